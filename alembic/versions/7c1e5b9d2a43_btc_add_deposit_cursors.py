@@ -0,0 +1,38 @@
+"""btc add deposit cursors
+
+Revision ID: 7c1e5b9d2a43
+Revises: 430a023f6d1d
+Create Date: 2026-10-18 14:40:12.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1e5b9d2a43'
+down_revision = '430a023f6d1d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.schema.CreateSequence(sa.Sequence('deposit_cursors_id', schema='btc_public')))
+    op.create_table(
+        'deposit_cursors',
+        sa.Column('id', sa.Integer, sa.Sequence('deposit_cursors_id', schema='btc_public'), primary_key=True),
+        sa.Column('bitcoind_inst_ref', sa.Integer, sa.ForeignKey('btc_public.bitcoind_instances.id'),
+                  nullable=False),
+        sa.Column('confirmations_applied', sa.Integer, nullable=False),
+        sa.Column('block_hash', sa.String(64), nullable=False),
+        sa.Column('ancestor_hashes', postgresql.ARRAY(sa.String(64))),
+        sa.Column('timestamp', sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.UniqueConstraint('bitcoind_inst_ref', 'confirmations_applied'),
+        schema='btc_public'
+    )
+
+
+def downgrade():
+    op.drop_table('deposit_cursors', schema='btc_public')
+    op.execute(sa.schema.DropSequence(sa.Sequence('deposit_cursors_id', schema='btc_public')))
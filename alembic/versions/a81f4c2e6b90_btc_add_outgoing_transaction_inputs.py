@@ -0,0 +1,45 @@
+"""btc add outgoing transaction inputs
+
+Revision ID: a81f4c2e6b90
+Revises: f3c8a1d94b27
+Create Date: 2026-10-18 21:04:12.318540
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a81f4c2e6b90'
+down_revision = 'f3c8a1d94b27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('outgoing_transactions', sa.Column('is_rejected', sa.Boolean, server_default=sa.false()),
+                  schema='btc_public')
+    op.create_index('ix_btc_public_outgoing_transactions_is_rejected', 'outgoing_transactions', ['is_rejected'],
+                    schema='btc_public')
+
+    op.execute(sa.schema.CreateSequence(sa.Sequence('outgoing_transaction_inputs_id', schema='btc_public')))
+    op.create_table(
+        'outgoing_transaction_inputs',
+        sa.Column('id', sa.Integer, sa.Sequence('outgoing_transaction_inputs_id', schema='btc_public'),
+                  primary_key=True),
+        sa.Column('outgoing_ref', sa.Integer, sa.ForeignKey('btc_public.outgoing_transactions.id'), nullable=False,
+                  index=True),
+        sa.Column('utxo_txid', sa.String(64), nullable=False),
+        sa.Column('utxo_vout', sa.Integer, nullable=False),
+        sa.Column('address', sa.String(64), nullable=False),
+        sa.Column('amount', sa.Numeric(precision=32, scale=24, asdecimal=True), nullable=False),
+        schema='btc_public'
+    )
+
+
+def downgrade():
+    op.drop_table('outgoing_transaction_inputs', schema='btc_public')
+    op.execute(sa.schema.DropSequence(sa.Sequence('outgoing_transaction_inputs_id', schema='btc_public')))
+
+    op.drop_index('ix_btc_public_outgoing_transactions_is_rejected', 'outgoing_transactions', schema='btc_public')
+    op.drop_column('outgoing_transactions', 'is_rejected', schema='btc_public')
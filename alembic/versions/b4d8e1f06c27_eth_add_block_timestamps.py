@@ -0,0 +1,32 @@
+"""eth add block timestamps
+
+Revision ID: b4d8e1f06c27
+Revises: 7c1e5b9d2a43
+Create Date: 2026-10-18 16:05:41.772310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b4d8e1f06c27'
+down_revision = '7c1e5b9d2a43'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.schema.CreateSequence(sa.Sequence('block_timestamps_id', schema='eth_public')))
+    op.create_table(
+        'block_timestamps',
+        sa.Column('id', sa.Integer, sa.Sequence('block_timestamps_id', schema='eth_public'), primary_key=True),
+        sa.Column('block_num', sa.Integer, unique=True),
+        sa.Column('block_timestamp', sa.Integer, index=True),
+        schema='eth_public'
+    )
+
+
+def downgrade():
+    op.drop_table('block_timestamps', schema='eth_public')
+    op.execute(sa.schema.DropSequence(sa.Sequence('block_timestamps_id', schema='eth_public')))
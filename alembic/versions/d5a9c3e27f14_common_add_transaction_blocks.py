@@ -0,0 +1,33 @@
+"""common add transaction blocks
+
+Revision ID: d5a9c3e27f14
+Revises: b4d8e1f06c27
+Create Date: 2026-10-18 16:52:09.118403
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'd5a9c3e27f14'
+down_revision = 'b4d8e1f06c27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('crypto_deposit_transactions', sa.Column('block_num', sa.Integer), schema='common_public')
+    op.add_column('crypto_deposit_transactions', sa.Column('block_hash', sa.String), schema='common_public')
+    op.add_column('crypto_withdraw_transactions', sa.Column('block_nums', postgresql.ARRAY(sa.Integer)),
+                  schema='common_public')
+    op.add_column('crypto_withdraw_transactions', sa.Column('block_hashes', postgresql.ARRAY(sa.String)),
+                  schema='common_public')
+
+
+def downgrade():
+    op.drop_column('crypto_withdraw_transactions', 'block_hashes', schema='common_public')
+    op.drop_column('crypto_withdraw_transactions', 'block_nums', schema='common_public')
+    op.drop_column('crypto_deposit_transactions', 'block_hash', schema='common_public')
+    op.drop_column('crypto_deposit_transactions', 'block_num', schema='common_public')
@@ -0,0 +1,34 @@
+"""btc add outgoing transactions
+
+Revision ID: f3c8a1d94b27
+Revises: d5a9c3e27f14
+Create Date: 2026-10-18 19:21:37.504912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f3c8a1d94b27'
+down_revision = 'd5a9c3e27f14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute(sa.schema.CreateSequence(sa.Sequence('outgoing_transactions_id', schema='btc_public')))
+    op.create_table(
+        'outgoing_transactions',
+        sa.Column('id', sa.Integer, sa.Sequence('outgoing_transactions_id', schema='btc_public'), primary_key=True),
+        sa.Column('txid', sa.String(64), index=True, unique=True),
+        sa.Column('signed_trx', sa.Text, nullable=False),
+        sa.Column('is_sent', sa.Boolean, index=True),
+        sa.Column('timestamp', sa.DateTime(timezone=True), server_default=sa.func.now(), index=True),
+        schema='btc_public'
+    )
+
+
+def downgrade():
+    op.drop_table('outgoing_transactions', schema='btc_public')
+    op.execute(sa.schema.DropSequence(sa.Sequence('outgoing_transactions_id', schema='btc_public')))
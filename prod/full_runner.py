@@ -34,6 +34,17 @@ if __name__ == '__main__':
         deposit_notification_endpoint = f"{environ['CALLBACK_API_ROOT']}/deposit"
         withdraw_notification_endpoint = f"{environ['CALLBACK_API_ROOT']}/withdraw"
 
+        # chain monitors are woken up by new block notifications when BITCOIND_ZMQ_URL/ETHEREUMD_WS_URL are set,
+        # polling every FALLBACK_INTERVAL seconds catches up missed ones
+        btcd_zmq_uri = environ.get('BITCOIND_ZMQ_URL') or None
+        ethd_ws_uri = environ.get('ETHEREUMD_WS_URL') or None
+        fallback_interval = float(environ.get('FALLBACK_INTERVAL', 300))
+
+        # BTC withdrawals are batched only when BTC_BATCH_INTERVAL (seconds) is set
+        btc_batch_interval = environ.get('BTC_BATCH_INTERVAL')
+        btc_batch_interval = float(btc_batch_interval) if btc_batch_interval else None
+        btc_batch_size = int(environ.get('BTC_BATCH_SIZE', 100))
+
         sentry_dsn = os.environ.get("SENTRY_DSN", None)
         app_release = os.environ.get("APP_VERSION", "local_commit")
         sentry_environment = os.environ.get("SENTRY_ENVIRONMENT", "local")
@@ -60,6 +71,11 @@ if __name__ == '__main__':
         eth_signing_instance_uri=eth_signing_instance_uri,
         deposit_notification_endpoint=deposit_notification_endpoint,
         withdraw_notification_endpoint=withdraw_notification_endpoint,
+        btc_batch_interval=btc_batch_interval,
+        btc_batch_size=btc_batch_size,
+        btcd_zmq_uri=btcd_zmq_uri,
+        ethd_ws_uri=ethd_ws_uri,
+        fallback_interval=fallback_interval,
         sentry_dsn=sentry_dsn,
         app_release=app_release,
         sentry_environment=sentry_environment
@@ -0,0 +1,215 @@
+import decimal
+import random
+from collections import namedtuple
+
+from transer.exceptions import BtcInsufficientFundsException
+
+SATOSHI = decimal.Decimal('0.00000001')
+
+# P2PKH transaction layout, see create_transaction.raw_transaction_size()
+TX_OVERHEAD_SIZE = 10
+INPUT_SIZE = 148
+OUTPUT_SIZE = 34
+
+DUST_THRESHOLD = 546    # satoshi, smaller outputs are non-standard
+MAX_INPUTS = 20         # keeps transactions small even when the wallet is full of tiny UTXOs
+BNB_MAX_TRIES = 100000
+KNAPSACK_ITERATIONS = 1000
+
+Utxo = namedtuple('Utxo', ['txid', 'vout', 'address', 'amount'])
+Selection = namedtuple('Selection', ['utxos', 'fee', 'change'])
+
+
+def to_satoshi(amount):
+    return int((decimal.Decimal(amount) / SATOSHI).to_integral_value(rounding=decimal.ROUND_HALF_UP))
+
+
+def from_satoshi(value):
+    return (decimal.Decimal(value) * SATOSHI).quantize(SATOSHI)
+
+
+def transaction_size(inputs, outputs):
+    return TX_OVERHEAD_SIZE + INPUT_SIZE * inputs + OUTPUT_SIZE * outputs
+
+
+def size_fee(size, feerate):
+    """
+    :param feerate: satoshi за 1000 байт
+    :return: комиссия в satoshi, с округлением вверх
+    """
+    return -(-size * feerate // 1000)
+
+
+def branch_and_bound(values, target, cost_of_change, max_inputs):
+    """
+    Поиск в глубину подмножества, покрывающего target без сдачи: сумма в [target, target + cost_of_change]
+    с минимальным превышением
+
+    :param values: эффективные суммы UTXO по убыванию
+    :return: индексы в values или None
+    """
+    best, best_excess = None, None
+    included = []   # decision per value, values[len(included)] is the next one
+    value = 0
+    inputs = 0
+    available = sum(values)
+
+    for _ in range(BNB_MAX_TRIES):
+        backtrack = False
+        if value + available < target or value > target + cost_of_change or inputs > max_inputs:
+            backtrack = True
+        elif value >= target:
+            excess = value - target
+            if best_excess is None or excess < best_excess:
+                best = [i for i, inc in enumerate(included) if inc]
+                best_excess = excess
+                if excess == 0:
+                    break
+            backtrack = True
+
+        if backtrack:
+            # walk back to the last included value and try to omit it
+            while included and not included[-1]:
+                included.pop()
+                available += values[len(included)]
+            if not included:
+                break
+            included[-1] = False
+            value -= values[len(included) - 1]
+            inputs -= 1
+        else:
+            i = len(included)
+            available -= values[i]
+            if included and not included[-1] and values[i] == values[i - 1]:
+                included.append(False)     # the same branch has been searched with the previous equal value
+            else:
+                included.append(True)
+                value += values[i]
+                inputs += 1
+
+    return best
+
+
+def knapsack(values, target, max_inputs, rng):
+    """
+    Стохастическое приближение лучшего подмножества, как в bitcoind до branch-and-bound:
+    наименьший UTXO больше target против подмножества меньших
+
+    :param values: эффективные суммы UTXO по убыванию
+    :return: индексы в values или None
+    """
+    lowest_larger = None
+    smaller = []
+    for i, v in enumerate(values):
+        if v == target:
+            return [i]
+        elif v < target:
+            smaller.append(i)
+        elif lowest_larger is None or v < values[lowest_larger]:
+            lowest_larger = i
+
+    total_smaller = sum(values[i] for i in smaller)
+    if total_smaller < target:
+        return [lowest_larger] if lowest_larger is not None else None
+
+    best = [True] * len(smaller)
+    best_value = total_smaller
+    for _ in range(KNAPSACK_ITERATIONS):
+        if best_value == target:
+            break
+
+        included = [False] * len(smaller)
+        total = 0
+        reached = False
+        for pass_num in range(2):
+            if reached:
+                break
+            for k, i in enumerate(smaller):
+                if (rng.random() < 0.5) if pass_num == 0 else not included[k]:
+                    total += values[i]
+                    included[k] = True
+                    if total >= target:
+                        reached = True
+                        if total < best_value:
+                            best_value = total
+                            best = included[:]
+                        total -= values[i]
+                        included[k] = False
+
+    subset = [i for i, inc in zip(smaller, best) if inc]
+    if lowest_larger is not None and (values[lowest_larger] <= best_value or len(subset) > max_inputs):
+        return [lowest_larger]
+    return subset if len(subset) <= max_inputs else None
+
+
+def largest_first(values, target, max_inputs):
+    """
+    :param values: эффективные суммы UTXO по убыванию
+    :return: индексы в values или None
+    """
+    total = 0
+    for i, v in enumerate(values[:max_inputs]):
+        total += v
+        if total >= target:
+            return list(range(i + 1))
+    return None
+
+
+def select_coins(utxos, amount, feerate, outputs=1, max_inputs=MAX_INPUTS, rng=None):
+    """
+    Выбор UTXO для выплаты с минимальной комиссией: branch-and-bound ищет набор без сдачи,
+    knapsack и largest-first - наборы со сдачей; из найденных берётся самый дешёвый с учётом
+    стоимости последующей траты сдачи. UTXO, трата которых стоит больше их суммы, не используются
+
+    :param utxos: [Utxo, ...], amount в BTC
+    :param amount: сумма выплат в BTC; decimal.Decimal
+    :param feerate: BTC за 1000 байт (как estimatesmartfee); decimal.Decimal
+    :param outputs: количество выходов-выплат, без сдачи
+    :param max_inputs: ограничение количества входов
+    :return: Selection(utxos, fee, change) - fee и change в BTC, change == 0 для транзакции без сдачи
+    """
+    rng = rng or random.Random()
+
+    feerate = to_satoshi(feerate)
+    input_fee = size_fee(INPUT_SIZE, feerate)
+    change_fee = size_fee(OUTPUT_SIZE, feerate)
+    cost_of_change = change_fee + input_fee     # the change output now and spending it later
+    need = to_satoshi(amount) + size_fee(TX_OVERHEAD_SIZE + OUTPUT_SIZE * outputs, feerate)
+
+    # effective value is what an UTXO brings after paying for its own input
+    candidates = [(to_satoshi(u.amount) - input_fee, u) for u in utxos]
+    candidates = [c for c in candidates if c[0] > 0 and c[0] + input_fee >= DUST_THRESHOLD]
+    candidates.sort(key=lambda c: c[0], reverse=True)
+    values = [c[0] for c in candidates]
+
+    need_with_change = need + change_fee + DUST_THRESHOLD
+    selections = [
+        branch_and_bound(values, need, cost_of_change, max_inputs),
+        knapsack(values, need_with_change, max_inputs, rng),
+        largest_first(values, need_with_change, max_inputs) or largest_first(values, need, max_inputs)
+    ]
+
+    best, best_cost = None, None
+    for selected in selections:
+        if selected is None:
+            continue
+
+        excess = sum(values[i] for i in selected) - need
+        change = excess - change_fee
+        if excess >= cost_of_change and change >= DUST_THRESHOLD:
+            fee = need - to_satoshi(amount) + len(selected) * input_fee + change_fee
+            cost = fee + input_fee
+        else:
+            change = 0
+            fee = need - to_satoshi(amount) + len(selected) * input_fee + excess
+            cost = fee
+
+        if best_cost is None or (cost, len(selected)) < (best_cost, len(best.utxos)):
+            best = Selection([candidates[i][1] for i in selected], from_satoshi(fee), from_satoshi(change))
+            best_cost = cost
+
+    if best is None:
+        raise BtcInsufficientFundsException(
+            f'insufficient amount of funds for {amount} at feerate {from_satoshi(feerate)} within {max_inputs} inputs'
+        )
+    return best
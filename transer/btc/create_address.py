@@ -9,12 +9,13 @@ from transer.db.btc import BitcoindInstance, Address, MasterKey
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 
 from transer import config
-from transer.utils import jsonrpc_caller
+from transer.utils import jsonrpc_caller, cpu_bound
 
 btc_signing_instance_uri = config['btc_signing_instance_uri']
 
 
 @_btc_dispatcher.add_method
+@cpu_bound
 @jsonrpc_caller(target_uri=btc_signing_instance_uri, catchables=[BtcAddressIntegrityException])
 def create_unpropagated_address(bt_name, key_name):
     try:
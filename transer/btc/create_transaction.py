@@ -1,9 +1,10 @@
 import decimal
 
 from transer.btc.validate_addresses import validate_addrs
+from transer.btc.coin_selection import Utxo, TX_OVERHEAD_SIZE, INPUT_SIZE, OUTPUT_SIZE
 from transer.exceptions import BtcCreateTransactionException
 from transer.btc import _btc_dispatcher
-from transer.db.btc import BitcoindInstance
+from transer.db.btc import BitcoindInstance, Address
 
 from sqlalchemy.orm.exc import NoResultFound
 
@@ -31,7 +32,7 @@ def raw_transaction_size(sources, destination, change=None):
     if isinstance(change, str):
         outs += 1
 
-    return 148 * ins + 34 * outs + 10
+    return INPUT_SIZE * ins + OUTPUT_SIZE * outs + TX_OVERHEAD_SIZE
 
 
 def transaction_fee_per_byte(bitcoind_inst, preferred_blocks=2):
@@ -43,6 +44,22 @@ def transaction_fee_per_byte(bitcoind_inst, preferred_blocks=2):
     return fee
 
 
+def transaction_feerate(bitcoind_inst, preferred_blocks=2):
+    """
+    :return: рекомендованная комиссия в BTC за 1000 байт; decimal.Decimal
+    """
+    fee = transaction_fee_per_byte(
+        bitcoind_inst=bitcoind_inst,
+        preferred_blocks=preferred_blocks
+    )
+
+    errors = fee.get('errors')
+    if errors:
+        e = ', '.join(errors)
+        raise BtcCreateTransactionException(f'Fee calculation is impossible because of errors: {e}')
+    return fee['feerate']
+
+
 def raw_transaction_fee(bitcoind_inst, sources, destination, change=None, preferred_blocks=2):
     """
     Считалка рекомендованной комиссии транзакции в BTC для P2SH-транзакции
@@ -58,18 +75,13 @@ def raw_transaction_fee(bitcoind_inst, sources, destination, change=None, prefer
     """
 
     byte_size = raw_transaction_size(sources, destination, change)
-    fee = transaction_fee_per_byte(
+    feerate = transaction_feerate(
         bitcoind_inst=bitcoind_inst,
         preferred_blocks=preferred_blocks
     )
 
-    errors = fee.get('errors')
-    if errors:
-        e = ', '.join(errors)
-        raise BtcCreateTransactionException(f'Fee calculation is impossible because of errors: {e}')
-
     # kilobyte == 1000 bytes ^__^       https://en.wikipedia.org/wiki/Kilobyte
-    return byte_size * fee['feerate'] / decimal.Decimal(1000.0)
+    return byte_size * feerate / decimal.Decimal(1000.0)
 
 
 def create_raw_transaction(bitcoind_inst, sources, destination,
@@ -111,6 +123,55 @@ def create_raw_transaction(bitcoind_inst, sources, destination,
     return trx_h, trx
 
 
+def list_wallet_utxos(bitcoind_inst, masterkey, exclude_addresses=(), exclude_outpoints=(), confirmations=6):
+    """
+    Реальный набор UTXO кошелька вместо баланса адресов из БД
+
+    :param bitcoind_inst: instance of btc.BitcoindInstance
+    :param masterkey: instance of btc.MasterKey, чьи адреса тратятся
+    :param exclude_addresses: адреса, UTXO которых не тратятся
+    :param exclude_outpoints: [(txid, vout), ...] - UTXO, уже потраченные ещё не отправленными транзакциями
+    :param confirmations: количество подтвержденных блоков для засчитывания транзакции
+    :return: [coin_selection.Utxo, ...]
+    """
+    wallet_addresses_q = Address.query.with_entities(Address.address).filter(
+        Address.bitcoind_inst == bitcoind_inst,
+        Address.masterkey == masterkey,
+        Address.is_populated.is_(True)
+    )
+    wallet_addresses = {a for a, in wallet_addresses_q} - set(exclude_addresses)
+    exclude_outpoints = set(exclude_outpoints)
+
+    bitcoind = bitcoind_inst.get_rpc_conn()
+    unspents = bitcoind.listunspent(confirmations, 999999999)
+    return [
+        Utxo(u['txid'], u['vout'], u['address'], u['amount'])
+        for u in unspents
+        if u.get('address') in wallet_addresses and (u['txid'], u['vout']) not in exclude_outpoints
+    ]
+
+
+def create_raw_transaction_from_utxos(bitcoind_inst, utxos, payments, change=None, change_amount=decimal.Decimal(0)):
+    """
+    Сырая транзакция из выбранных UTXO (см. coin_selection.select_coins())
+
+    :param bitcoind_inst: instance of btc.BitcoindInstance
+    :param utxos: [coin_selection.Utxo, ...]
+    :param payments: {wallet_address: amount, ...} - выплаты; amount в decimal.Decimal
+    :param change: wallet_address as str - кошелек для остатка или None
+    :param change_amount: сдача; decimal.Decimal
+    :return: (trx_h, trx) -  сырая транзакция в hex:str и декодированная транзакция в dict
+    """
+    outs = dict(payments)
+    if change_amount > 0:
+        outs[change] = outs.get(change, decimal.Decimal(0)) + change_amount
+
+    bitcoind = bitcoind_inst.get_rpc_conn()
+    trx_h = bitcoind.createrawtransaction([{'txid': u.txid, 'vout': u.vout} for u in utxos], outs)
+    trx = bitcoind.decoderawtransaction(trx_h)
+    return trx_h, trx
+
+
 @_btc_dispatcher.add_method
 def calculate_transaction_fee(bt_name, sources, destination, change=None, preferred_blocks=2):
     """
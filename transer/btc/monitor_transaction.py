@@ -1,97 +1,263 @@
+import logging
+import itertools
+
 from bitcoinrpc.authproxy import JSONRPCException
 
 from transer.exceptions import BtcMonitorTransactionException
 from transer.btc import _btc_dispatcher
+from transer.btc.rpc_client import get_chain
+from transer.chain_cache import REORG_DEPTH
+from transer.chain_store import get_chain_store
 from transer.db import btc, sqla_session
 
-from sqlalchemy import desc
+from sqlalchemy import desc, text
 from sqlalchemy.orm.exc import NoResultFound
 
+logger = logging.getLogger('monitor')
 
-@_btc_dispatcher.add_method
-def get_recent_deposit_transactions(bt_name, confirmations=6):
+CURSOR_DEPTH = 20   # previous deposit cursor positions kept for rewinding on chain reorganization
+NOT_FOUND = -5  # bitcoind RPC_INVALID_ADDRESS_OR_KEY: no such block or transaction
+SYNC_PAGE_SIZE = 5000   # listtransactions page size for the initial wallet sync, a few MB of JSON
+
+
+def get_deposit_cursor(bitcoind_inst, confirmations):
+    """
+    :return: btc.DepositCursor или None, если сканирование ещё не запускалось
+    """
+    cursor = btc.DepositCursor.query.filter_by(
+        bitcoind_inst=bitcoind_inst,
+        confirmations_applied=confirmations
+    ).one_or_none()
+    if cursor is not None:
+        return cursor
+
+    # the scanner used to keep its position in DepositsLog, continue from there
+    log_entry_q = btc.DepositsLog.query\
+        .filter_by(bitcoind_inst=bitcoind_inst, confirmations_applied=confirmations)\
+        .order_by(desc(btc.DepositsLog.timestamp))\
+        .limit(1)
+    log_entry = log_entry_q.one_or_none()
+    if log_entry is None:
+        return None
+
+    cursor = btc.DepositCursor(
+        bitcoind_inst=bitcoind_inst,
+        confirmations_applied=confirmations,
+        block_hash=log_entry.confirmed_block_hash,
+        ancestor_hashes=[]
+    )
+    sqla_session.add(cursor)
+    return cursor
+
+
+# candidates come as arrays, so the filtering is a single round trip whatever their number
+FILTER_DEPOSIT_CANDIDATES_SQL = text(f'''
+SELECT c.idx
+FROM unnest(CAST(:txids AS varchar[]), CAST(:addresses AS varchar[])) WITH ORDINALITY AS c(txid, address, idx)
+JOIN {btc.Address.__table__.fullname} a ON a.address = c.address
+WHERE a.bitcoind_inst_ref = :bitcoind_inst_ref
+    AND a.is_populated
+    AND NOT EXISTS (
+        SELECT 1 FROM {btc.ChangeTransactionLog.__table__.fullname} ch WHERE ch.change_tx_id = c.txid
+    )
+ORDER BY c.idx
+''')
+
+
+def filter_deposit_candidates(bitcoind_inst, receive_txs):
+    """
+    Отбор входящих транзакций на адреса кошелька, исключая change транзакции, средствами Postgres
+
+    :param receive_txs: транзакции из listsinceblock
+    :return: отобранные receive_txs в исходном порядке
+    """
+    if len(receive_txs) == 0:
+        return []
+
+    rows = sqla_session.execute(FILTER_DEPOSIT_CANDIDATES_SQL, {
+        'txids': [x['txid'] for x in receive_txs],
+        'addresses': [x['address'] for x in receive_txs],
+        'bitcoind_inst_ref': bitcoind_inst.id
+    })
+    return [receive_txs[r.idx - 1] for r in rows]     # ordinality is 1-based
+
+
+def is_orphaned(bitcoind, block_hash):
+    if get_chain(bitcoind.service_url).in_main_chain(block_hash):
+        return False
+
+    try:
+        header = bitcoind.getblockheader(block_hash)
+    except JSONRPCException as e:
+        if e.code == NOT_FOUND:
+            return True
+        raise
+    return header['confirmations'] == -1
+
+
+def rewind_deposit_cursor(bitcoind, cursor):
+    """
+    Откат курсора к последней сохранённой позиции, оставшейся в основной цепочке после реорганизации
+
+    :return: hash блока, с которого нужно продолжить сканирование
+    """
+    positions = [cursor.block_hash] + list(cursor.ancestor_hashes or [])
+    headers = bitcoind.batch_([['getblockheader', h] for h in positions], raise_errors=False)
+
+    for i, (block_hash, header) in enumerate(zip(positions, headers)):
+        if isinstance(header, JSONRPCException):
+            if header.code == NOT_FOUND:
+                continue
+            raise header
+        if header['confirmations'] != -1:
+            logger.warning(f'Chain reorganization: deposit cursor rewound from {cursor.block_hash} to {block_hash}')
+            cursor.block_hash = block_hash
+            cursor.ancestor_hashes = positions[i + 1:]
+            return block_hash
+
+    raise BtcMonitorTransactionException(
+        f'Chain reorganization is deeper than {len(positions)} tracked deposit cursor positions'
+    )
+
+
+def is_deposit_candidate(tx, confirmations):
+    return tx['category'] == 'receive' and tx['confirmations'] >= confirmations
+
+
+def list_wallet_transactions(bitcoind, confirmations):
+    """
+    Постраничный обход всей истории кошелька через listtransactions вместо listsinceblock(''),
+    который отдаёт её одним ответом. Транзакции, пришедшие во время обхода, сдвигают страницы
+    и могут попасть в выборку повторно, но не пропускаются
+
+    bitcoind проходит skip записей от конца истории на каждой странице, так что обход квадратичен:
+    n^2 / (2 * SYNC_PAGE_SIZE) записей, около 10^8 для истории в миллион записей - минуты работы узла.
+    Это приемлемо, тк. обход выполняется однократно, пока у сканера нет курсора (см. DepositCursor),
+    а ограниченных сверху по блокам выборок listsinceblock не поддерживает - ответ всегда доходит
+    до вершины чейна
+
+    :return: генератор list-ов receive транзакций, по странице за раз
+    """
+    skip = 0
+    while True:
+        page = bitcoind.listtransactions('*', SYNC_PAGE_SIZE, skip, True)
+        yield [x for x in page if is_deposit_candidate(x, confirmations)]
+
+        if len(page) < SYNC_PAGE_SIZE:
+            return
+        skip += SYNC_PAGE_SIZE
+
+
+def iter_recent_deposit_transactions(bt_name, confirmations=6):
     """
     pull-проверяльщик новых входящих (receive) транзакций, для заданного количества конфирмаций
-    гарантирует однократный учёт входящих транзакций (only-once semantics)
+    гарантирует однократный учёт входящих транзакций (only-once semantics).
+    Курсор сдвигается после того, как потребитель обработал все порции
 
     :param bt_name: name to lookup in btc.BitcoindInstance, as str
     :param confirmations: минимальное количетство подтверждений, для которого проверяется наличие новых транзакций;
         является дискриминатором: для разных величин алгоритм отрабатывает независимо
-    :return:
+    :return: генератор list-ов входящих транзакций на адреса кошелька, память ограничена размером порции
     """
 
     # explicitly prohibit mempool/unconfirmed transactions to prevent race conditions
     if confirmations <= 0:
-        return []
+        return
 
     try:
         bitcoind_inst = btc.BitcoindInstance.query.filter_by(instance_name=bt_name).one()
     except NoResultFound:
         raise BtcMonitorTransactionException(f'Bitcoind RPC server with name {bt_name} not found')
 
-    log_entry_q = btc.DepositsLog.query\
-        .filter_by(bitcoind_inst=bitcoind_inst)\
-        .order_by(desc(btc.DepositsLog.timestamp))\
-        .limit(1)
-
-    try:
-        log_entry = log_entry_q.one()
-        latest_block_hash = log_entry.confirmed_block_hash
-    except NoResultFound:
-        latest_block_hash = ''
+    cursor = get_deposit_cursor(bitcoind_inst, confirmations)
 
     bitcoind = bitcoind_inst.get_rpc_conn()
     try:
-        res = bitcoind.listsinceblock(latest_block_hash, confirmations, True)
+        if cursor is None:
+            # the same block listsinceblock() would report as 'lastblock'
+            chain = get_chain(bitcoind.service_url)
+            lastblock_height = max(chain.tip().height - confirmations + 1, 0)
+            lastblock = chain.headers_at([lastblock_height])[lastblock_height].hash
+            pages = list_wallet_transactions(bitcoind, confirmations)
+        else:
+            if is_orphaned(bitcoind, cursor.block_hash):
+                since_block_hash = rewind_deposit_cursor(bitcoind, cursor)
+            else:
+                since_block_hash = cursor.block_hash
+
+            res = bitcoind.listsinceblock(since_block_hash, confirmations, True)
+            lastblock = res['lastblock']
+            pages = [[x for x in res['transactions'] if is_deposit_candidate(x, confirmations)]]
+
+        for receive_txs in pages:
+            res_list = filter_deposit_candidates(bitcoind_inst, receive_txs)
+            if res_list:
+                yield res_list
     except JSONRPCException as e:
         raise BtcMonitorTransactionException(str(e)) from e
 
-    txs = res['transactions']
-    receive_txs = [x for x in txs if x['category'] == 'receive' and x['confirmations'] >= confirmations]
-
-    txids = [x['txid'] for x in receive_txs]
-    change_txs_q = btc.ChangeTransactionLog.query.filter(
-        # Size of sql-statement is limited to 1G. It will be enough
-        # See https://doxygen.postgresql.org/memutils_8h.html#a74a92b981e9b6aa591c5fbb24efd1dac
-        btc.ChangeTransactionLog.change_tx_id.in_(txids)
-    )
-    change_txs = change_txs_q.all()
-    change_txids = [x.change_tx_id for x in change_txs]     # txids to exclude from result list
-
-    addresses = [x['address'] for x in receive_txs]
-    involved_addresses_q = btc.Address.query.filter(
-        # Size of sql-statement is limited to 1G. It will be enough
-        # See https://doxygen.postgresql.org/memutils_8h.html#a74a92b981e9b6aa591c5fbb24efd1dac
-        btc.Address.address.in_(addresses),
-        btc.Address.bitcoind_inst == bitcoind_inst,
-        btc.Address.is_populated.is_(True)
-    )
-    involved_addresses = [x.address for x in involved_addresses_q.all()]    # addresses to include to result list
-
-    res_list = []
-    for i in receive_txs:
-        if i['address'] not in involved_addresses or i['txid'] in change_txids:
-            continue
-        res_list.append(i)
-
-    lastblock = res['lastblock']
-    check_lastblock_q = btc.DepositsLog.query.filter(
-        btc.DepositsLog.confirmed_block_hash == lastblock,
-        btc.DepositsLog.confirmations_applied == confirmations
-    )
-    try:
-        check_lastblock_q.one()
-    except NoResultFound:
-        log_lastblock = btc.DepositsLog(
+    if cursor is None:
+        cursor = btc.DepositCursor(
             bitcoind_inst=bitcoind_inst,
             confirmations_applied=confirmations,
-            confirmed_block_hash=lastblock
+            block_hash=lastblock,
+            ancestor_hashes=[]
         )
-        sqla_session.add(log_lastblock)
+        sqla_session.add(cursor)
+    else:
+        cursor.advance(lastblock, CURSOR_DEPTH)
 
     sqla_session.commit()
 
-    return res_list
+
+@_btc_dispatcher.add_method
+def get_recent_deposit_transactions(bt_name, confirmations=6):
+    """
+    См. iter_recent_deposit_transactions()
+
+    :return: list входящих транзакций на адреса кошелька
+    """
+    return list(itertools.chain.from_iterable(iter_recent_deposit_transactions(bt_name, confirmations)))
+
+
+def cached_transactions(bitcoind, txids):
+    """
+    Транзакции за горизонтом реорганизаций из локального кэша (см. transer.chain_store),
+    confirmations пересчитываются от текущей вершины чейна
+
+    :return: {txid: decoded transaction} найденных в кэше
+    """
+    store = get_chain_store()
+    if store is None:
+        return {}
+
+    chain = get_chain(bitcoind.service_url)
+    cached = store.get_many(f'btc_tx:{chain.network()}', txids)
+    if len(cached) == 0:
+        return {}
+
+    tip_height = chain.tip().height
+    txs = {}
+    for txid, (tx, block_height) in cached.items():
+        txs[txid] = dict(tx, confirmations=tip_height - block_height + 1)
+    return txs
+
+
+def store_transactions(bitcoind, txs):
+    """
+    Сохранение в локальный кэш транзакций, у которых больше REORG_DEPTH подтверждений
+
+    :param txs: [decoded transaction, ...]
+    """
+    store = get_chain_store()
+    deep_txs = [tx for tx in txs if tx.get('confirmations', 0) > REORG_DEPTH]
+    if store is None or len(deep_txs) == 0:
+        return
+
+    chain = get_chain(bitcoind.service_url)
+    tip_height = chain.tip().height
+    txs = {tx['txid']: (tx, tip_height - tx['confirmations'] + 1) for tx in deep_txs}
+    store.put_many(f'btc_tx:{chain.network()}', txs)
 
 
 @_btc_dispatcher.add_method
@@ -102,9 +268,68 @@ def get_txid_status(bt_name, txid):
         raise BtcMonitorTransactionException(f'Bitcoind RPC server with name {bt_name} not found')
 
     bitcoind = bitcoind_inst.get_rpc_conn()
+    cached = cached_transactions(bitcoind, [txid])
+    if txid in cached:
+        return cached[txid]
+
     try:
         res = bitcoind.getrawtransaction(txid, True)
     except JSONRPCException as e:
         raise BtcMonitorTransactionException(str(e)) from e
 
+    store_transactions(bitcoind, [res])
     return res
+
+
+@_btc_dispatcher.add_method
+def get_txids_status(bt_name, txids):
+    """
+    Пакетный вариант get_txid_status(): все getrawtransaction, кроме найденных в локальном кэше,
+    уходят одним JSON-RPC batch запросом
+
+    :param bt_name: name to lookup in btc.BitcoindInstance, as str
+    :param txids: [txid, ...]
+    :return: {txid: decoded transaction или None, если транзакция не найдена}
+    """
+    try:
+        bitcoind_inst = btc.BitcoindInstance.query.filter_by(instance_name=bt_name).one()
+    except NoResultFound:
+        raise BtcMonitorTransactionException(f'Bitcoind RPC server with name {bt_name} not found')
+
+    bitcoind = bitcoind_inst.get_rpc_conn()
+    cached = cached_transactions(bitcoind, txids)
+    missing_txids = [txid for txid in txids if txid not in cached]
+    try:
+        res = bitcoind.batch_([['getrawtransaction', txid, True] for txid in missing_txids], raise_errors=False)
+    except JSONRPCException as e:
+        raise BtcMonitorTransactionException(str(e)) from e
+
+    # only 'not found' means the transaction is gone, any other error (warmup, full work queue) is transient
+    txs = {}
+    for txid, r in zip(missing_txids, res):
+        if isinstance(r, JSONRPCException):
+            if r.code != NOT_FOUND:
+                raise BtcMonitorTransactionException(f'getrawtransaction {txid} failed: {r.error}') from r
+            r = None
+        txs[txid] = r
+    store_transactions(bitcoind, [tx for tx in txs.values() if tx is not None])
+
+    txs.update(cached)
+    return txs
+
+
+@_btc_dispatcher.add_method
+def get_best_block_hash(bt_name):
+    """
+    :param bt_name: name to lookup in btc.BitcoindInstance, as str
+    :return: hash вершины чейна
+    """
+    try:
+        bitcoind_inst = btc.BitcoindInstance.query.filter_by(instance_name=bt_name).one()
+    except NoResultFound:
+        raise BtcMonitorTransactionException(f'Bitcoind RPC server with name {bt_name} not found')
+
+    try:
+        return get_chain(bitcoind_inst.get_url()).tip().hash
+    except JSONRPCException as e:
+        raise BtcMonitorTransactionException(str(e)) from e
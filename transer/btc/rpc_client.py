@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import base64
+import decimal
+import threading
+import http.client
+import urllib.parse as urlparse
+
+from bitcoinrpc.authproxy import JSONRPCException, EncodeDecimal, USER_AGENT
+
+from transer import config, rpc_stats
+from transer.chain_cache import Header, HeaderCache, get_header_cache
+
+# bitcoind closes idle keep-alive connections; raised while sending, such errors mean that the request
+# has not reached the server and may be resent
+STALE_CONNECTION_ERRORS = (
+    http.client.CannotSendRequest,
+    BrokenPipeError,
+    ConnectionResetError
+)
+
+# raised while reading the response, such errors leave unknown whether the request has been served,
+# so only the calls that don't change the node state are resent
+STALE_RESPONSE_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.ResponseNotReady,
+    ConnectionResetError
+)
+
+READ_ONLY_METHODS = frozenset([
+    'getbestblockhash', 'getblockhash', 'getblockheader', 'getblock', 'getblockcount', 'getrawtransaction',
+    'gettransaction', 'listtransactions', 'listsinceblock', 'listunspent', 'estimatesmartfee',
+    'decoderawtransaction', 'getrawmempool', 'getmempoolentry', 'validateaddress'
+])
+
+
+def is_read_only(method):
+    """
+    :param method: имя метода или пакета методов, см. rpc_stats.batch_method()
+    """
+    return all(m in READ_ONLY_METHODS for m in method.split('+'))
+
+
+class BitcoindRpcClient(object):
+    """
+    Keep-alive соединение к bitcoind, протокол вызовов как у AuthServiceProxy.
+    Одиночные вызовы - через call()/атрибуты, пакетные - через batch_(); каждый запрос учитывается в rpc_stats
+    """
+
+    def __init__(self, service_url, timeout):
+        self.service_url = service_url
+        self.timeout = timeout
+        self.id_count = 0
+
+        self.url = urlparse.urlparse(service_url)
+        if self.url.scheme == 'https':
+            self.conn = http.client.HTTPSConnection(self.url.hostname, self.url.port or 443, timeout=timeout)
+        else:
+            self.conn = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=timeout)
+
+        authpair = f'{self.url.username}:{self.url.password}'.encode('utf8')
+        self.auth_header = b'Basic ' + base64.b64encode(authpair)
+
+    def call(self, method, *args):
+        self.id_count += 1
+        postdata = json.dumps(
+            {'version': '1.1', 'method': method, 'params': args, 'id': self.id_count},
+            default=EncodeDecimal
+        )
+        response = self._post(method, postdata)
+
+        if response.get('error') is not None:
+            raise JSONRPCException(response['error'])
+        elif 'result' not in response:
+            raise JSONRPCException({'code': -343, 'message': 'missing JSON-RPC result'})
+        return response['result']
+
+    def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            raise AttributeError
+        return lambda *args: self.call(name, *args)
+
+    def _request(self, method, postdata):
+        headers = {
+            'Host': self.url.hostname,
+            'User-Agent': USER_AGENT,
+            'Authorization': self.auth_header,
+            'Content-type': 'application/json'
+        }
+
+        try:
+            self.conn.request('POST', self.url.path, postdata, headers)
+        except STALE_CONNECTION_ERRORS:
+            self.conn.close()   # will be reopened by the next request
+            self.conn.request('POST', self.url.path, postdata, headers)
+
+        try:
+            http_response = self.conn.getresponse()
+        except STALE_RESPONSE_ERRORS:
+            self.conn.close()
+            if not is_read_only(method):
+                raise
+            self.conn.request('POST', self.url.path, postdata, headers)
+            http_response = self.conn.getresponse()
+
+        content_type = http_response.getheader('Content-Type')
+        responsedata = http_response.read()
+        if content_type != 'application/json':
+            raise JSONRPCException({
+                'code': -342,
+                'message': f'non-JSON HTTP response with \'{http_response.status} {http_response.reason}\' from server'
+            })
+        return responsedata
+
+    def _post(self, method, postdata, calls=1):
+        started = time.monotonic()
+        responsedata = b''
+        errors = calls
+        try:
+            responsedata = self._request(method, postdata)
+            response = json.loads(responsedata.decode('utf8'), parse_float=decimal.Decimal)
+            errors = rpc_stats.count_errors(response)
+            return response
+        finally:
+            rpc_stats.record('bitcoind', method, started, len(postdata), len(responsedata), errors, calls)
+
+    def batch_(self, rpc_calls, raise_errors=True):
+        """
+        JSON-RPC batch: все вызовы уходят одним HTTP запросом
+
+        :param rpc_calls: [[method, param1, param2, ...], ...]
+        :param raise_errors: если False, то вместо результатов неуспешных вызовов возвращаются
+            экземпляры JSONRPCException, иначе исключение пробрасывается
+        :return: list результатов в порядке rpc_calls
+        """
+        if len(rpc_calls) == 0:
+            return []
+
+        batch_data = [
+            {'jsonrpc': '2.0', 'method': c[0], 'params': list(c[1:]), 'id': i}
+            for i, c in enumerate(rpc_calls)
+        ]
+        responses = self._post(
+            rpc_stats.batch_method(c[0] for c in rpc_calls),
+            json.dumps(batch_data, default=EncodeDecimal),
+            calls=len(rpc_calls)
+        )
+        if isinstance(responses, dict):
+            raise JSONRPCException(responses.get('error') or {'code': -343, 'message': 'malformed batch response'})
+
+        responses_by_id = {r.get('id'): r for r in responses}
+
+        results = []
+        for i in range(len(rpc_calls)):
+            response = responses_by_id.get(i, {'error': {'code': -343, 'message': 'missing JSON-RPC result'}})
+            if response.get('error') is not None:
+                e = JSONRPCException(response['error'])
+                if raise_errors:
+                    raise e
+                results.append(e)
+            else:
+                results.append(response.get('result'))
+        return results
+
+
+_clients = {}   # {(service_url, thread_id): BitcoindRpcClient}
+_clients_pid = None
+
+
+def get_client(service_url):
+    """
+    Пул соединений к bitcoind: одно keep-alive соединение на процесс/поток,
+    тк. AuthServiceProxy не thread-safe. После fork() соединения родителя не используются
+
+    :param service_url: url bitcoind RPC сервера, включая credentials
+    :return: BitcoindRpcClient
+    """
+    global _clients_pid
+
+    pid = os.getpid()
+    if pid != _clients_pid:
+        _clients.clear()
+        _clients_pid = pid
+
+    key = (service_url, threading.get_ident())
+    client = _clients.get(key)
+    if client is None:
+        client = BitcoindRpcClient(service_url, timeout=config.get('btcd_rpc_timeout', 30))
+        _clients[key] = client
+    return client
+
+
+def block_header(header):
+    return Header(header['height'], header['hash'], header.get('previousblockhash'), header['time'])
+
+
+class BtcHeaderCache(HeaderCache):
+    def __init__(self, service_url):
+        super(BtcHeaderCache, self).__init__()
+        self.service_url = service_url
+
+    def fetch_tip(self):
+        bitcoind = get_client(self.service_url)
+        tip_hash = bitcoind.getbestblockhash()
+        if self.tip_header is not None and self.tip_header.hash == tip_hash:
+            return self.tip_header
+        return block_header(bitcoind.getblockheader(tip_hash))
+
+    def fetch_network(self):
+        # forks keep the genesis block, but their transactions and blocks diverge from the fork point anyway
+        return get_client(self.service_url).getblockhash(0)
+
+    def fetch_headers(self, heights):
+        bitcoind = get_client(self.service_url)
+        hashes = bitcoind.batch_([['getblockhash', h] for h in heights])
+        return [block_header(h) for h in bitcoind.batch_([['getblockheader', h] for h in hashes])]
+
+
+def get_chain(service_url):
+    """
+    :param service_url: url bitcoind RPC сервера, включая credentials
+    :return: BtcHeaderCache - вершина чейна и заголовки последних блоков, см. transer.chain_cache.HeaderCache
+    """
+    return get_header_cache(('bitcoind', service_url), lambda: BtcHeaderCache(service_url))
@@ -2,25 +2,49 @@ from bitcoinrpc.authproxy import JSONRPCException
 
 from transer.btc import _btc_dispatcher
 from transer.db.btc import BitcoindInstance
-from transer.exceptions import BtcSendTransactionException
+from transer.exceptions import BtcSendTransactionException, BtcTransactionRejectedException
 
 from sqlalchemy.orm.exc import NoResultFound
 
 
+ALREADY_IN_CHAIN = -27    # bitcoind RPC_VERIFY_ALREADY_IN_CHAIN
+TRANSACTION_REJECTED = -26  # bitcoind RPC_VERIFY_REJECTED
+VERIFY_ERROR = -25  # bitcoind RPC_VERIFY_ERROR, e.g. missing or already spent inputs
+DESERIALIZATION_ERROR = -22     # bitcoind RPC_DESERIALIZATION_ERROR
+REJECTED_CODES = (TRANSACTION_REJECTED, VERIFY_ERROR, DESERIALIZATION_ERROR)
+ALREADY_KNOWN_REASONS = ('txn-already-in-mempool', 'txn-already-known')
+
+
+def is_already_sent(e):
+    """
+    :param e: JSONRPCException sendrawtransaction
+    :return: True, если транзакция уже в mempool-е или в чейне
+    """
+    if e.code == ALREADY_IN_CHAIN:
+        return True
+    return e.code == TRANSACTION_REJECTED and any(r in (e.message or '') for r in ALREADY_KNOWN_REASONS)
+
+
 def send_raw_transaction(bitcoind_inst, signed_trx_h):
     """
-    send_raw_transaction()
+    send_raw_transaction() - идемпотентная: уже отправленная транзакция (в mempool-е или в чейне)
+    считается успешно отправленной
 
     :param bitcoind_inst: instance of btc.BitcoindInstance
     :param signed_trx_h: signed raw transaction as hex:str
     :return: sent_txid -  txid отправленной транзакции
+    :raise BtcTransactionRejectedException: транзакция отвергнута и повторная отправка не поможет
     """
 
     bitcoind = bitcoind_inst.get_rpc_conn()
     try:
         txid = bitcoind.sendrawtransaction(signed_trx_h)
     except JSONRPCException as e:
+        if is_already_sent(e):
+            return bitcoind.decoderawtransaction(signed_trx_h)['txid']
         print(e)
+        if e.code in REJECTED_CODES:
+            raise BtcTransactionRejectedException(str(e)) from e
         raise BtcSendTransactionException(str(e))
 
     return txid
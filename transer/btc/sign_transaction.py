@@ -6,7 +6,7 @@ from transer.db.btc import BitcoindInstance
 from sqlalchemy.orm.exc import NoResultFound
 
 from transer import config
-from transer.utils import jsonrpc_caller
+from transer.utils import jsonrpc_caller, cpu_bound
 
 btc_signing_instance_uri = config['btc_signing_instance_uri']
 
@@ -44,6 +44,7 @@ def sign_raw_transaction(bitcoind_inst, signing_addrs, trx_h):
 
 
 @_btc_dispatcher.add_method
+@cpu_bound
 @jsonrpc_caller(target_uri=btc_signing_instance_uri, catchables=[BtcSignTransactionException])
 def sign_transaction(bt_name, signing_addrs, trx):
     """
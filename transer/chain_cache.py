@@ -0,0 +1,159 @@
+import os
+import time
+import threading
+from collections import namedtuple, OrderedDict
+
+from transer import config
+
+# the tip replaced not by its direct child may come from a fork anywhere this deep below it
+REORG_DEPTH = 64
+
+Header = namedtuple('Header', ['height', 'hash', 'prev_hash', 'timestamp'])
+
+
+class HeaderCache(object):
+    """
+    Вершина чейна и заголовки последних блоков одного узла, общие для всех мониторов процесса.
+    Вершина перечитывается не чаще раза в config['chain_tip_ttl'] секунд, заголовки хранятся в LRU
+    на config['chain_header_cache_size'] блоков. При смене вершины не на её потомка заголовки
+    последних REORG_DEPTH высот сбрасываются по hash-у
+
+    Наследники реализуют fetch_tip(), fetch_headers() и fetch_network()
+    """
+
+    def __init__(self):
+        self.size = config.get('chain_header_cache_size', 1024)
+        self.ttl = config.get('chain_tip_ttl', 2.0)
+
+        self.headers = OrderedDict()    # {hash: Header}, least recently used first
+        self.main_chain = {}            # {height: hash} as of the current tip
+        self.tip_header = None
+        self.tip_read_at = None
+        self.network_id = None
+        self.lock = threading.Lock()
+
+    def fetch_tip(self):
+        """
+        :return: Header вершины чейна
+        """
+        raise NotImplementedError
+
+    def fetch_headers(self, heights):
+        """
+        :return: [Header, ...] блоков основной цепочки в порядке heights
+        """
+        raise NotImplementedError
+
+    def fetch_network(self):
+        """
+        :return: str идентификатор сети узла
+        """
+        raise NotImplementedError
+
+    def network(self):
+        """
+        Идентификатор сети узла, которым разделяются данные разных сетей в transer.chain_store
+
+        :return: str
+        """
+        with self.lock:
+            if self.network_id is None:
+                self.network_id = self.fetch_network()
+            return self.network_id
+
+    def add(self, header):
+        self.headers[header.hash] = header
+        self.headers.move_to_end(header.hash)
+        self.main_chain[header.height] = header.hash
+
+        while len(self.headers) > self.size:
+            _, evicted = self.headers.popitem(last=False)
+            if self.main_chain.get(evicted.height) == evicted.hash:
+                del self.main_chain[evicted.height]
+
+    def invalidate(self, above_height):
+        for height in [h for h in self.main_chain if h > above_height]:
+            self.headers.pop(self.main_chain.pop(height), None)
+
+    def tip(self):
+        """
+        :return: Header вершины чейна, не старше config['chain_tip_ttl'] секунд
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.tip_header is not None and now - self.tip_read_at < self.ttl:
+                return self.tip_header
+
+            tip = self.fetch_tip()
+            old_tip = self.tip_header
+            if old_tip is not None and tip.hash != old_tip.hash:
+                if tip.prev_hash == old_tip.hash:
+                    self.invalidate(tip.height - 1)     # nothing above the old tip is known anyway
+                else:
+                    self.invalidate(min(old_tip.height, tip.height) - REORG_DEPTH)
+
+            self.add(tip)
+            self.tip_header = tip
+            self.tip_read_at = now
+            return tip
+
+    def headers_at(self, heights):
+        """
+        Заголовки блоков основной цепочки; отсутствующие в кэше запрашиваются у узла одним пакетом
+
+        :param heights: высоты блоков
+        :return: {height: Header}
+        """
+        self.tip()    # drops the headers possibly orphaned since the last tip read
+
+        with self.lock:
+            found = {}
+            for height in set(heights):
+                block_hash = self.main_chain.get(height)
+                if block_hash is not None:
+                    found[height] = self.headers[block_hash]
+                    self.headers.move_to_end(block_hash)
+
+        missing = sorted(set(heights) - set(found))
+        if missing:
+            fetched = self.fetch_headers(missing)
+            with self.lock:
+                for header in fetched:
+                    self.add(header)
+                    found[header.height] = header
+        return found
+
+    def in_main_chain(self, block_hash):
+        """
+        :return: True, если блок известен как принадлежащий основной цепочке; False - неизвестно
+        """
+        self.tip()
+
+        with self.lock:
+            header = self.headers.get(block_hash)
+            return header is not None and self.main_chain.get(header.height) == block_hash
+
+
+_caches = {}    # {key: HeaderCache}
+_caches_pid = None
+
+
+def get_header_cache(key, factory):
+    """
+    Кэш заголовков текущего процесса для узла key; после fork() кэш родителя не используется
+
+    :param key: например, url узла
+    :param factory: () -> HeaderCache, вызывается при первом обращении
+    :return: HeaderCache
+    """
+    global _caches_pid
+
+    pid = os.getpid()
+    if pid != _caches_pid:
+        _caches.clear()
+        _caches_pid = pid
+
+    cache = _caches.get(key)
+    if cache is None:
+        cache = _caches.setdefault(key, factory())
+    return cache
@@ -0,0 +1,131 @@
+import asyncio
+import json
+import logging
+
+import aiohttp
+
+from transer.exceptions import DaemonConfigException
+
+logger = logging.getLogger('chain_events')
+
+RECONNECT_DELAY = 5     # seconds, doubled on every unsuccessful attempt up to RECONNECT_DELAY_MAX
+RECONNECT_DELAY_MAX = 120
+
+
+def notify(wakeups):
+    for w in wakeups:
+        w.set()
+
+
+def import_zmq():
+    try:
+        import zmq
+        import zmq.asyncio
+    except ImportError as e:
+        raise DaemonConfigException('pyzmq is required to subscribe to bitcoind notifications') from e
+    return zmq
+
+
+async def listen_bitcoind_blocks(zmq_uri, wakeups, *, loop):
+    """
+    Подписка на bitcoind -zmqpubhashblock: каждый новый блок будит задачи из wakeups.
+    Переподключение к publisher-у zmq делает сам, при ошибках сокет пересоздаётся
+
+    :param zmq_uri: адрес zmq publisher-а bitcoind, например tcp://127.0.0.1:28332
+    :param wakeups: [asyncio.Event, ...] задач, которые нужно разбудить
+    """
+    zmq = import_zmq()
+    delay = RECONNECT_DELAY
+
+    context = zmq.asyncio.Context()
+    try:
+        while True:
+            socket = context.socket(zmq.SUB)
+            try:
+                socket.setsockopt(zmq.SUBSCRIBE, b'hashblock')
+                socket.connect(zmq_uri)
+                while True:
+                    topic, body, *_ = await socket.recv_multipart()
+                    if topic == b'hashblock':
+                        logger.debug(f'bitcoind block {body.hex()} notification received')
+                        notify(wakeups)
+                        delay = RECONNECT_DELAY
+            except (zmq.ZMQError, ValueError) as e:
+                logger.error(f'bitcoind zmq {zmq_uri} failed: {e}')
+            finally:
+                socket.close(linger=0)
+
+            # missed blocks are caught up by fallback polling
+            await asyncio.sleep(delay, loop=loop)
+            delay = min(delay * 2, RECONNECT_DELAY_MAX)
+    finally:
+        context.term()
+
+
+async def listen_geth_heads(ws_uri, wakeups, *, loop):
+    """
+    Подписка eth_subscribe('newHeads') по websocket: каждый новый блок будит задачи из wakeups
+
+    :param ws_uri: websocket url geth, например ws://127.0.0.1:8546
+    :param wakeups: [asyncio.Event, ...] задач, которые нужно разбудить
+    """
+    delay = RECONNECT_DELAY
+    subscribe_request = {'jsonrpc': '2.0', 'id': 1, 'method': 'eth_subscribe', 'params': ['newHeads']}
+
+    while True:
+        try:
+            async with aiohttp.ClientSession(loop=loop) as session:
+                async with session.ws_connect(ws_uri, heartbeat=30) as ws:
+                    await ws.send_json(subscribe_request)
+                    async for msg in ws:
+                        if msg.type != aiohttp.WSMsgType.TEXT:
+                            break
+
+                        data = json.loads(msg.data)
+                        if data.get('method') == 'eth_subscription':
+                            head = data['params']['result']
+                            logger.debug(f'geth block {head.get("number")} notification received')
+                            notify(wakeups)
+                            delay = RECONNECT_DELAY
+                        elif data.get('error') is not None:
+                            logger.error(f'geth eth_subscribe failed: {data["error"]}')
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.error(f'geth websocket {ws_uri} failed: {e}')
+
+        # missed blocks are caught up by fallback polling
+        await asyncio.sleep(delay, loop=loop)
+        delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+
+def log_listener_exit(task):
+    if task.cancelled():
+        return
+    e = task.exception()
+    if e is not None:
+        logger.error('block listener stopped, chain monitors fall back to polling', exc_info=e)
+
+
+def create_block_listeners(loop, btcd_zmq_uri=None, ethd_ws_uri=None):
+    """
+    :return: (btc_wakeups, eth_wakeups) - фабрики asyncio.Event для задач, которые нужно будить на новых блоках;
+        None вместо фабрики, если соответствующая подписка не сконфигурирована
+    :raise DaemonConfigException: для подписки на bitcoind не установлен pyzmq
+    """
+    if btcd_zmq_uri is not None:
+        import_zmq()    # fail on startup, not in the listener task
+
+    def wakeup_factory(uri, listener):
+        if uri is None:
+            return None
+
+        wakeups = []
+        task = loop.create_task(listener(uri, wakeups, loop=loop))
+        task.add_done_callback(log_listener_exit)
+
+        def wakeup():
+            event = asyncio.Event(loop=loop)
+            wakeups.append(event)
+            return event
+        return wakeup
+
+    return wakeup_factory(btcd_zmq_uri, listen_bitcoind_blocks), wakeup_factory(ethd_ws_uri, listen_geth_heads)
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import zlib
+import decimal
+import sqlite3
+import threading
+from collections.abc import Mapping
+
+from transer import config
+
+EVICTION_CHUNK = 100    # records deleted per statement while shrinking the store
+EVICTION_TARGET = 0.9   # the store is shrunk to this fraction of its size cap
+MAX_KEYS = 500          # keys per SELECT, below the SQLite host parameters limit
+FORMAT_VERSION = 2      # PRAGMA user_version; stores written in another format are recreated
+TOUCH_GRANULARITY = 600     # seconds, records read more recently are not updated by reads again
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_used_at ON records (used_at);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (name, value) VALUES ('bytes', 0);
+CREATE TRIGGER IF NOT EXISTS records_insert AFTER INSERT ON records BEGIN
+    UPDATE meta SET value = value + NEW.size WHERE name = 'bytes';
+END;
+CREATE TRIGGER IF NOT EXISTS records_delete AFTER DELETE ON records BEGIN
+    UPDATE meta SET value = value - OLD.size WHERE name = 'bytes';
+END;
+'''
+
+
+class ChainDataEncoder(json.JSONEncoder):
+    """
+    Decimal сохраняется без потери точности, bytes (HexBytes) - как hex строка
+    """
+
+    def default(self, o):
+        if isinstance(o, decimal.Decimal):
+            return {'$decimal': str(o)}
+        elif isinstance(o, bytes):
+            return '0x' + o.hex()
+        elif isinstance(o, Mapping):    # web3 AttributeDict
+            return dict(o)
+        return super(ChainDataEncoder, self).default(o)
+
+
+def decode_object(obj):
+    if len(obj) == 1 and '$decimal' in obj:
+        return decimal.Decimal(obj['$decimal'])
+    return obj
+
+
+def encode(value):
+    return zlib.compress(json.dumps(value, cls=ChainDataEncoder, separators=(',', ':')).encode('utf8'))
+
+
+def decode(data):
+    return json.loads(zlib.decompress(data).decode('utf8'), object_hook=decode_object)
+
+
+class ChainStore(object):
+    """
+    Локальный SQLite кэш неизменяемых данных чейна (транзакций и блоков за горизонтом реорганизаций),
+    общий для всех процессов демона. Размер ограничен max_bytes, при переполнении вытесняются
+    давно не читавшиеся записи (LRU, время чтения обновляется не чаще раза в TOUCH_GRANULARITY секунд).
+    Данные разных сетей разделены namespace-ами, см. HeaderCache.network()
+    """
+
+    def __init__(self, path, max_bytes):
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')     # readers don't wait for writers
+
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            if self.conn.execute('PRAGMA user_version').fetchone()[0] != FORMAT_VERSION:
+                self.conn.execute('DROP TABLE IF EXISTS records')
+                self.conn.execute('DROP TABLE IF EXISTS meta')
+                self.conn.execute(f'PRAGMA user_version = {FORMAT_VERSION}')
+        self.conn.executescript(SCHEMA)
+
+    def get_many(self, namespace, keys):
+        """
+        :param namespace: вид записей и сеть, например btc_tx:<genesis hash>
+        :param keys: hash-и или номера блоков
+        :return: {key: value} найденных записей
+        """
+        db_keys = {f'{namespace}:{k}': k for k in keys}
+        lookup_keys = list(db_keys)
+
+        now = time.time()
+        found = {}
+        touched = []
+        for i in range(0, len(lookup_keys), MAX_KEYS):
+            chunk = lookup_keys[i:i + MAX_KEYS]
+            rows = self.conn.execute(
+                f'SELECT key, value, used_at FROM records WHERE key IN ({",".join("?" * len(chunk))})', chunk
+            ).fetchall()
+            found.update((db_keys[key], decode(value)) for key, value, _ in rows)
+            # reads stay read-only unless the LRU position is noticeably stale
+            touched.extend(key for key, _, used_at in rows if now - used_at > TOUCH_GRANULARITY)
+
+        for i in range(0, len(touched), MAX_KEYS):
+            chunk = touched[i:i + MAX_KEYS]
+            self.conn.execute(
+                f'UPDATE records SET used_at = ? WHERE key IN ({",".join("?" * len(chunk))})', [now] + chunk
+            )
+        return found
+
+    def put_many(self, namespace, records):
+        """
+        Запись неизменяемых данных; уже сохранённые ключи не перезаписываются
+
+        :param records: {key: value}
+        """
+        if len(records) == 0:
+            return
+
+        now = time.time()
+        rows = []
+        for key, value in records.items():
+            data = encode(value)
+            rows.append((f'{namespace}:{key}', data, len(data), now))
+
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany('INSERT OR IGNORE INTO records (key, value, size, used_at) VALUES (?, ?, ?, ?)', rows)
+        self.evict()
+
+    def size(self):
+        return self.conn.execute('SELECT value FROM meta WHERE name = \'bytes\'').fetchone()[0]
+
+    def evict(self):
+        if self.size() <= self.max_bytes:
+            return
+
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            while self.size() > self.max_bytes * EVICTION_TARGET:
+                deleted = self.conn.execute(
+                    'DELETE FROM records WHERE key IN (SELECT key FROM records ORDER BY used_at LIMIT ?)',
+                    (EVICTION_CHUNK,)
+                )
+                if deleted.rowcount == 0:
+                    break
+
+
+_stores = {}    # {thread_id: ChainStore}
+_stores_pid = None
+
+
+def get_chain_store():
+    """
+    Соединение к config['chain_store_path'] текущего процесса/потока, тк. соединения sqlite3 не thread-safe
+
+    :return: ChainStore или None, если кэш не сконфигурирован
+    """
+    global _stores_pid
+
+    path = config.get('chain_store_path')
+    if path is None:
+        return None
+
+    pid = os.getpid()
+    if pid != _stores_pid:
+        _stores.clear()
+        _stores_pid = pid
+
+    store = _stores.get(threading.get_ident())
+    if store is None:
+        store = ChainStore(path, max_bytes=config.get('chain_store_max_mb', 512) * 1024 * 1024)
+        _stores[threading.get_ident()] = store
+    return store
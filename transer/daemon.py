@@ -5,12 +5,14 @@ import logging
 import pprint
 from aiohttp import web
 
-from transer.utils import handler_fabric, endpoint_fabric, init_db, init_logging, create_delayed_scheduler
+from transer.utils import handler_fabric, endpoint_fabric, init_db, init_logging
 from transer.utils import dump_db_ddl, recreate_entire_database
 from transer.exceptions import DaemonConfigException
+from transer.chain_events import create_block_listeners
+from transer.scheduler import create_delayed_scheduler
 from transer.btc import init_btc
 from transer.eth import init_eth
-from transer import config
+from transer import config, metrics
 
 
 def run(db_uri, listen_host, listen_port, workers, signing_mode,
@@ -19,7 +21,15 @@ def run(db_uri, listen_host, listen_port, workers, signing_mode,
         btcd_instance_uri, ethd_instance_uri,
         btc_signing_instance_uri, eth_signing_instance_uri,
         deposit_notification_endpoint, withdraw_notification_endpoint,
-        sentry_dsn, app_release, sentry_environment):
+        sentry_dsn, app_release, sentry_environment,
+        native_dispatch=True,
+        signer_connect_timeout=5.0, signer_read_timeout=120.0, signer_pool_maxsize=10,
+        btcd_rpc_timeout=30, ethd_rpc_timeout=10, ethd_pool_maxsize=10,
+        ethd_batch_size=100, ethd_max_inflight=4, ethd_scan_window=500,
+        chain_tip_ttl=2.0, chain_header_cache_size=1024, chain_store_path=None, chain_store_max_mb=512,
+        btc_batch_interval=None, btc_batch_size=100,
+        btcd_zmq_uri=None, ethd_ws_uri=None, fallback_interval=300,
+        profile_dir=None, profile_sample_rate=0.01, profile_threshold=5.0):
 
     config['eth_masterkey_name'] = eth_masterkey_name
     config['btc_masterkey_name'] = btc_masterkey_name
@@ -30,13 +40,33 @@ def run(db_uri, listen_host, listen_port, workers, signing_mode,
     config['ethd_instance_uri'] = ethd_instance_uri
     config['btcd_instance_uri'] = btcd_instance_uri
     config['btcd_instance_name'] = 'fake_instance'
+    config['btcd_rpc_timeout'] = btcd_rpc_timeout
+    config['ethd_rpc_timeout'] = ethd_rpc_timeout
+    config['ethd_pool_maxsize'] = ethd_pool_maxsize
+    config['ethd_batch_size'] = ethd_batch_size
+    config['ethd_max_inflight'] = ethd_max_inflight
+    config['ethd_scan_window'] = ethd_scan_window
+    config['chain_tip_ttl'] = chain_tip_ttl
+    config['chain_header_cache_size'] = chain_header_cache_size
+    config['chain_store_path'] = chain_store_path
+    config['chain_store_max_mb'] = chain_store_max_mb
+    config['btc_batch_interval'] = btc_batch_interval
+    config['btc_batch_size'] = btc_batch_size
 
     config['eth_signing_instance_uri'] = eth_signing_instance_uri
     config['btc_signing_instance_uri'] = btc_signing_instance_uri
 
+    config['signer_connect_timeout'] = signer_connect_timeout
+    config['signer_read_timeout'] = signer_read_timeout
+    config['signer_pool_maxsize'] = signer_pool_maxsize
+
     config['deposit_notification_endpoint'] = deposit_notification_endpoint
     config['withdraw_notification_endpoint'] = withdraw_notification_endpoint
 
+    config['profile_dir'] = profile_dir
+    config['profile_sample_rate'] = profile_sample_rate
+    config['profile_threshold'] = profile_threshold
+
     config['sentry_dsn'] = sentry_dsn
     config['app_release'] = app_release
     config['sentry_environment'] = sentry_environment
@@ -49,7 +79,7 @@ def run(db_uri, listen_host, listen_port, workers, signing_mode,
     from transer import outerface
 
     async_loop = asyncio.get_event_loop()
-    app = web.Application()
+    app = web.Application(middlewares=[metrics.metrics_middleware])
 
     init_db(db_uri)
 
@@ -76,8 +106,16 @@ def run(db_uri, listen_host, listen_port, workers, signing_mode,
     # We need 'ThreadPoolExecutor' because 'multiprocessing' cannot pickle sockets
     thread_executor = futures.ThreadPoolExecutor(max_workers=workers)
 
-    app.router.add_post('/btc', handler_fabric(process_executor, btc_dispatcher))
-    app.router.add_post('/eth', handler_fabric(process_executor, eth_dispatcher))
+    # I/O-bound JSON-RPC methods are served by threads, only @cpu_bound ones go to 'process_executor'
+    jsonrpc_thread_executor = futures.ThreadPoolExecutor(max_workers=workers) if native_dispatch else None
+
+    metrics.register_executor(process_executor, 'process', workers)
+    metrics.register_executor(thread_executor, 'thread', workers)
+    if jsonrpc_thread_executor is not None:
+        metrics.register_executor(jsonrpc_thread_executor, 'jsonrpc_thread', workers)
+
+    app.router.add_post('/btc', handler_fabric(process_executor, btc_dispatcher, jsonrpc_thread_executor))
+    app.router.add_post('/eth', handler_fabric(process_executor, eth_dispatcher, jsonrpc_thread_executor))
 
     app.router.add_post(
         '/claim-wallet-addr/{currency}',
@@ -100,38 +138,104 @@ def run(db_uri, listen_host, listen_port, workers, signing_mode,
         endpoint_fabric(thread_executor, outerface.withdrawal_status_endpoint)
     )
 
+    # metrics live in the main process memory, so they are rendered by 'thread_executor'
+    app.router.add_get('/metrics', endpoint_fabric(thread_executor, metrics.metrics_endpoint))
+
     delayed_scheduler = create_delayed_scheduler(loop=async_loop, executor=process_executor)
 
     # suppress all the outgoing connections/notification clients in 'signing node' mode
     if not signing_mode:
+        # with block notifications configured, chain monitors are woken up by new blocks
+        # and polling every 'fallback_interval' seconds only catches up missed notifications
+        btc_wakeup, eth_wakeup = create_block_listeners(
+            loop=async_loop,
+            btcd_zmq_uri=btcd_zmq_uri,
+            ethd_ws_uri=ethd_ws_uri
+        )
+        btc_interval = 50 if btc_wakeup is None else fallback_interval
+        eth_interval = 50 if eth_wakeup is None else fallback_interval
+
+        # chain monitors run only when the chain tip has moved and poll it faster while there is a backlog;
+        # notification senders retry faster while there are unacknowledged notifications
         btc_deposit_monitor_task = delayed_scheduler(
             deposit.periodic_check_deposit_btc,
-            interval=50
+            interval=btc_interval,
+            wakeup=btc_wakeup() if btc_wakeup else None,
+            jitter=0.1,
+            deadline=600,
+            min_interval=btc_interval / 5,
+            max_interval=btc_interval * 2,
+            tip_probe=deposit.chain_tip_btc,
+            backlog_probe=deposit.backlog_deposit_btc
         )
 
         eth_deposit_monitor_task = delayed_scheduler(
             deposit.periodic_check_deposit_eth,
-            interval=50
+            interval=eth_interval,
+            wakeup=eth_wakeup() if eth_wakeup else None,
+            jitter=0.1,
+            deadline=600,
+            min_interval=eth_interval / 5,
+            max_interval=eth_interval * 2,
+            tip_probe=deposit.chain_tip_eth,
+            backlog_probe=deposit.backlog_deposit_eth
         )
 
         deposit_send_task = delayed_scheduler(
             outerface.periodic_send_deposit,
-            interval=50
+            interval=50,
+            jitter=0.1,
+            deadline=300,
+            min_interval=10,
+            max_interval=100,
+            backlog_probe=outerface.backlog_send_deposit
         )
 
         btc_withdraw_monitor_task = delayed_scheduler(
             withdraw.periodic_check_withdraw_btc,
-            interval=50
+            interval=btc_interval,
+            wakeup=btc_wakeup() if btc_wakeup else None,
+            jitter=0.1,
+            deadline=300,
+            min_interval=btc_interval / 5,
+            max_interval=btc_interval * 2,
+            tip_probe=deposit.chain_tip_btc,
+            backlog_probe=withdraw.backlog_withdraw_btc
         )
 
         eth_withdraw_monitor_task = delayed_scheduler(
             withdraw.periodic_check_withdraw_eth,
-            interval=50
+            interval=eth_interval,
+            wakeup=eth_wakeup() if eth_wakeup else None,
+            jitter=0.1,
+            deadline=300,
+            min_interval=eth_interval / 5,
+            max_interval=eth_interval * 2,
+            tip_probe=deposit.chain_tip_eth,
+            backlog_probe=withdraw.backlog_withdraw_eth
         )
 
+        # queued BTC withdrawals are checked every tenth of 'btc_batch_interval' while there are any,
+        # so a full batch of 'btc_batch_size' is sent without waiting for the whole interval
+        if btc_batch_interval is not None:
+            delayed_scheduler(
+                withdraw.periodic_flush_withdraw_btc,
+                interval=btc_batch_interval,
+                jitter=0.1,
+                deadline=300,
+                min_interval=btc_batch_interval / 10,
+                max_interval=btc_batch_interval,
+                backlog_probe=withdraw.backlog_flush_withdraw_btc
+            )
+
         withdraw_send_task = delayed_scheduler(
             outerface.periodic_send_withdraw,
-            interval=50
+            interval=50,
+            jitter=0.1,
+            deadline=300,
+            min_interval=10,
+            max_interval=100,
+            backlog_probe=outerface.backlog_send_withdraw
         )
 
     web.run_app(app, host=listen_host, port=listen_port, loop=async_loop)
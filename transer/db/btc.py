@@ -4,10 +4,11 @@ import functools
 import logging
 import decimal
 
-from bitcoinrpc.authproxy import AuthServiceProxy
 from pycoin.key.BIP32Node import BIP32Node
-from sqlalchemy import Column, Integer, String, Unicode, Boolean, DateTime, ForeignKey, UniqueConstraint, Numeric, desc
+from sqlalchemy import Column, Integer, String, Unicode, Text, Boolean, DateTime, ForeignKey, UniqueConstraint, Numeric
+from sqlalchemy import desc
 from sqlalchemy.orm import relationship
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.sql import functions
 
 from Crypto.Cipher import AES
@@ -16,6 +17,7 @@ from Crypto.Hash import SHA256
 from transer import config
 from transer.exceptions import BtcAddressIntegrityException, BtcAddressCreationException
 from transer.ethereum_utils.utils import bytes_to_str, hex_str_to_bytes
+from transer.btc import rpc_client
 from . import Base, sqla_session
 
 logger = logging.getLogger('db')
@@ -97,9 +99,9 @@ class BitcoindInstance(Base):
             pass
         return config['btcd_instance_uri']
 
-    # тут обойдемся без singleton, тк. multiprocess/futures будет сделать непросто
+    # keep-alive соединения живут в пуле, отдельном для каждого процесса/потока, см. transer.btc.rpc_client
     def get_rpc_conn(self):
-        return AuthServiceProxy(self.get_url())
+        return rpc_client.get_client(self.get_url())
 
 
 class DepositsLog(Base):
@@ -118,6 +120,38 @@ class DepositsLog(Base):
     timestamp = Column(DateTime(timezone=True), default=functions.now(), index=True)
 
 
+class DepositCursor(Base):
+    """
+    Позиция сканера входящих транзакций, одна запись на (bitcoind, количество конфирмаций).
+    Хранит последний обработанный блок и несколько предыдущих позиций, чтобы при реорганизации чейна
+    откатиться только до последней позиции, оставшейся в основной цепочке
+    """
+    __tablename__ = 'deposit_cursors'
+
+    __table_args__ = (
+        UniqueConstraint('bitcoind_inst_ref', 'confirmations_applied'),
+        {'schema': schema_prefix + 'public'}
+    )
+
+    bitcoind_inst_ref = Column(ForeignKey(BitcoindInstance.id), nullable=False)
+    bitcoind_inst = relationship(BitcoindInstance, lazy='select')
+
+    confirmations_applied = Column(Integer, nullable=False)
+    block_hash = Column(String(64), nullable=False)
+    ancestor_hashes = Column(ARRAY(String(64)), default=[])     # previous cursor positions, newest first
+    timestamp = Column(DateTime(timezone=True), default=functions.now(), onupdate=functions.now())
+
+    def advance(self, block_hash, depth):
+        """
+        :param block_hash: новый последний обработанный блок
+        :param depth: сколько предыдущих позиций хранить для отката при реорганизации
+        """
+        if block_hash == self.block_hash:
+            return
+        self.ancestor_hashes = ([self.block_hash] + list(self.ancestor_hashes or []))[:depth]
+        self.block_hash = block_hash
+
+
 class ChangeTransactionLog(Base):
     """
     Хранилка всех change адресов и транзакций; при переводе крипты почти всегда есть 2 destination addresses:
@@ -137,6 +171,46 @@ class ChangeTransactionLog(Base):
     change_tx_id = Column(String(64), index=True, unique=True)
 
 
+class OutgoingTransaction(Base):
+    """
+    Подписанные транзакции выплат. Записываются до отправки в сеть, чтобы после падения или ошибки
+    отправки транзакцию можно было отправить повторно, а не оплатить выплаты ещё раз из других UTXO
+    """
+
+    __tablename__ = 'outgoing_transactions'
+
+    __table_args__ = {
+        'schema': schema_prefix + 'public'
+    }
+
+    txid = Column(String(64), index=True, unique=True)
+    signed_trx = Column(Text, nullable=False)
+    is_sent = Column(Boolean, default=False, index=True)
+    is_rejected = Column(Boolean, default=False, index=True)    # terminal, bitcoind won't ever accept it
+    timestamp = Column(DateTime(timezone=True), default=functions.now(), index=True)
+
+
+class OutgoingTransactionInput(Base):
+    """
+    UTXO, потраченные транзакцией выплат. Пока транзакция не отправлена, bitcoind их не считает потраченными,
+    поэтому они исключаются из выбора входов следующих выплат
+    """
+
+    __tablename__ = 'outgoing_transaction_inputs'
+
+    __table_args__ = {
+        'schema': schema_prefix + 'public'
+    }
+
+    outgoing_ref = Column(ForeignKey(OutgoingTransaction.id), index=True, nullable=False)
+    outgoing = relationship(OutgoingTransaction, lazy='select')
+
+    utxo_txid = Column(String(64), nullable=False)
+    utxo_vout = Column(Integer, nullable=False)
+    address = Column(String(64), nullable=False)
+    amount = Column(Numeric(precision=32, scale=24, asdecimal=True), nullable=False)
+
+
 class Address(Base):
     __tablename__ = 'addresses'
 
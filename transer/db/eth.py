@@ -229,3 +229,17 @@ class DepositsLog(Base):
     block_num = Column(Integer, index=True)
     block_hash = Column(String(66), unique=True)
     block_timestamp = Column(DateTime(timezone=True), index=True)
+
+
+class BlockTimestamp(Base):
+    """
+    Разреженный индекс номер блока -> timestamp для поиска блока по времени,
+    см. transer.eth.block_index.block_for_timestamp()
+    """
+    __tablename__ = 'block_timestamps'
+
+    __table_args__ = {
+        'schema': schema_prefix + 'public'
+    }
+    block_num = Column(Integer, unique=True)
+    block_timestamp = Column(Integer, index=True)   # unix time
@@ -1,7 +1,7 @@
 import logging
 import decimal
 
-from sqlalchemy import Column, String, DateTime, Numeric, Boolean
+from sqlalchemy import Column, String, Integer, DateTime, Numeric, Boolean
 from sqlalchemy.sql import functions
 from sqlalchemy.dialects.postgresql import UUID, ARRAY, ENUM
 
@@ -27,6 +27,9 @@ class CryptoWithdrawTransaction(Base):
     address = Column(String, index=True)
     txids = Column(ARRAY(String), default=[])
     completed_txids = Column(ARRAY(String), default=[])
+    # blocks the pending txids were mined in, element-wise with txids; None for not yet mined ones
+    block_nums = Column(ARRAY(Integer), default=[])
+    block_hashes = Column(ARRAY(String), default=[])
     amount = Column(Numeric(precision=32, scale=24, asdecimal=True), default=decimal.Decimal(0.0))
     status = Column(ENUM(*[x.value for x in types.WithdrawalStatus],
                          name='crypto_withdraw_transaction_status'),
@@ -46,6 +49,8 @@ class CryptoDepositTransaction(Base):
     currency = Column(ENUM(*[x.value for x in types.CryptoCurrency], name='currency'), index=True)
     address = Column(String, index=True)
     txid = Column(String, index=True)
+    block_num = Column(Integer)     # the block the transaction was mined in, if known
+    block_hash = Column(String)
     amount = Column(Numeric(precision=32, scale=24, asdecimal=True), default=decimal.Decimal(0.0))
     status = Column(ENUM(*[x.value for x in types.DepositStatus],
                          name='crypto_deposit_transaction_status'),
@@ -0,0 +1,74 @@
+import os
+import time
+
+from transer.db import eth, sqla_session
+
+# ids are taken from a sequence, so a transaction committed later may bring a smaller id;
+# the rows just below the last seen id are re-read on every refresh to pick them up
+ID_LOOKBACK = 1000
+
+# transer never deletes addresses, but the ones removed from the table by hand are dropped on the next full reload
+RELOAD_INTERVAL = 3600  # seconds
+
+
+def address_key(address):
+    """
+    :param address: '0x' + 40 hex digits, в любом регистре
+    :return: 20-байтовый ключ адреса
+    """
+    return bytes.fromhex(address[2:])
+
+
+class AddressIndex(object):
+    """
+    Множество адресов кошелька в памяти процесса: дочитывается по id > last_id,
+    целиком перезагружается раз в RELOAD_INTERVAL секунд
+    """
+
+    def __init__(self):
+        self.keys = set()
+        self.last_id = 0
+        self.loaded_at = None
+
+    def refresh(self):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at >= RELOAD_INTERVAL:
+            keys, last_id = set(), 0
+            self.loaded_at = time.monotonic()
+        else:
+            keys, last_id = self.keys, self.last_id
+
+        new_addresses_q = sqla_session.query(eth.Address.id, eth.Address.address)\
+            .filter(eth.Address.id > last_id - ID_LOOKBACK)\
+            .order_by(eth.Address.id)
+
+        for address_id, address in new_addresses_q.yield_per(10000):
+            keys.add(address_key(address))
+            last_id = max(last_id, address_id)
+
+        # the reloaded set replaces the old one only when complete
+        self.keys, self.last_id = keys, last_id
+
+    def __contains__(self, address):
+        return address_key(address) in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+
+_index = None
+_index_pid = None
+
+
+def get_address_index():
+    """
+    :return: AddressIndex текущего процесса, дочитанный до последнего адреса
+    """
+    global _index, _index_pid
+
+    pid = os.getpid()
+    if pid != _index_pid:
+        _index = AddressIndex()
+        _index_pid = pid
+
+    _index.refresh()
+    return _index
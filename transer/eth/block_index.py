@@ -0,0 +1,96 @@
+from sqlalchemy import desc, asc
+from sqlalchemy.dialects.postgresql import insert
+
+from transer.db import eth, sqla_session
+from transer.eth.rpc_client import get_chain
+
+SCAN_SAMPLE_STEP = 1000     # every n-th scanned block goes to the index
+
+
+def record_block_timestamps(blocks):
+    """
+    Пополнение индекса номер блока -> timestamp; коммит на вызывающей стороне
+
+    :param blocks: [(block_num, timestamp), ...]
+    """
+    if len(blocks) == 0:
+        return
+
+    index_table = eth.BlockTimestamp.__table__
+    rows = [
+        {'id': index_table.c.id.default.next_value(), 'block_num': n, 'block_timestamp': ts}
+        for n, ts in dict(blocks).items()
+    ]
+    insert_q = insert(index_table)\
+        .values(rows)\
+        .on_conflict_do_nothing(index_elements=[index_table.c.block_num])
+    sqla_session.execute(insert_q)
+
+
+def record_scanned_blocks(blocks):
+    """
+    Индекс пополняется как побочный эффект сканирования: каждый SCAN_SAMPLE_STEP-й и последний блок
+    """
+    sampled = [b for b in blocks if b['number'] % SCAN_SAMPLE_STEP == 0] + blocks[-1:]
+    record_block_timestamps([(b['number'], b['timestamp']) for b in sampled])
+
+
+def nearest_indexed_blocks(timestamp):
+    """
+    :return: ((block_num, timestamp) или None, (block_num, timestamp) или None) - ближайшие известные блоки
+        с timestamp <= заданного и > заданного
+    """
+    lower = sqla_session.query(eth.BlockTimestamp.block_num, eth.BlockTimestamp.block_timestamp)\
+        .filter(eth.BlockTimestamp.block_timestamp <= timestamp)\
+        .order_by(desc(eth.BlockTimestamp.block_timestamp))\
+        .first()
+    upper = sqla_session.query(eth.BlockTimestamp.block_num, eth.BlockTimestamp.block_timestamp)\
+        .filter(eth.BlockTimestamp.block_timestamp > timestamp)\
+        .order_by(asc(eth.BlockTimestamp.block_timestamp))\
+        .first()
+    return (tuple(lower) if lower else None), (tuple(upper) if upper else None)
+
+
+def block_for_timestamp(web3_url, timestamp):
+    """
+    Первый блок с timestamp больше заданного: интерполяционный поиск между ближайшими известными
+    по индексу блоками, с чередованием шагов деления пополам, чтобы неравномерное время блоков
+    не вырождало поиск. Все полученные по RPC блоки попадают в индекс; коммит на вызывающей стороне
+
+    :param web3_url: web3 RPC url as str
+    :param timestamp: unix time
+    :return: номер блока
+    """
+    chain = get_chain(web3_url)
+    fetched = []
+
+    def fetch(header):
+        fetched.append((header.height, header.timestamp))
+        return header.height, header.timestamp
+
+    lower, upper = nearest_indexed_blocks(timestamp)
+    if lower is None:
+        lower = fetch(chain.headers_at([0])[0])
+    if upper is None:
+        upper = fetch(chain.tip())
+        if upper[1] <= timestamp:   # no block after the timestamp yet
+            record_block_timestamps(fetched)
+            return upper[0]
+
+    bisect = False
+    while upper[0] - lower[0] > 1:
+        if bisect or upper[1] == lower[1]:
+            guess = (lower[0] + upper[0]) // 2
+        else:
+            guess = lower[0] + (timestamp - lower[1]) * (upper[0] - lower[0]) // (upper[1] - lower[1])
+        guess = min(max(guess, lower[0] + 1), upper[0] - 1)
+        bisect = not bisect
+
+        block = fetch(chain.headers_at([guess])[guess])
+        if block[1] <= timestamp:
+            lower = block
+        else:
+            upper = block
+
+    record_block_timestamps(fetched)
+    return upper[0]
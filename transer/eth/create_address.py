@@ -3,7 +3,7 @@ from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 from transer.exceptions import EthAddressIntegrityException
 from transer.eth import _eth_dispatcher
 from transer import config
-from transer.utils import jsonrpc_caller
+from transer.utils import jsonrpc_caller, cpu_bound
 
 from transer.db import eth
 
@@ -11,6 +11,7 @@ eth_signing_instance_uri = config['eth_signing_instance_uri']
 
 
 @_eth_dispatcher.add_method
+@cpu_bound
 @jsonrpc_caller(target_uri=eth_signing_instance_uri, catchables=[EthAddressIntegrityException])
 def create_address():
     key_name = config.get('eth_masterkey_name', None)
@@ -3,12 +3,12 @@ import codecs
 
 import rlp
 from ethereum import transactions
-from web3 import Web3
 
 from transer.eth.validate_address import normalize_addr, validate_existence_addr_
 from transer.exceptions import EthAddressIntegrityException
 
 from transer.eth import eth_divider, _eth_dispatcher
+from transer.eth.rpc_client import get_web3
 
 # constant, amount of gas to run a transaction
 # https://ethereum.github.io/yellowpaper/paper.pdf Appendix G
@@ -23,8 +23,7 @@ def current_gas_price(web3_url):
     :param web3_url: web3 RPC url as str
     :return: current price of gas, in Ether (!)
     """
-    provider = Web3.HTTPProvider(web3_url)
-    web3_inst = Web3(provider)
+    web3_inst = get_web3(web3_url)
     gas_price = web3_inst.eth.gasPrice
     return gas_price / eth_divider
 
@@ -42,8 +41,7 @@ def create_transaction(web3_url, src_addr, dst_addr, amount, gas_price):
     :return: unsigned transaction as hex str
     """
 
-    provider = Web3.HTTPProvider(web3_url)
-    web3_inst = Web3(provider)
+    web3_inst = get_web3(web3_url)
 
     amount = decimal.Decimal(amount) * eth_divider          # convert to Wei
     gas_price = decimal.Decimal(gas_price) * eth_divider    # convert to Wei
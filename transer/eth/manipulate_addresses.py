@@ -2,9 +2,11 @@ import secrets
 from ethereum import utils
 from transer.eth import _eth_dispatcher
 from transer.exceptions import EthAddressIntegrityException
+from transer.utils import cpu_bound
 
 
 @_eth_dispatcher.add_method
+@cpu_bound
 def create_priv_keys(num_keys=1):
     """
     create_priv_keys()
@@ -28,6 +30,7 @@ def create_priv_keys(num_keys=1):
 
 
 @_eth_dispatcher.add_method
+@cpu_bound
 def create_keypairs(num_keypairs=1):
     """
     create_keypairs()
@@ -1,18 +1,24 @@
 from datetime import datetime, timezone
 from collections import defaultdict
-from math import floor
 
-from web3 import Web3
 from sqlalchemy import desc, asc
-from sqlalchemy.orm import load_only
 from sqlalchemy.orm.exc import NoResultFound
 
+from transer import config
 from transer.db import eth, sqla_session
 from transer.exceptions import EthMonitorTransactionException
 from transer.eth import eth_divider, _eth_dispatcher
+from transer.eth.rpc_client import get_web3, get_blocks, get_chain
+from transer.eth.address_index import get_address_index
+from transer.eth.block_index import block_for_timestamp, record_scanned_blocks
+from transer.chain_cache import REORG_DEPTH
+from transer.chain_store import get_chain_store
 
 
 def rewind_to_earleist_address(web3_url):
+    """
+    :return: номер первого блока, созданного после самого раннего адреса кошелька
+    """
     earlest_address_q = eth.Address.query\
         .order_by(asc(eth.Address.timestamp))\
         .limit(1)
@@ -21,118 +27,131 @@ def rewind_to_earleist_address(web3_url):
     except NoResultFound as e:
         raise EthMonitorTransactionException('No deposit addresses to monitor') from e
 
-    provider = Web3.HTTPProvider(web3_url)
-    web3_inst = Web3(provider)
-    bottom_block = web3_inst.eth.getBlock('earliest')
-    top_block = web3_inst.eth.getBlock('latest')
-
-    target_timestamp = earlest_address.timestamp
-
-    while True:
-        bottom_block_num = bottom_block['number']
-        top_block_num = top_block['number']
+    return block_for_timestamp(web3_url, earlest_address.timestamp.timestamp())
 
-        if top_block_num - bottom_block_num == 1:
-            return top_block
 
-        middle_block_num = floor(bottom_block_num + (top_block_num - bottom_block_num) / 2)
-        middle_block = web3_inst.eth.getBlock(middle_block_num)
-
-        if middle_block['timestamp'] <= target_timestamp.timestamp():
-            bottom_block = middle_block
-        elif middle_block['timestamp'] > target_timestamp.timestamp():
-            top_block = middle_block
-
-
-@_eth_dispatcher.add_method
-def get_recent_deposit_transactions(web3_url):
+def iter_recent_deposit_transactions(web3_url):
     """
+    Сканирование блоков окнами по config['ethd_scan_window'] блоков. Для каждого окна в сессию добавляется
+    контрольная точка (eth.DepositsLog последнего блока окна), которую потребитель коммитит вместе
+    с депозитами окна; после падения сканирование продолжается с последнего закоммиченного окна
 
     :param web3_url: web3 RPC url as str
-    :return:
+    :return: генератор {address: [deposit, ...]} по окну за раз
     """
 
-    provider = Web3.HTTPProvider(web3_url)
-    web3_inst = Web3(provider)
-
     log_entry_q = eth.DepositsLog.query\
         .order_by(desc(eth.DepositsLog.block_num))\
         .limit(1)
-
-    try:
-        log_entry = log_entry_q.one()
-        bottom_block_num = log_entry.block_num
-    except NoResultFound:
-        bottom_block = rewind_to_earleist_address(web3_url)
-        bottom_block_num = bottom_block['number']
-        bottom_block_obj = eth.DepositsLog(
-            block_num=bottom_block_num,
-            block_hash=bottom_block['hash'],
-            block_timestamp=datetime.fromtimestamp(bottom_block['timestamp'], timezone.utc)
+    log_entry = log_entry_q.one_or_none()
+    if log_entry is not None:
+        bottom_block_num = log_entry.block_num + 1   # the checkpoint block itself is already scanned
+    else:
+        bottom_block_num = rewind_to_earleist_address(web3_url)
+
+    top_block_num = get_chain(web3_url).tip().height
+
+    addresses = get_address_index()
+
+    scan_window = config.get('ethd_scan_window', 500)
+    for window_start in range(bottom_block_num, top_block_num + 1, scan_window):
+        block_nums = list(range(window_start, min(window_start + scan_window, top_block_num + 1)))
+
+        involved_adresses = defaultdict(list)
+        scanned_blocks = []
+        for block in get_blocks(web3_url, block_nums):
+            scanned_blocks.append({'number': block['number'], 'timestamp': block['timestamp']})
+            txs = block['transactions']
+            confirmations = top_block_num - block['number']
+            for tx in txs:
+                to = tx['to']
+                if to is None:
+                    continue
+                to = to.lower()
+
+                if to in addresses:
+                    data = {
+                        'tx_hash': tx['hash'],
+                        'amount': tx['value'] / eth_divider,
+                        'timestamp': block['timestamp'],
+                        'block_num': block['number'],
+                        'block_hash': block['hash'],
+                        'confirmations': confirmations
+                    }
+                    involved_adresses[to].append(data)
+
+        checkpoint = eth.DepositsLog(
+            block_num=block['number'],
+            block_hash=block['hash'],
+            block_timestamp=datetime.fromtimestamp(block['timestamp'], timezone.utc)
         )
-        sqla_session.add(bottom_block_obj)
-
-    top_block = web3_inst.eth.getBlock('latest')
-    top_block_num = top_block['number']
+        sqla_session.add(checkpoint)
+        record_scanned_blocks(scanned_blocks)
 
-    if top_block_num == bottom_block_num:
-        return []
+        yield involved_adresses
 
-    top_block_obj = eth.DepositsLog(
-        block_num=top_block_num,
-        block_hash=top_block['hash'],
-        block_timestamp=datetime.fromtimestamp(top_block['timestamp'], timezone.utc)
-    )
-    sqla_session.add(top_block_obj)
 
-    addesses_q = eth.Address.query.options(load_only('address'))
-    addresses = {a.address for a in addesses_q.all()}
+@_eth_dispatcher.add_method
+def get_recent_deposit_transactions(web3_url):
+    """
+    См. iter_recent_deposit_transactions()
 
+    :param web3_url: web3 RPC url as str
+    :return: {address: [deposit, ...]}
+    """
     involved_adresses = defaultdict(list)
-
-    for b in range(bottom_block_num, top_block_num+1):
-        block = web3_inst.eth.getBlock(b, True)
-        txs = block['transactions']
-        confirmations = top_block['number'] - b
-        for tx in txs:
-            to = tx['to']
-            if to is None:
-                continue
-            to = to.lower()
-
-            if to in addresses:
-                data = {
-                    'tx_hash': tx['hash'],
-                    'amount': tx['value'] / eth_divider,
-                    'timestamp': block['timestamp'],
-                    'confirmations': confirmations
-                }
-                involved_adresses[to].append(data)
-
-    sqla_session.commit()
+    for window_deposits in iter_recent_deposit_transactions(web3_url):
+        for address, deposits in window_deposits.items():
+            involved_adresses[address].extend(deposits)
+        sqla_session.commit()
 
     return involved_adresses
 
 
+def get_block_hashes(web3_url, block_nums):
+    """
+    Hash-и блоков основной цепочки, для проверки сохранённых блоков транзакций на orphaning
+
+    :param web3_url: web3 RPC url as str
+    :param block_nums: номера блоков
+    :return: {block_num: block hash}
+    """
+    return {height: header.hash for height, header in get_chain(web3_url).headers_at(block_nums).items()}
+
+
 @_eth_dispatcher.add_method
 def get_transaction(web3_url, tx_hash):
     """
-    Simple Eth.getTransaction() wrapper
+    Simple Eth.getTransaction() wrapper. Transactions with more than REORG_DEPTH confirmations
+    are kept in the local cache, see transer.chain_store
 
     :param web3_url: web3 RPC url as str
     :param tx_hash: hash of transaction
     :return:
     """
-
-    provider = Web3.HTTPProvider(web3_url)
-    web3_inst = Web3(provider)
-
-    res = web3_inst.eth.getTransaction(tx_hash)
-    if res is None:
-        raise EthMonitorTransactionException(f'Transaction with hash {tx_hash} is not found')
-
-    tx = dict(res)
-    latest_block = web3_inst.eth.blockNumber
-    tx['confirmations'] = latest_block - res['blockNumber']
+    store = get_chain_store()
+    if store is not None:
+        namespace = f'eth_tx:{get_chain(web3_url).network()}'
+        cached = store.get_many(namespace, [tx_hash])
+    else:
+        cached = {}
+
+    tx = cached.get(tx_hash)
+    if tx is None:
+        web3_inst = get_web3(web3_url)
+
+        res = web3_inst.eth.getTransaction(tx_hash)
+        if res is None:
+            raise EthMonitorTransactionException(f'Transaction with hash {tx_hash} is not found')
+        tx = dict(res)
+
+    if tx['blockNumber'] is None:     # pending, e.g. returned to the pool after chain reorganization
+        tx['confirmations'] = 0
+    else:
+        latest_block = get_chain(web3_url).tip().height
+        tx['confirmations'] = latest_block - tx['blockNumber']
+
+    if store is not None and tx_hash not in cached and tx['confirmations'] > REORG_DEPTH:
+        store.put_many(namespace, {tx_hash: tx})
 
     return tx
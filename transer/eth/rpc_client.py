@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import itertools
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from web3 import Web3, HTTPProvider
+from web3.middleware.pythonic import block_formatter
+
+from transer import config, rpc_stats
+from transer.chain_cache import REORG_DEPTH, Header, HeaderCache, get_header_cache
+from transer.chain_store import get_chain_store
+from transer.exceptions import EthMonitorTransactionException
+
+
+class PooledHTTPProvider(HTTPProvider):
+    """
+    HTTPProvider поверх собственной requests.Session: keep-alive пул соединений с настраиваемым размером
+    вместо глобального кеша сессий web3, который не переживает fork()
+    """
+
+    def __init__(self, endpoint_uri, session, request_kwargs=None):
+        self.session = session
+        super(PooledHTTPProvider, self).__init__(endpoint_uri, request_kwargs)
+
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+
+        started = time.monotonic()
+        response_data = b''
+        errors = 1
+        try:
+            response = self.session.post(self.endpoint_uri, data=request_data, **self.get_request_kwargs())
+            response.raise_for_status()
+            response_data = response.content
+            decoded_response = self.decode_rpc_response(response_data)
+            errors = rpc_stats.count_errors(decoded_response)
+            return decoded_response
+        finally:
+            rpc_stats.record('geth', method, started, len(request_data), len(response_data), errors)
+
+    def make_batch_request(self, rpc_calls):
+        """
+        JSON-RPC batch: все вызовы уходят одним HTTP запросом
+
+        :param rpc_calls: [(method, params), ...]
+        :return: list декодированных ответов в порядке rpc_calls
+        """
+        ids = [next(self.request_counter) for _ in rpc_calls]
+        request_data = json.dumps([
+            {'jsonrpc': '2.0', 'method': method, 'params': params, 'id': request_id}
+            for (method, params), request_id in zip(rpc_calls, ids)
+        ]).encode('utf-8')
+
+        started = time.monotonic()
+        response_data = b''
+        errors = len(rpc_calls)
+        try:
+            response = self.session.post(self.endpoint_uri, data=request_data, **self.get_request_kwargs())
+            response.raise_for_status()
+            response_data = response.content
+            decoded_responses = self.decode_rpc_response(response_data)
+            errors = rpc_stats.count_errors(decoded_responses)
+        finally:
+            rpc_stats.record(
+                'geth', rpc_stats.batch_method(m for m, _ in rpc_calls), started,
+                len(request_data), len(response_data), errors, len(rpc_calls)
+            )
+
+        if isinstance(decoded_responses, dict):     # whole batch rejected
+            decoded_responses = [decoded_responses]
+        responses_by_id = {r.get('id'): r for r in decoded_responses}
+        return [
+            responses_by_id.get(i, {'error': {'code': -32603, 'message': 'missing JSON-RPC result'}}) for i in ids
+        ]
+
+
+def create_session():
+    pool_maxsize = config.get('ethd_pool_maxsize', 10)
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+_web3_insts = {}    # {web3_url: Web3}
+_web3_insts_pid = None
+
+
+def get_web3(web3_url):
+    """
+    Реестр Web3 инстансов, один на url в пределах процесса; после fork() инстансы родителя не используются.
+    Web3 и его пул соединений thread-safe, так что инстанс общий для всех потоков процесса
+
+    :param web3_url: web3 RPC url as str
+    :return: Web3
+    """
+    global _web3_insts_pid
+
+    pid = os.getpid()
+    if pid != _web3_insts_pid:
+        _web3_insts.clear()
+        _web3_insts_pid = pid
+
+    web3_inst = _web3_insts.get(web3_url)
+    if web3_inst is None:
+        provider = PooledHTTPProvider(
+            web3_url,
+            session=create_session(),
+            request_kwargs={'timeout': config.get('ethd_rpc_timeout', 10)}
+        )
+        web3_inst = Web3(provider)
+        _web3_insts[web3_url] = web3_inst
+    return web3_inst
+
+
+def get_blocks(web3_url, block_nums, full_transactions=True):
+    """
+    Загрузка блоков пакетами eth_getBlockByNumber: по config['ethd_batch_size'] блоков в запросе,
+    до config['ethd_max_inflight'] запросов одновременно. Память ограничена окном запросов в полёте.
+    Блоки глубже REORG_DEPTH читаются из локального кэша и сохраняются в него, см. transer.chain_store
+
+    :param web3_url: web3 RPC url as str
+    :param block_nums: номера блоков
+    :return: генератор блоков (как Eth.getBlock()) в порядке block_nums
+    """
+    provider = get_web3(web3_url).providers[0]
+    batch_size = config.get('ethd_batch_size', 100)
+    max_inflight = config.get('ethd_max_inflight', 4)
+    caller = rpc_stats.caller()
+
+    # sqlite3 connections are per thread, so the store is used from the calling thread only
+    store = get_chain_store()
+    if store is not None:
+        chain = get_chain(web3_url)
+        namespace = f'{"eth_block" if full_transactions else "eth_block_header"}:{chain.network()}'
+        immutable_height = chain.tip().height - REORG_DEPTH   # such blocks never change by number
+
+    def fetch(batch):
+        rpc_stats.reset()   # requests are made in pool threads, their stats are merged into the calling thread
+        if len(batch) == 0:
+            return {}, rpc_stats.drain()
+        responses = provider.make_batch_request([('eth_getBlockByNumber', [hex(b), full_transactions]) for b in batch])
+
+        blocks = {}
+        for block_num, r in zip(batch, responses):
+            if r.get('error') is not None or r.get('result') is None:
+                raise EthMonitorTransactionException(f'Block {block_num} cannot be fetched: {r.get("error")}')
+            blocks[block_num] = block_formatter(r['result'])
+        return blocks, rpc_stats.drain()
+
+    def submit(pool, batch):
+        cached = store.get_many(namespace, batch) if store is not None else {}
+        return batch, cached, pool.submit(fetch, [b for b in batch if b not in cached])
+
+    batches = (block_nums[i:i + batch_size] for i in range(0, len(block_nums), batch_size))
+    with ThreadPoolExecutor(max_workers=max_inflight) as pool:
+        inflight = collections.deque(submit(pool, b) for b in itertools.islice(batches, max_inflight))
+        while inflight:
+            batch, cached, future = inflight.popleft()
+            fetched, calls = future.result()
+            rpc_stats.merge(calls, caller)
+            if store is not None:
+                store.put_many(namespace, {n: b for n, b in fetched.items() if n <= immutable_height})
+
+            for b in itertools.islice(batches, 1):
+                inflight.append(submit(pool, b))
+            yield from (cached[n] if n in cached else fetched[n] for n in batch)
+
+
+def block_header(block):
+    return Header(block['number'], block['hash'], block['parentHash'], block['timestamp'])
+
+
+class EthHeaderCache(HeaderCache):
+    def __init__(self, web3_url):
+        super(EthHeaderCache, self).__init__()
+        self.web3_url = web3_url
+
+    def fetch_tip(self):
+        return block_header(get_web3(self.web3_url).eth.getBlock('latest'))
+
+    def fetch_network(self):
+        # chain forks share the genesis block and the history before the fork, but not the network id
+        return str(get_web3(self.web3_url).version.network)
+
+    def fetch_headers(self, heights):
+        return [block_header(b) for b in get_blocks(self.web3_url, heights, full_transactions=False)]
+
+
+def get_chain(web3_url):
+    """
+    :param web3_url: web3 RPC url as str
+    :return: EthHeaderCache - вершина чейна и заголовки последних блоков, см. transer.chain_cache.HeaderCache
+    """
+    return get_header_cache(('geth', web3_url), lambda: EthHeaderCache(web3_url))
@@ -1,6 +1,6 @@
-from web3 import Web3
 
 from transer.eth import _eth_dispatcher
+from transer.eth.rpc_client import get_web3, get_chain
 
 
 @_eth_dispatcher.add_method
@@ -13,8 +13,7 @@ def send_transaction(web3_url, signed_tx_h):
     :return: transaction hash as str or None,
         for details, see https://github.com/ethereum/wiki/wiki/JSON-RPC#eth_sendrawtransaction
     """
-    provider = Web3.HTTPProvider(web3_url)
-    web3_inst = Web3(provider)
+    web3_inst = get_web3(web3_url)
 
     res = web3_inst.eth.sendRawTransaction(signed_tx_h)
     if res:
@@ -33,8 +32,7 @@ def transaction_receipt(web3_url, tx_hash):
     :return: transaction receipt as dict or None,
         for details, see https://github.com/ethereum/wiki/wiki/JSON-RPC#eth_gettransactionreceipt
     """
-    provider = Web3.HTTPProvider(web3_url)
-    web3_inst = Web3(provider)
+    web3_inst = get_web3(web3_url)
 
     return web3_inst.eth.getTransactionReceipt(tx_hash)
 
@@ -47,9 +45,7 @@ def current_block_number(web3_url):
     :param web3_url: web3 RPC url as str
     :return: current block number
     """
-    provider = Web3.HTTPProvider(web3_url)
-    web3_inst = Web3(provider)
-    return web3_inst.eth.blockNumber
+    return get_chain(web3_url).tip().height
 
 
 @_eth_dispatcher.add_method
@@ -63,14 +59,13 @@ def check_transaction_mined(web3_url, tx_hash, blocks_depth=6):
     :return: True if there are at least 'blocks_depth' blocks mined since
         transaction denoted by 'tx_hash' applied, False otherwise
     """
-    provider = Web3.HTTPProvider(web3_url)
-    web3_inst = Web3(provider)
+    web3_inst = get_web3(web3_url)
 
     receipt = web3_inst.eth.getTransactionReceipt(tx_hash)
     if receipt is None:
         return None
 
     mined_block_num = receipt['blockNumber']
-    current_block_num = web3_inst.eth.blockNumber
+    current_block_num = get_chain(web3_url).tip().height
 
     return mined_block_num + blocks_depth <= current_block_num
@@ -7,12 +7,13 @@ from transer.eth.validate_address import normalize_addr
 from transer.exceptions import EthAddressIntegrityException
 from transer.eth import _eth_dispatcher
 from transer import config
-from transer.utils import jsonrpc_caller
+from transer.utils import jsonrpc_caller, cpu_bound
 
 eth_signing_instance_uri = config['eth_signing_instance_uri']
 
 
 @_eth_dispatcher.add_method
+@cpu_bound
 @jsonrpc_caller(target_uri=eth_signing_instance_uri, catchables=[EthAddressIntegrityException])
 def sign_transaction(src_addr, priv_key, unsigned_tx_h, network_id=1):
     """
@@ -1,10 +1,10 @@
 import decimal
 
 from ethereum import utils
-from web3 import Web3
 
 from transer.exceptions import EthAddressIntegrityException
 from transer.eth import eth_divider, _eth_dispatcher
+from transer.eth.rpc_client import get_web3
 
 
 @_eth_dispatcher.add_method
@@ -39,8 +39,7 @@ def validate_existence_addr(web3_url, addr, estimate_spendable=decimal.Decimal(0
     :return: True/False - достаточно или нет средств; None если по адресу нет транзакций и баланс 0
         (адрес не использовался)
     """
-    provider = Web3.HTTPProvider(web3_url)
-    web3_inst = Web3(provider)
+    web3_inst = get_web3(web3_url)
 
     validate_existence_addr_(
         web3_inst=web3_inst,
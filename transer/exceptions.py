@@ -35,6 +35,10 @@ class BtcCreateTransactionException(BtcBaseClass):
     pass
 
 
+class BtcInsufficientFundsException(BtcCreateTransactionException):
+    pass
+
+
 class BtcSignTransactionException(BtcBaseClass):
     pass
 
@@ -43,6 +47,10 @@ class BtcSendTransactionException(BtcBaseClass):
     pass
 
 
+class BtcTransactionRejectedException(BtcSendTransactionException):
+    pass
+
+
 class BtcMonitorTransactionException(BtcBaseClass):
     pass
 
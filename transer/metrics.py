@@ -0,0 +1,289 @@
+import threading
+import logging
+import time
+
+from aiohttp import web
+
+from transer import types, rpc_stats
+from transer.db import transaction, sqla_session
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+logger = logging.getLogger('metrics')
+
+registry = []
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_sample(name, labelnames, key, value, extra_labels=()):
+    labels = list(zip(labelnames, key)) + list(extra_labels)
+    if labels:
+        labels_s = ','.join(f'{k}="{escape_label_value(v)}"' for k, v in labels)
+        return f'{name}{{{labels_s}}} {value}'
+    return f'{name} {value}'
+
+
+class Metric(object):
+    """
+    Минимальная реализация метрик в формате Prometheus text exposition,
+    значения живут в памяти главного процесса демона
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()    # updated from executor's threads/callbacks
+        self.values = {}
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def samples(self):
+        return [format_sample(self.name, self.labelnames, k, v) for k, v in self.values.items()]
+
+    def render(self):
+        with self.lock:
+            samples = self.samples()
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}'] + samples
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            for b, c in zip(self.buckets, counts):
+                lines.append(format_sample(f'{self.name}_bucket', self.labelnames, key, c, [('le', b)]))
+            lines.append(format_sample(f'{self.name}_bucket', self.labelnames, key, count, [('le', '+Inf')]))
+            lines.append(format_sample(f'{self.name}_sum', self.labelnames, key, total))
+            lines.append(format_sample(f'{self.name}_count', self.labelnames, key, count))
+        return lines
+
+
+http_requests = Counter(
+    'transer_http_requests_total', 'HTTP requests by route and status', ['route', 'method', 'status']
+)
+http_request_duration = Histogram(
+    'transer_http_request_duration_seconds', 'HTTP request latency by route', ['route', 'method']
+)
+
+jsonrpc_requests = Counter(
+    'transer_jsonrpc_requests_total', 'JSON-RPC calls by dispatcher method', ['endpoint', 'method']
+)
+jsonrpc_request_duration = Histogram(
+    'transer_jsonrpc_request_duration_seconds', 'JSON-RPC call latency by dispatcher method', ['endpoint', 'method']
+)
+
+executor_inflight = Gauge(
+    'transer_executor_inflight_tasks', 'Tasks submitted to executor and not finished yet (queued + running)',
+    ['executor']
+)
+executor_workers = Gauge(
+    'transer_executor_workers', 'Executor capacity', ['executor']
+)
+
+periodic_task_runs = Counter(
+    'transer_periodic_task_runs_total', 'Periodic task runs by outcome', ['task', 'outcome']
+)
+periodic_task_duration = Histogram(
+    'transer_periodic_task_duration_seconds', 'Periodic task run duration', ['task']
+)
+periodic_task_last_run = Gauge(
+    'transer_periodic_task_last_run_timestamp_seconds', 'Unix time of the last periodic task run', ['task']
+)
+periodic_task_last_duration = Gauge(
+    'transer_periodic_task_last_duration_seconds', 'Duration of the last periodic task run', ['task']
+)
+periodic_task_items = Gauge(
+    'transer_periodic_task_last_items_processed', 'Number of items processed by the last periodic task run', ['task']
+)
+periodic_task_backlog = Gauge(
+    'transer_periodic_task_backlog', 'Backlog reported by periodic task probe', ['task']
+)
+
+deposits_backlog = Gauge(
+    'transer_deposits', 'Deposit transactions by currency and status', ['currency', 'status']
+)
+withdrawals_backlog = Gauge(
+    'transer_withdrawals', 'Withdrawal transactions by currency and status', ['currency', 'status']
+)
+unacknowledged_notifications = Gauge(
+    'transer_unacknowledged_notifications', 'Deposit/withdrawal notifications not acknowledged yet', ['kind']
+)
+
+rpc_requests = Counter(
+    'transer_rpc_requests_total', 'HTTP requests to bitcoind/geth/signer by RPC method and calling function',
+    ['backend', 'method', 'caller']
+)
+rpc_calls = Counter(
+    'transer_rpc_calls_total', 'RPC calls (batch items counted separately) by RPC method and calling function',
+    ['backend', 'method', 'caller']
+)
+rpc_errors = Counter(
+    'transer_rpc_errors_total', 'Failed RPC requests by RPC method and calling function',
+    ['backend', 'method', 'caller']
+)
+rpc_duration = Counter(
+    'transer_rpc_duration_seconds_total', 'Time spent in RPC requests by RPC method and calling function',
+    ['backend', 'method', 'caller']
+)
+rpc_request_bytes = Counter(
+    'transer_rpc_request_bytes_total', 'RPC request payload size by RPC method', ['backend', 'method']
+)
+rpc_response_bytes = Counter(
+    'transer_rpc_response_bytes_total', 'RPC response payload size by RPC method', ['backend', 'method']
+)
+rpc_calls_per_run = Histogram(
+    'transer_rpc_calls_per_run', 'RPC calls made by one endpoint/JSON-RPC request/periodic task run', ['tag'],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, 10000)
+)
+
+executor_names = {}     # {id(executor): name}
+
+
+def register_executor(executor, name, workers):
+    executor_names[id(executor)] = name
+    executor_workers.set(workers, executor=name)
+
+
+def track_future(executor, future):
+    """
+    Учёт глубины очереди executor-а: future считается до своего завершения
+    """
+    name = executor_names.get(id(executor), type(executor).__name__)
+    executor_inflight.inc(executor=name)
+    future.add_done_callback(lambda _: executor_inflight.dec(executor=name))
+
+
+def record_rpc_calls(tag, calls):
+    """
+    :param tag: имя метода/задачи, см. utils.profile_tag()
+    :param calls: статистика RPC вызовов worker-а, см. rpc_stats.drain()
+    """
+    for (backend, method, caller), s in calls.items():
+        rpc_requests.inc(s[rpc_stats.REQUESTS], backend=backend, method=method, caller=caller)
+        rpc_calls.inc(s[rpc_stats.CALLS], backend=backend, method=method, caller=caller)
+        rpc_errors.inc(s[rpc_stats.ERRORS], backend=backend, method=method, caller=caller)
+        rpc_duration.inc(s[rpc_stats.SECONDS], backend=backend, method=method, caller=caller)
+        rpc_request_bytes.inc(s[rpc_stats.REQUEST_BYTES], backend=backend, method=method)
+        rpc_response_bytes.inc(s[rpc_stats.RESPONSE_BYTES], backend=backend, method=method)
+
+    total = rpc_stats.total_calls(calls)
+    rpc_calls_per_run.observe(total, tag=tag)
+    if total:
+        logger.debug(f'{tag} made {total} RPC calls')
+
+
+def route_label(request):
+    route = request.match_info.route
+    if route is None or route.resource is None:
+        return 'unmatched'
+    info = route.resource.get_info()
+    return info.get('formatter') or info.get('path') or 'unmatched'
+
+
+async def metrics_middleware(app, handler):
+    async def middleware_handler(request):
+        started = time.monotonic()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            route = route_label(request)
+            http_requests.inc(route=route, method=request.method, status=status)
+            http_request_duration.observe(time.monotonic() - started, route=route, method=request.method)
+    return middleware_handler
+
+
+def update_backlog_gauges():
+    CryptoDepositTransaction = transaction.CryptoDepositTransaction
+    CryptoWithdrawTransaction = transaction.CryptoWithdrawTransaction
+
+    try:
+        for c in types.CryptoCurrency:
+            pending_deposits = CryptoDepositTransaction.query.filter(
+                CryptoDepositTransaction.currency == c.value,
+                CryptoDepositTransaction.status == types.DepositStatus.PENDING.value
+            ).count()
+            deposits_backlog.set(pending_deposits, currency=c.value, status=types.DepositStatus.PENDING.value)
+
+            for s in (types.WithdrawalStatus.PREPENDING, types.WithdrawalStatus.PENDING):
+                withdrawals = CryptoWithdrawTransaction.query.filter(
+                    CryptoWithdrawTransaction.currency == c.value,
+                    CryptoWithdrawTransaction.status == s.value
+                ).count()
+                withdrawals_backlog.set(withdrawals, currency=c.value, status=s.value)
+
+        unacknowledged_notifications.set(
+            CryptoDepositTransaction.query.filter(CryptoDepositTransaction.is_acknowledged.is_(False)).count(),
+            kind='deposit'
+        )
+        unacknowledged_notifications.set(
+            CryptoWithdrawTransaction.query.filter(CryptoWithdrawTransaction.is_acknowledged.is_(False)).count(),
+            kind='withdrawal'
+        )
+    finally:
+        sqla_session.close()
+
+
+def render():
+    lines = []
+    for m in registry:
+        lines.extend(m.render())
+    return '\n'.join(lines) + '\n'
+
+
+def metrics_endpoint(sync_request):
+    update_backlog_gauges()
+    return web.Response(text=render(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
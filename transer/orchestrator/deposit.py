@@ -1,139 +1,252 @@
 import uuid
 
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+
 from transer import types, config
 from transer.btc import monitor_transaction as btc_mon
 from transer.eth import monitor_transaction as eth_mon
+from transer.eth import send_transaction as eth_send
 from transer.db import sqla_session, btc, eth, transaction
-from transer.exceptions import BtcMonitorTransactionException, EthMonitorTransactionException
+from transer.exceptions import EthMonitorTransactionException, TransactionInconsistencyError
+
+INGEST_CHUNK_SIZE = 1000    # rows per INSERT statement
+
+
+def chain_tip_btc():
+    return btc_mon.get_best_block_hash(bt_name=config['btcd_instance_name'])
 
 
-def add_confirmed_deposit_btc(address, amount):
-    address_to_update_q = btc.Address.query.filter(
-        btc.Address.address == address
+def chain_tip_eth():
+    return eth_send.current_block_number(config['ethd_instance_uri'])
+
+
+def pending_deposits(currency):
+    pending_transactions_q = transaction.CryptoDepositTransaction.query.filter(
+        transaction.CryptoDepositTransaction.status == types.DepositStatus.PENDING.value,
+        transaction.CryptoDepositTransaction.currency == currency.value
     )
-    address_to_update = address_to_update_q.one()
-    address_to_update.amount += amount
+    return pending_transactions_q.count()
+
+
+def backlog_deposit_btc():
+    return pending_deposits(types.CryptoCurrency.BITCOIN)
+
+
+def backlog_deposit_eth():
+    return pending_deposits(types.CryptoCurrency.ETHERIUM)
+
+
+def ingest_deposits(currency, deposits):
+    """
+    Идемпотентная пакетная запись новых депозитов: уже записанные (по детерминированному u_txid) пропускаются
+
+    :param currency: types.CryptoCurrency
+    :param deposits: [(address, txid, amount, types.DepositStatus, block_num, block_hash), ...];
+        блок, в который попала транзакция, может быть None
+    :return: [(address, amount), ...] реально записанных COMPLETED депозитов, для зачисления на баланс
+    """
+    deposits_table = transaction.CryptoDepositTransaction.__table__
+
+    credits = []
+    for i in range(0, len(deposits), INGEST_CHUNK_SIZE):
+        rows = [
+            {
+                'id': deposits_table.c.id.default.next_value(),     # rendered inline, not pre-executed per row
+                'u_txid': uuid.uuid5(uuid.NAMESPACE_URL, f'{address}.{txid}'),
+                'currency': currency.value,
+                'address': address,
+                'txid': txid,
+                'block_num': block_num,
+                'block_hash': block_hash,
+                'amount': amount,
+                'status': status.value,
+                'is_acknowledged': False
+            }
+            for address, txid, amount, status, block_num, block_hash in deposits[i:i + INGEST_CHUNK_SIZE]
+        ]
+        insert_q = insert(deposits_table)\
+            .values(rows)\
+            .on_conflict_do_nothing(index_elements=[deposits_table.c.u_txid])\
+            .returning(deposits_table.c.address, deposits_table.c.amount, deposits_table.c.status)
+
+        inserted = sqla_session.execute(insert_q)
+        credits.extend((r.address, r.amount) for r in inserted if r.status == types.DepositStatus.COMPLETED.value)
+    return credits
+
+
+APPLY_DEPOSIT_TRANSITIONS_SQL = text(f'''
+UPDATE {transaction.CryptoDepositTransaction.__table__.fullname} t
+SET status = CAST(c.status AS crypto_deposit_transaction_status), is_acknowledged = FALSE
+FROM unnest(CAST(:ids AS integer[]), CAST(:statuses AS varchar[])) AS c(id, status)
+WHERE t.id = c.id AND t.status = CAST(:pending AS crypto_deposit_transaction_status)
+RETURNING t.address, t.amount, t.status
+''')
+
+
+def apply_deposit_transitions(transitions):
+    """
+    Перевод PENDING депозитов в новые статусы одним UPDATE-ом; депозиты, статус которых
+    уже сменился конкурентно, не затрагиваются
+
+    :param transitions: [(CryptoDepositTransaction.id, types.DepositStatus), ...]
+    :return: [(address, amount), ...] депозитов, ставших COMPLETED, для зачисления на баланс
+    """
+    if len(transitions) == 0:
+        return []
+
+    rows = sqla_session.execute(APPLY_DEPOSIT_TRANSITIONS_SQL, {
+        'ids': [x[0] for x in transitions],
+        'statuses': [x[1].value for x in transitions],
+        'pending': types.DepositStatus.PENDING.value
+    })
+    return [(r.address, r.amount) for r in rows if r.status == types.DepositStatus.COMPLETED.value]
+
+
+CREDIT_DEPOSITS_SQL = '''
+UPDATE {table} a
+SET amount = a.amount + c.amount
+FROM unnest(CAST(:addresses AS varchar[]), CAST(:amounts AS numeric[])) AS c(address, amount)
+WHERE a.address = c.address
+RETURNING a.address
+'''
+
+
+def credit_deposits(address_model, credits):
+    """
+    Зачисление подтверждённых депозитов на балансы адресов одним UPDATE-ом, суммы сгруппированы по адресам
+
+    :param address_model: btc.Address или eth.Address
+    :param credits: [(address, amount), ...]
+    :raise TransactionInconsistencyError: адрес не найден или записан более одного раза
+    """
+    amounts = {}
+    for address, amount in credits:
+        amounts[address] = amounts.get(address, 0) + amount
+    if len(amounts) == 0:
+        return
+
+    rows = sqla_session.execute(text(CREDIT_DEPOSITS_SQL.format(table=address_model.__table__.fullname)), {
+        'addresses': list(amounts.keys()),
+        'amounts': list(amounts.values())
+    })
+
+    credited = sorted(r.address for r in rows)
+    if credited != sorted(amounts):
+        sqla_session.rollback()
+        raise TransactionInconsistencyError(
+            f'Credited addresses {credited} mismatch deposit addresses {sorted(amounts)}. Report the bug'
+        )
 
 
 def periodic_check_deposit_btc():
     btcd_instance_name = config['btcd_instance_name']
 
-    recorded_transactions_q = transaction.CryptoDepositTransaction.query.filter(
+    recorded_transactions_q = sqla_session.query(
+        transaction.CryptoDepositTransaction.id,
+        transaction.CryptoDepositTransaction.txid
+    ).filter(
         transaction.CryptoDepositTransaction.status == types.DepositStatus.PENDING.value,
         transaction.CryptoDepositTransaction.currency == types.CryptoCurrency.BITCOIN.value
     )
     recorded_transactions = recorded_transactions_q.all()
-    for t in recorded_transactions:
-        txid = t.txid
 
-        try:
-            tx_info = btc_mon.get_txid_status(
-                bt_name=btcd_instance_name,
-                txid=txid
-            )
-        except BtcMonitorTransactionException:
-            t.status = types.DepositStatus.CANCELLED.value    # in case of chain rebuilt
-            t.is_acknowledged = False
-            continue
-
-        confirmations = tx_info['confirmations']
-        if confirmations >= 6:
-            add_confirmed_deposit_btc(t.address, t.amount)
-            t.status = types.DepositStatus.COMPLETED.value
-            t.is_acknowledged = False
+    txs_info = btc_mon.get_txids_status(
+        bt_name=btcd_instance_name,
+        txids=list({t.txid for t in recorded_transactions})
+    )
+    transitions = []
+    for t in recorded_transactions:
+        tx_info = txs_info[t.txid]
+        if tx_info is None:
+            transitions.append((t.id, types.DepositStatus.CANCELLED))    # in case of chain rebuilt
+        elif tx_info.get('confirmations', 0) >= 6:
+            transitions.append((t.id, types.DepositStatus.COMPLETED))
 
+    credit_deposits(btc.Address, apply_deposit_transitions(transitions))
     sqla_session.commit()
 
-    txs = btc_mon.get_recent_deposit_transactions(
-        bt_name=btcd_instance_name,
-        confirmations=1
-    )
     # Controversial approach here: some data might be lost
     # between get_recent_deposit_transactions() and upcoming sqla_session.commit().
-    # It may be relied only on subsequent Postgres/Redshift layer reliability
-    for t in txs:
-        address = t['address']
-        amount = t['amount']
-        txid = t['txid']
-        confirmations = t['confirmations']
-        u_txid_seed = f'{address}.{txid}'
-        u_txid = uuid.uuid5(uuid.NAMESPACE_URL, u_txid_seed)
-        status = types.DepositStatus.PENDING if confirmations < 6 else types.DepositStatus.COMPLETED
-        deposit_transaction = transaction.CryptoDepositTransaction(
-            u_txid=u_txid,
-            currency=types.CryptoCurrency.BITCOIN.value,
-            address=address,
-            amount=amount,
-            txid=txid,
-            status=status.value,
-            is_acknowledged=False
-        )
-        sqla_session.add(deposit_transaction)
+    # It may be relied only on subsequent Postgres/Redshift layer reliability.
+    # Already recorded transactions (e.g. after the deposit cursor is rewound on chain reorganization) are skipped,
+    # so every chunk is committed on its own
+    txs_count = 0
+    for txs in btc_mon.iter_recent_deposit_transactions(bt_name=btcd_instance_name, confirmations=1):
+        deposits = []
+        for t in txs:
+            status = types.DepositStatus.PENDING if t['confirmations'] < 6 else types.DepositStatus.COMPLETED
+            deposits.append((t['address'], t['txid'], t['amount'], status, t.get('blockheight'), t.get('blockhash')))
 
-        if status == types.DepositStatus.COMPLETED:
-            add_confirmed_deposit_btc(address, amount)
+        credit_deposits(btc.Address, ingest_deposits(types.CryptoCurrency.BITCOIN, deposits))
+        sqla_session.commit()
+        txs_count += len(txs)
 
-    sqla_session.commit()
-
-
-def add_confirmed_deposit_eth(address, amount):
-    address_to_update_q = eth.Address.query.filter(
-        eth.Address.address == address
-    )
-    address_to_update = address_to_update_q.one()
-    address_to_update.amount += amount
+    return len(recorded_transactions) + txs_count
 
 
 def periodic_check_deposit_eth():
     ethd_instance_uri = config['ethd_instance_uri']
 
-    recorded_transactions_q = transaction.CryptoDepositTransaction.query.filter(
+    recorded_transactions_q = sqla_session.query(
+        transaction.CryptoDepositTransaction.id,
+        transaction.CryptoDepositTransaction.txid,
+        transaction.CryptoDepositTransaction.block_num,
+        transaction.CryptoDepositTransaction.block_hash
+    ).filter(
         transaction.CryptoDepositTransaction.status == types.DepositStatus.PENDING.value,
         transaction.CryptoDepositTransaction.currency == types.CryptoCurrency.ETHERIUM.value
     )
     recorded_transactions = recorded_transactions_q.all()
-    for t in recorded_transactions:
-        tx_hash = t.txid
 
+    # Confirmations are counted from the recorded block against a single tip read.
+    # The node is asked again only about transactions without a recorded block and about those getting
+    # enough confirmations, whose blocks are checked to be still in the main chain within one batch
+    tip_block_num = chain_tip_eth()
+    matured_block_nums = [
+        t.block_num for t in recorded_transactions
+        if t.block_num is not None and tip_block_num - t.block_num >= 12
+    ]
+    block_hashes = eth_mon.get_block_hashes(ethd_instance_uri, matured_block_nums) if matured_block_nums else {}
+
+    transitions = []
+    relocations = []
+    for t in recorded_transactions:
+        if t.block_num is not None:
+            if tip_block_num - t.block_num < 12:
+                continue
+            if block_hashes[t.block_num] == t.block_hash:
+                transitions.append((t.id, types.DepositStatus.COMPLETED))
+                continue
+
+        # not mined when recorded or the recorded block is orphaned
         try:
             tx_info = eth_mon.get_transaction(
                 web3_url=ethd_instance_uri,
-                tx_hash=tx_hash
+                tx_hash=t.txid
             )
         except EthMonitorTransactionException:
-            t.status = types.DepositStatus.CANCELLED.value    # in case of chain rebuilt
-            t.is_acknowledged = False
+            transitions.append((t.id, types.DepositStatus.CANCELLED))    # in case of chain rebuilt
             continue
 
-        confirmations = tx_info['confirmations']
-        if confirmations >= 12:
-            add_confirmed_deposit_eth(t.address, t.amount)
-            t.status = types.DepositStatus.COMPLETED.value
-            t.is_acknowledged = False
+        relocations.append({'id': t.id, 'block_num': tx_info['blockNumber'], 'block_hash': tx_info['blockHash']})
+        if tx_info['confirmations'] >= 12:
+            transitions.append((t.id, types.DepositStatus.COMPLETED))
 
+    sqla_session.bulk_update_mappings(transaction.CryptoDepositTransaction, relocations)
+    credit_deposits(eth.Address, apply_deposit_transitions(transitions))
     sqla_session.commit()
 
-    deposits = eth_mon.get_recent_deposit_transactions(ethd_instance_uri)
-
-    for address in deposits:
-        for tx in deposits[address]:
-            txid = tx['tx_hash']
-            amount = tx['amount']
-            u_txid_seed = f'{address}.{txid}'
-            u_txid = uuid.uuid5(uuid.NAMESPACE_URL, u_txid_seed)
-            status = types.DepositStatus.PENDING if tx['confirmations'] < 12 else types.DepositStatus.COMPLETED
-            deposit_transaction = transaction.CryptoDepositTransaction(
-                u_txid=u_txid,
-                currency=types.CryptoCurrency.ETHERIUM.value,
-                address=address,
-                amount=amount,
-                txid=txid,
-                status=status.value,
-                is_acknowledged=False
-            )
-            sqla_session.add(deposit_transaction)
+    txs_count = 0
+    for deposits in eth_mon.iter_recent_deposit_transactions(ethd_instance_uri):
+        new_deposits = []
+        for address in deposits:
+            for tx in deposits[address]:
+                status = types.DepositStatus.PENDING if tx['confirmations'] < 12 else types.DepositStatus.COMPLETED
+                new_deposits.append((address, tx['tx_hash'], tx['amount'], status, tx['block_num'], tx['block_hash']))
 
-            if status == types.DepositStatus.COMPLETED:
-                add_confirmed_deposit_eth(address, amount)
+        credit_deposits(eth.Address, ingest_deposits(types.CryptoCurrency.ETHERIUM, new_deposits))
+        sqla_session.commit()   # the window's deposits and its scan checkpoint at once
+        txs_count += len(new_deposits)
 
-    sqla_session.commit()
+    return len(recorded_transactions) + txs_count
@@ -1,16 +1,23 @@
 import decimal
 import logging
+from datetime import datetime, timezone
+from http.client import HTTPException
 
-from sqlalchemy import desc, asc
+from sqlalchemy import asc
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 
 from transer import config, types
 from transer.exceptions import TransactionInconsistencyError, EthMonitorTransactionException
+from transer.exceptions import BtcInsufficientFundsException, BtcSendTransactionException
+from transer.exceptions import BtcMonitorTransactionException, BtcTransactionRejectedException
 from transer.db import eth, btc, transaction, sqla_session
 from transer.types import CryptoCurrency, WithdrawalStatus
+from transer.utils import jsonrpc_batch
 
-from transer.btc.create_transaction import calculate_transaction_fee as btc_calculate_transaction_fee
-from transer.btc.create_transaction import create_transaction as btc_create_transaction
+from transer.btc.create_transaction import transaction_feerate as btc_transaction_feerate
+from transer.btc.create_transaction import list_wallet_utxos as btc_list_wallet_utxos
+from transer.btc.create_transaction import create_raw_transaction_from_utxos as btc_create_raw_transaction
+from transer.btc.coin_selection import select_coins as btc_select_coins
 from transer.btc.sign_transaction import sign_transaction as btc_sign_transaction
 from transer.btc.send_transaction import send_transaction as btc_send_transaction
 from transer.btc.monitor_transaction import get_txid_status as btc_get_txid_status
@@ -19,7 +26,9 @@ from transer.eth.create_transaction import current_gas_price as eth_current_gas_
 from transer.eth.create_transaction import create_transaction as eth_create_transaction
 from transer.eth.sign_transaction import sign_transaction as eth_sign_transaction
 from transer.eth.send_transaction import send_transaction as eth_send_transaction
+from transer.eth.send_transaction import current_block_number as eth_current_block_number
 from transer.eth.monitor_transaction import get_transaction as eth_get_transaction
+from transer.eth.rpc_client import get_blocks as eth_get_blocks
 from transer.eth.create_transaction import TRANSACTION_GAS
 from transer.eth import eth_divider
 
@@ -55,126 +64,314 @@ def withdraw_btc(u_txid, address, amount):
         sqla_session.rollback()
         raise TransactionInconsistencyError(f'Multiple transaction records found for {u_txid}. Report the bug') from e
     except NoResultFound:
+        # in batching mode the withdrawal is queued and sent by periodic_flush_withdraw_btc()
+        batched = config.get('btc_batch_interval') is not None
         crypto_transaction = transaction.CryptoWithdrawTransaction(
             u_txid=u_txid,
             currency=CryptoCurrency.BITCOIN.value,
             address=address,
             amount=amount,
-            status=WithdrawalStatus.FAILED.value
+            status=WithdrawalStatus.PREPENDING.value if batched else WithdrawalStatus.FAILED.value
         )
         sqla_session.add(crypto_transaction)
 
-        btcd_instance_name = config['btcd_instance_name']
-        key_name = config['btc_masterkey_name']
-        masterkey_q = btc.MasterKey.query.filter(
-            btc.MasterKey.masterkey_name == key_name
-        )
-        masterkey = masterkey_q.one()
+        if not batched:
+            try:
+                send_withdrawals_btc([crypto_transaction])
+            except BtcInsufficientFundsException:
+                pass
 
-        bitcoind_instance_q = btc.BitcoindInstance.query.filter(
-            btc.BitcoindInstance.instance_name == btcd_instance_name
-        )
-        bitcoind_inst = bitcoind_instance_q.one()
-
-        # given that num of UTXOs ~ num of Addresses and fee is ~$2 per UTXO
-        # so let it be no more 10 UTXOs/Addresses to feed the destination at cost ~$20 and one wallet for change
-        ordered_adresses_q = btc.Address.query.filter(
-            btc.Address.bitcoind_inst == bitcoind_inst,
-            btc.Address.masterkey == masterkey,
-            btc.Address.address != address
-        ).order_by(desc(btc.Address.amount)).limit(11)
-        candidates = ordered_adresses_q.all()
-
-        change_address = candidates.pop(-1)
+        sqla_session.commit()
+        return crypto_transaction.status
 
-        estimate_amount = decimal.Decimal(0.0)
 
-        projected_fee = btc_calculate_transaction_fee(
-            bt_name=btcd_instance_name,
-            sources=[c.address for c in candidates], destination=address,
-            change=change_address.address,
-            preferred_blocks=5  # Anton don't like such numbers :-)
-        )
-
-        src_address_objs = []
-        for c in candidates:
-            estimate_amount += c.amount
-            src_address_objs.append(c)
-            if estimate_amount > amount + projected_fee:
-                break
-        if estimate_amount < amount + projected_fee:
-            # Insufficient funds
-            sqla_session.commit()
-            logger.error(
-                f"BTC withdrawal insufficient funds error (amount: {amount}, "
-                f"fee {projected_fee}, balance: {estimate_amount})",
-            )
-            return crypto_transaction.status
+def send_withdrawals_btc(crypto_transactions):
+    """
+    Выплаты по crypto_transactions одной транзакцией с единственной сдачей. Если средств на все не хватает,
+    отправляется наибольшее начало списка, которое удаётся оплатить
 
-        src_addresses = [x.address for x in src_address_objs]
+    :param crypto_transactions: [CryptoWithdrawTransaction, ...] в порядке очереди
+    :return: [CryptoWithdrawTransaction, ...] отправленные, в статусе PENDING
+    :raise BtcInsufficientFundsException: средств не хватает даже на первую выплату
+    """
+    btcd_instance_name = config['btcd_instance_name']
+    key_name = config['btc_masterkey_name']
+    masterkey_q = btc.MasterKey.query.filter(
+        btc.MasterKey.masterkey_name == key_name
+    )
+    masterkey = masterkey_q.one()
+
+    # the row lock serializes the withdrawals up to the commit below, otherwise concurrent /withdraw calls
+    # and the batch flush would pick the same UTXOs
+    bitcoind_instance_q = btc.BitcoindInstance.query.filter(
+        btc.BitcoindInstance.instance_name == btcd_instance_name
+    ).with_for_update()
+    bitcoind_inst = bitcoind_instance_q.one()
+
+    # bitcoind doesn't know that the inputs of recorded but not yet sent transactions are spent
+    unsent_inputs_q = btc.OutgoingTransactionInput.query.join(btc.OutgoingTransaction).filter(
+        btc.OutgoingTransaction.is_sent.is_(False),
+        btc.OutgoingTransaction.is_rejected.is_(False)
+    ).with_entities(btc.OutgoingTransactionInput.utxo_txid, btc.OutgoingTransactionInput.utxo_vout)
+
+    # inputs are chosen from the actual UTXO set, see transer.btc.coin_selection
+    utxos = btc_list_wallet_utxos(
+        bitcoind_inst=bitcoind_inst,
+        masterkey=masterkey,
+        exclude_addresses=sorted({cw_trx.address for cw_trx in crypto_transactions}),
+        exclude_outpoints=[tuple(i) for i in unsent_inputs_q]
+    )
+    feerate = btc_transaction_feerate(
+        bitcoind_inst=bitcoind_inst,
+        preferred_blocks=5  # Anton don't like such numbers :-)
+    )
+    balance = sum(u.amount for u in utxos)
 
-        # Equation 'projected_fee >= actual_fee' is always true
-        actual_fee = btc_calculate_transaction_fee(
-            bt_name=btcd_instance_name,
-            sources=[src_addresses],
-            destination=address,
-            change=change_address.address,
-            preferred_blocks=5  # Anton don't like such numbers :-)
-        )
+    batch = list(crypto_transactions)
+    while sum(cw_trx.amount for cw_trx in batch) > balance and len(batch) > 1:
+        batch.pop()
 
-        trx, _ = btc_create_transaction(
-            bt_name=bitcoind_inst.instance_name,
-            sources=src_addresses,
-            destination=address,
-            amount=amount,
-            change=change_address.address,
-            fee=actual_fee
-        )
+    while True:
+        # bitcoind accepts one output per address
+        payments = {}
+        for cw_trx in batch:
+            payments[cw_trx.address] = payments.get(cw_trx.address, decimal.Decimal(0)) + cw_trx.amount
 
-        signed_trx, _ = btc_sign_transaction(
-            bt_name=bitcoind_inst.instance_name,
-            signing_addrs=src_addresses,
-            trx=trx
-        )
+        try:
+            selection = btc_select_coins(utxos, sum(payments.values()), feerate, outputs=len(payments))
+            break
+        except BtcInsufficientFundsException:
+            logger.error(
+                f"BTC withdrawal insufficient funds error (amount: {sum(payments.values())}, "
+                f"withdrawals: {len(batch)}, feerate {feerate}, balance: {balance})",
+            )
+            if len(batch) == 1:
+                raise
+            batch.pop()
+
+    src_addresses = sorted({u.address for u in selection.utxos})
+    change_address = max(selection.utxos, key=lambda u: u.amount).address
+
+    trx, _ = btc_create_raw_transaction(
+        bitcoind_inst=bitcoind_inst,
+        utxos=selection.utxos,
+        payments=payments,
+        change=change_address,
+        change_amount=selection.change
+    )
 
-        # It would be a race condition between section starting from send_transaction() to sqla_session.commit()
-        # and monitor_transaction.get_recent_deposit_transactions(), if get_recent_deposit_transactions() taken
-        # into account transactions with num of confirmations equals to 0 (mempool/unconfirmed transactions).
-        # Doesn't actual condition now
-        txid = btc_send_transaction(
-            bt_name=bitcoind_inst.instance_name,
-            signed_trx=signed_trx
+    signed_trx_h, signed_trx = btc_sign_transaction(
+        bt_name=bitcoind_inst.instance_name,
+        signing_addrs=src_addresses,
+        trx=trx
+    )
+    txid = signed_trx['txid']
+
+    # the transaction is committed before the broadcast: if the process dies or the broadcast fails,
+    # the withdrawals stay PENDING with the known txid and broadcast_withdrawals_btc() sends the same
+    # transaction again, instead of the next flush paying them once more from other UTXOs
+    outgoing = btc.OutgoingTransaction(txid=txid, signed_trx=signed_trx_h, is_sent=False, is_rejected=False)
+    sqla_session.add(outgoing)
+    sqla_session.add_all([
+        btc.OutgoingTransactionInput(
+            outgoing=outgoing,
+            utxo_txid=u.txid,
+            utxo_vout=u.vout,
+            address=u.address,
+            amount=u.amount
         )
+        for u in selection.utxos
+    ])
 
-        crypto_transaction.status = WithdrawalStatus.PENDING.value
-        crypto_transaction.txids = [txid]
+    for cw_trx in batch:
+        cw_trx.status = WithdrawalStatus.PENDING.value
+        cw_trx.is_acknowledged = False
+        cw_trx.txids = [txid]
 
+    if selection.change > 0:
         change_address_log = btc.ChangeTransactionLog(
-            change_address=change_address.address,
+            change_address=change_address,
             change_tx_id=txid
         )
         sqla_session.add(change_address_log)
 
-        # all the funds move to change address
-        for a in src_address_objs:
-            a.amount = decimal.Decimal(0.0)
+    # the change is credited back when the transaction is confirmed, see withdrawal_status_btc()
+    src_address_objs = btc.Address.query.filter(btc.Address.address.in_(src_addresses)).all()
+    for a in src_address_objs:
+        a.amount -= sum(u.amount for u in selection.utxos if u.address == a.address)
+
+    sqla_session.commit()
+
+    # It would be a race condition between section starting from send_transaction() to sqla_session.commit()
+    # and monitor_transaction.get_recent_deposit_transactions(), if get_recent_deposit_transactions() taken
+    # into account transactions with num of confirmations equals to 0 (mempool/unconfirmed transactions).
+    # Doesn't actual condition now
+    broadcast_withdrawals_btc(bitcoind_inst, [txid])
+
+    return batch
+
+
+def broadcast_withdrawals_btc(bitcoind_inst, txids=None):
+    """
+    Отправка в сеть записанных, но ещё не отправленных транзакций выплат. Повторная отправка безопасна:
+    транзакция, уже находящаяся в mempool-е или в чейне, считается отправленной. Отвергнутые bitcoind
+    транзакции больше не отправляются, см. reject_outgoing_btc()
 
+    :param txids: только эти транзакции; None - все неотправленные
+    :return: количество отправленных транзакций
+    """
+    outgoing_q = btc.OutgoingTransaction.query.filter(
+        btc.OutgoingTransaction.is_sent.is_(False),
+        btc.OutgoingTransaction.is_rejected.is_(False)
+    )
+    if txids is not None:
+        outgoing_q = outgoing_q.filter(btc.OutgoingTransaction.txid.in_(txids))
+
+    sent = 0
+    for outgoing in outgoing_q.all():
+        try:
+            btc_send_transaction(
+                bt_name=bitcoind_inst.instance_name,
+                signed_trx=outgoing.signed_trx
+            )
+        except BtcTransactionRejectedException as e:
+            if not is_known_transaction_btc(bitcoind_inst, outgoing.txid):
+                reject_outgoing_btc(outgoing, e)
+                continue
+        except (BtcSendTransactionException, OSError, HTTPException) as e:
+            # the withdrawals remain PENDING, the broadcast is retried by periodic_check_withdraw_btc()
+            logger.error(f'BTC transaction {outgoing.txid} broadcast failed: {e!r}')
+            continue
+
+        outgoing.is_sent = True
         sqla_session.commit()
-        return crypto_transaction.status
+        sent += 1
+    return sent
+
+
+def is_known_transaction_btc(bitcoind_inst, txid):
+    """
+    bitcoind отвергает и уже подтверждённую транзакцию, если её выходы потрачены ("missing inputs")
+
+    :return: True, если транзакция есть в mempool-е или в чейне
+    """
+    try:
+        btc_get_txid_status(bt_name=bitcoind_inst.instance_name, txid=txid)
+    except BtcMonitorTransactionException:
+        return False
+    return True
+
+
+def reject_outgoing_btc(outgoing, reason):
+    """
+    Транзакция выплат, которую bitcoind никогда не примет: её выплаты переводятся в FAILED,
+    потраченное с адресов возвращается, а её входы снова доступны для следующих выплат
+
+    :param outgoing: instance of btc.OutgoingTransaction
+    :param reason: исключение, с которым транзакция отвергнута
+    """
+    logger.error(f'BTC transaction {outgoing.txid} rejected, its withdrawals failed: {reason!r}')
+
+    # same lock as in send_withdrawals_btc(), address amounts are changed under it
+    btc.BitcoindInstance.query.filter(
+        btc.BitcoindInstance.instance_name == config['btcd_instance_name']
+    ).with_for_update().one()
+
+    outgoing.is_rejected = True
+
+    crypto_transaction_q = transaction.CryptoWithdrawTransaction.query.filter(
+        transaction.CryptoWithdrawTransaction.txids.contains([outgoing.txid]),
+        transaction.CryptoWithdrawTransaction.status == WithdrawalStatus.PENDING.value
+    )
+    for cw_trx in crypto_transaction_q:
+        cw_trx.status = WithdrawalStatus.FAILED.value
+        cw_trx.is_acknowledged = False
+
+    inputs_q = btc.OutgoingTransactionInput.query.filter(
+        btc.OutgoingTransactionInput.outgoing_ref == outgoing.id
+    )
+    spent = {}
+    for i in inputs_q:
+        spent[i.address] = spent.get(i.address, decimal.Decimal(0)) + i.amount
+
+    for a in btc.Address.query.filter(btc.Address.address.in_(spent.keys())):
+        a.amount += spent[a.address]
+
+    btc.ChangeTransactionLog.query.filter(
+        btc.ChangeTransactionLog.change_tx_id == outgoing.txid
+    ).delete(synchronize_session=False)
+
+    sqla_session.commit()
+
+
+def backlog_flush_withdraw_btc():
+    queued_transactions_q = transaction.CryptoWithdrawTransaction.query.filter(
+        transaction.CryptoWithdrawTransaction.status == types.WithdrawalStatus.PREPENDING.value,
+        transaction.CryptoWithdrawTransaction.currency == types.CryptoCurrency.BITCOIN.value
+    )
+    return queued_transactions_q.count()
+
+
+def periodic_flush_withdraw_btc():
+    """
+    Отправка накопленных (PREPENDING) BTC выплат одной транзакцией - когда их набралось config['btc_batch_size']
+    или самая старая ждёт дольше config['btc_batch_interval'] секунд
+
+    :return: количество отправленных выплат
+    """
+    batch_size = config.get('btc_batch_size', 100)
+
+    queued_transactions_q = transaction.CryptoWithdrawTransaction.query.filter(
+        transaction.CryptoWithdrawTransaction.status == types.WithdrawalStatus.PREPENDING.value,
+        transaction.CryptoWithdrawTransaction.currency == types.CryptoCurrency.BITCOIN.value
+    ).order_by(
+        asc(transaction.CryptoWithdrawTransaction.timestamp),
+        asc(transaction.CryptoWithdrawTransaction.id)
+    ).limit(batch_size).with_for_update(skip_locked=True)
+    queued_transactions = queued_transactions_q.all()
+
+    if len(queued_transactions) == 0:
+        sqla_session.commit()
+        return 0
+
+    waiting = (datetime.now(timezone.utc) - queued_transactions[0].timestamp).total_seconds()
+    if len(queued_transactions) < batch_size and waiting < config['btc_batch_interval']:
+        sqla_session.commit()
+        return 0
+
+    try:
+        sent = send_withdrawals_btc(queued_transactions)
+    except BtcInsufficientFundsException:
+        # the head of the queue can't be paid at all, don't let it block the rest
+        queued_transactions[0].status = WithdrawalStatus.FAILED.value
+        queued_transactions[0].is_acknowledged = False
+        sqla_session.commit()
+        return 0
+
+    sqla_session.commit()   # releases the rows left in the queue
+    return len(sent)
 
 
 def withdrawal_status_btc(crypto_transaction):
     btcd_instance_name = config['btcd_instance_name']
 
+    if crypto_transaction.status == WithdrawalStatus.PREPENDING.value:
+        return  # queued, see periodic_flush_withdraw_btc()
+
     try:
         txid = crypto_transaction.txids[0]  # in btc, only one txid per transaction
     except (KeyError, TypeError):
         return WithdrawalStatus.FAILED.value
 
-    tx_info = btc_get_txid_status(
-        bt_name=btcd_instance_name,
-        txid=txid
-    )
+    try:
+        tx_info = btc_get_txid_status(
+            bt_name=btcd_instance_name,
+            txid=txid
+        )
+    except BtcMonitorTransactionException as e:
+        # e.g. not broadcast yet, see broadcast_withdrawals_btc()
+        logger.warning(f'BTC withdrawal transaction {txid} status is unknown: {e!r}')
+        return
 
     if crypto_transaction.status == WithdrawalStatus.COMPLETED.value:
         return
@@ -197,7 +394,20 @@ def withdrawal_status_btc(crypto_transaction):
         change_tx_q = btc.ChangeTransactionLog.query.filter(
             btc.ChangeTransactionLog.change_tx_id == txid
         )
-        change_tx = change_tx_q.one()
+        change_tx = change_tx_q.one_or_none()
+        if change_tx is None:   # changeless transaction
+            return
+
+        # a batch transaction pays several withdrawals, its change is credited with the first one completed
+        completed_q = transaction.CryptoWithdrawTransaction.query.filter(
+            transaction.CryptoWithdrawTransaction.txids.contains([txid]),
+            transaction.CryptoWithdrawTransaction.status.in_([
+                WithdrawalStatus.COMPLETED.value, WithdrawalStatus.COMPLETED_CHARGED.value
+            ]),
+            transaction.CryptoWithdrawTransaction.id != crypto_transaction.id
+        )
+        if completed_q.count() > 0:
+            return
 
         txs = tx_info['vout']
         addrs = {t['scriptPubKey']['addresses'][0]: t['value'] for t in txs}
@@ -214,7 +424,28 @@ def withdrawal_status_btc(crypto_transaction):
         crypto_transaction.is_acknowledged = False
 
 
+def pending_withdrawals(currency):
+    pending_transactions_q = transaction.CryptoWithdrawTransaction.query.filter(
+        transaction.CryptoWithdrawTransaction.status == types.WithdrawalStatus.PENDING.value,
+        transaction.CryptoWithdrawTransaction.currency == currency.value
+    )
+    return pending_transactions_q.count()
+
+
+def backlog_withdraw_btc():
+    return pending_withdrawals(types.CryptoCurrency.BITCOIN)
+
+
+def backlog_withdraw_eth():
+    return pending_withdrawals(types.CryptoCurrency.ETHERIUM)
+
+
 def periodic_check_withdraw_btc():
+    bitcoind_instance_q = btc.BitcoindInstance.query.filter(
+        btc.BitcoindInstance.instance_name == config['btcd_instance_name']
+    )
+    broadcast_withdrawals_btc(bitcoind_instance_q.one())
+
     crypto_transaction_q = transaction.CryptoWithdrawTransaction.query.filter(
         transaction.CryptoWithdrawTransaction.status == types.WithdrawalStatus.PENDING.value,
         transaction.CryptoWithdrawTransaction.currency == types.CryptoCurrency.BITCOIN.value
@@ -227,8 +458,32 @@ def periodic_check_withdraw_btc():
 
     sqla_session.commit()
 
+    return len(crypto_transactions)
+
+
+def same_hash(a, b):
+    """
+    Сравнение hex hash-ей без учёта регистра и префикса 0x
+    """
+    return a.lower().replace('0x', '', 1) == b.lower().replace('0x', '', 1)
+
+
+def matured_blocks_eth(crypto_transactions, tip_block_num):
+    """
+    Блоки транзакций, набравших 12 подтверждений, одним batch-ем - для проверки, что они остались в основной цепочке
+
+    :return: {block_num: блок с транзакциями}
+    """
+    block_nums = {
+        n for cw_trx in crypto_transactions for n in cw_trx.block_nums or []
+        if n is not None and tip_block_num - n >= 12
+    }
+    return {b['number']: b for b in eth_get_blocks(config['ethd_instance_uri'], sorted(block_nums))}
+
 
 def periodic_check_withdraw_eth():
+    ethd_instance_uri = config['ethd_instance_uri']
+
     crypto_transaction_q = transaction.CryptoWithdrawTransaction.query.filter(
         transaction.CryptoWithdrawTransaction.status == types.WithdrawalStatus.PENDING.value,
         transaction.CryptoWithdrawTransaction.currency == types.CryptoCurrency.ETHERIUM.value
@@ -236,11 +491,16 @@ def periodic_check_withdraw_eth():
 
     crypto_transactions = crypto_transaction_q.all()
 
+    tip_block_num = eth_current_block_number(ethd_instance_uri)   # the only tip read of the cycle
+    matured_blocks = matured_blocks_eth(crypto_transactions, tip_block_num)
+
     for cw_trx in crypto_transactions:
-        withdrawal_status_eth(cw_trx)
+        withdrawal_status_eth(cw_trx, tip_block_num, matured_blocks)
 
     sqla_session.commit()
 
+    return len(crypto_transactions)
+
 
 def withdraw_eth(u_txid, address, amount):
     """
@@ -307,7 +567,7 @@ def withdraw_eth(u_txid, address, amount):
             sqla_session.commit()
             return crypto_transaction.status
 
-        tx_ids = []
+        signing_calls = []
         for s, a in spendables.items():
             utx_h = eth_create_transaction(
                 web3_url=ethd_instance_uri,
@@ -317,13 +577,18 @@ def withdraw_eth(u_txid, address, amount):
                 gas_price=gas_price
             )
 
-            stx_h = eth_sign_transaction(
-                src_addr=s.address,
-                priv_key=s.get_priv_key(),
-                unsigned_tx_h=utx_h,
-                network_id=masterkey.network_id
-            )
+            signing_calls.append((eth_sign_transaction, {
+                'src_addr': s.address,
+                'priv_key': s.get_priv_key(),
+                'unsigned_tx_h': utx_h,
+                'network_id': masterkey.network_id
+            }))
 
+        # all the transactions are signed within one round trip to signing node
+        signed_txs = jsonrpc_batch(signing_calls)
+
+        tx_ids = []
+        for stx_h in signed_txs:
             tx_id = eth_send_transaction(
                 web3_url=ethd_instance_uri,
                 signed_tx_h=stx_h
@@ -331,39 +596,72 @@ def withdraw_eth(u_txid, address, amount):
             tx_ids.append(tx_id)
 
         crypto_transaction.txids = tx_ids
+        crypto_transaction.block_nums = [None] * len(tx_ids)
+        crypto_transaction.block_hashes = [None] * len(tx_ids)
         crypto_transaction.status = types.WithdrawalStatus.PENDING.value
 
         sqla_session.commit()
         return crypto_transaction.status
 
 
-def withdrawal_status_eth(crypto_transaction):
+def withdrawal_status_eth(crypto_transaction, tip_block_num=None, matured_blocks=None):
+    """
+    Подтверждения считаются по сохранённому блоку транзакции; у узла транзакция запрашивается,
+    только если блок ещё не известен или ушёл из основной цепочки
+
+    :param tip_block_num: номер последнего блока в чейне, запрашивается, если не задан
+    :param matured_blocks: см. matured_blocks_eth()
+    """
     ethd_instance_uri = config['ethd_instance_uri']
+    if tip_block_num is None:
+        tip_block_num = eth_current_block_number(ethd_instance_uri)
+        matured_blocks = matured_blocks_eth([crypto_transaction], tip_block_num)
     pending_txids = crypto_transaction.txids[:]
     completed_txids = crypto_transaction.completed_txids[:]
 
-    complete_c = len(pending_txids)
-    for txid in pending_txids[:]:
-        try:
-            tx = eth_get_transaction(web3_url=ethd_instance_uri, tx_hash=txid)
-        except EthMonitorTransactionException:
-            # one of transactions was unsuccessful / disappeared so there is partial withdrawing
-            # and payment transaction will remain PENDING until manual investigation
-            pass
-        if tx['confirmations'] >= 12:
-            address = eth.Address.query.filter(
-                eth.Address.address == tx['from'].lower()
-            ).one()
-            address.amount -= tx['value'] / eth_divider
-
-            complete_c -= 1
-            completed_txids.append(txid)
-            pending_txids.remove(txid)
+    # rows written before blocks were recorded have no block_nums/block_hashes
+    unknown_blocks = [None] * (len(pending_txids) - len(crypto_transaction.block_nums or []))
+    block_nums = (crypto_transaction.block_nums or []) + unknown_blocks
+    block_hashes = (crypto_transaction.block_hashes or []) + unknown_blocks
+
+    still_pending = []
+    for txid, block_num, block_hash in zip(pending_txids, block_nums, block_hashes):
+        if block_num is not None and tip_block_num - block_num < 12:
+            still_pending.append((txid, block_num, block_hash))
+            continue
+
+        tx = None
+        block = matured_blocks.get(block_num)
+        if block is not None and block['hash'] == block_hash:
+            tx = next((x for x in block['transactions'] if same_hash(x['hash'], txid)), None)
+
+        if tx is None:
+            # not mined when last checked, the recorded block is orphaned or doesn't list the transaction
+            try:
+                tx = eth_get_transaction(web3_url=ethd_instance_uri, tx_hash=txid)
+            except EthMonitorTransactionException:
+                # one of transactions was unsuccessful / disappeared so there is partial withdrawing
+                # and payment transaction will remain PENDING until manual investigation
+                still_pending.append((txid, None, None))
+                continue
+
+            if tx['confirmations'] < 12:
+                still_pending.append((txid, tx['blockNumber'], tx['blockHash']))
+                continue
+
+        address = eth.Address.query.filter(
+            eth.Address.address == tx['from'].lower()
+        ).one()
+        address.amount -= tx['value'] / eth_divider
+
+        completed_txids.append(txid)
 
     # deep update whole sqla.ARRAY as alternative
     # to Mutation Tracking http://docs.sqlalchemy.org/en/latest/orm/extensions/mutable.html
     crypto_transaction.completed_txids = completed_txids
-    crypto_transaction.txids = pending_txids
+    crypto_transaction.txids = [x[0] for x in still_pending]
+    crypto_transaction.block_nums = [x[1] for x in still_pending]
+    crypto_transaction.block_hashes = [x[2] for x in still_pending]
 
-    if complete_c == 0:
+    if len(still_pending) == 0:
         crypto_transaction.status = types.WithdrawalStatus.COMPLETED.value
@@ -122,6 +122,20 @@ def withdrawal_status_endpoint(sync_request):
     return json_response(resp_data)
 
 
+def backlog_send_withdraw():
+    unacknowledged_transactions_q = transaction.CryptoWithdrawTransaction.query.filter(
+        transaction.CryptoWithdrawTransaction.is_acknowledged.is_(False)
+    )
+    return unacknowledged_transactions_q.count()
+
+
+def backlog_send_deposit():
+    unacknowledged_transactions_q = transaction.CryptoDepositTransaction.query.filter(
+        transaction.CryptoDepositTransaction.is_acknowledged.is_(False)
+    )
+    return unacknowledged_transactions_q.count()
+
+
 def periodic_send_withdraw():
     withdraw_notification_endpoint = config['withdraw_notification_endpoint']
 
@@ -160,6 +174,8 @@ def periodic_send_withdraw():
 
     sqla_session.commit()
 
+    return len(unacknowledged_transactions)
+
 
 def periodic_send_deposit():
     deposit_notification_endpoint = config['deposit_notification_endpoint']
@@ -202,3 +218,5 @@ def periodic_send_deposit():
                 t.is_acknowledged = True
 
     sqla_session.commit()
+
+    return len(unacknowledged_transactions)
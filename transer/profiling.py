@@ -0,0 +1,54 @@
+import os
+import re
+import time
+import random
+import logging
+import cProfile
+import itertools
+
+from transer import config
+
+logger = logging.getLogger('profiling')
+
+_dump_numbers = itertools.count()     # next() is atomic under the GIL, see profile_path()
+
+
+def profile_path(tag):
+    safe_tag = re.sub(r'[^\w.-]+', '_', tag)
+    timestamp = time.strftime('%Y%m%d-%H%M%S')
+    # slow calls of different threads may finish within the same second
+    return os.path.join(config['profile_dir'], f'{safe_tag}-{timestamp}-{os.getpid()}-{next(_dump_numbers)}.prof')
+
+
+def profiled(tag, func, *args, **kwargs):
+    """
+    Выборочное профилирование: config['profile_sample_rate'] доля вызовов исполняется под cProfile,
+    профиль сохраняется в config['profile_dir'] только если вызов длился дольше config['profile_threshold'] секунд.
+    Профили читаются через pstats/snakeviz, например: python -m pstats <file>.prof
+
+    :param tag: имя метода/задачи, попадает в имя файла профиля
+    """
+    if not config.get('profile_dir') or random.random() >= config.get('profile_sample_rate', 0.0):
+        return func(*args, **kwargs)
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # another profiler is active in this thread
+        return func(*args, **kwargs)
+
+    started = time.monotonic()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        duration = time.monotonic() - started
+
+        if duration >= config.get('profile_threshold', 5.0):
+            path = profile_path(tag)
+            try:
+                os.makedirs(config['profile_dir'], exist_ok=True)
+                profiler.dump_stats(path)
+                logger.warning(f'{tag} took {duration:.3f}s, profile saved to {path}')
+            except OSError as e:
+                logger.error(f'{tag} profile cannot be saved to {path}: {e}')
@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import threading
+
+TRANSER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# frames of these files are RPC plumbing, the caller is searched above them
+PLUMBING_FILES = {
+    os.path.join(TRANSER_DIR, 'rpc_stats.py'),
+    os.path.join(TRANSER_DIR, 'utils.py'),
+    os.path.join(TRANSER_DIR, 'chain_cache.py'),
+    os.path.join(TRANSER_DIR, 'btc', 'rpc_client.py'),
+    os.path.join(TRANSER_DIR, 'eth', 'rpc_client.py'),
+}
+
+_local = threading.local()
+
+# {(backend, method, caller): stats}, see record()
+REQUESTS, CALLS, ERRORS, SECONDS, REQUEST_BYTES, RESPONSE_BYTES = range(6)
+
+
+def reset():
+    _local.calls = {}
+
+
+def drain():
+    """
+    :return: статистика RPC вызовов, накопленная текущим потоком с последнего reset()/drain()
+    """
+    calls = getattr(_local, 'calls', {})
+    _local.calls = {}
+    return calls
+
+
+def caller():
+    """
+    :return: ближайшая по стеку функция transer, не относящаяся к RPC клиентам,
+        например btc.monitor_transaction.get_txids_status
+    """
+    frame = sys._getframe(1)    # pylint: disable=W0212
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(TRANSER_DIR) and filename not in PLUMBING_FILES:
+            module = os.path.splitext(os.path.relpath(filename, TRANSER_DIR))[0].replace(os.sep, '.')
+            return f'{module}.{frame.f_code.co_name}'
+        frame = frame.f_back
+    return 'unknown'
+
+
+def record(backend, method, started, request_bytes, response_bytes, errors=0, calls=1):
+    """
+    Учёт одного HTTP запроса к RPC серверу
+
+    :param backend: bitcoind, geth или signer
+    :param method: RPC метод; для batch запроса - уникальные методы через '+'
+    :param started: time.monotonic() перед отправкой запроса
+    :param errors: количество неуспешных вызовов
+    :param calls: количество вызовов в batch запросе
+    """
+    key = (backend, method, caller())
+    stats = getattr(_local, 'calls', None)
+    if stats is None:
+        stats = _local.calls = {}
+
+    s = stats.setdefault(key, [0, 0, 0, 0.0, 0, 0])
+    s[REQUESTS] += 1
+    s[CALLS] += calls
+    s[ERRORS] += errors
+    s[SECONDS] += time.monotonic() - started
+    s[REQUEST_BYTES] += request_bytes
+    s[RESPONSE_BYTES] += response_bytes
+
+
+def merge(calls, caller_name):
+    """
+    Учёт в текущем потоке статистики, собранной в другом потоке (см. drain())
+
+    :param caller_name: функция, от имени которой делались вызовы
+    """
+    stats = getattr(_local, 'calls', None)
+    if stats is None:
+        stats = _local.calls = {}
+
+    for (backend, method, _), s in calls.items():
+        merged = stats.setdefault((backend, method, caller_name), [0, 0, 0, 0.0, 0, 0])
+        for i, v in enumerate(s):
+            merged[i] += v
+
+
+def count_errors(response):
+    """
+    :param response: декодированный JSON-RPC ответ, одиночный или batch
+    """
+    responses = response if isinstance(response, list) else [response]
+    return sum(1 for r in responses if isinstance(r, dict) and r.get('error') is not None)
+
+
+def batch_method(methods):
+    return '+'.join(sorted(set(methods)))
+
+
+def total_calls(calls):
+    return sum(s[CALLS] for s in calls.values())
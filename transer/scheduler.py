@@ -0,0 +1,218 @@
+import asyncio
+import functools
+import logging
+import random
+import time
+
+from transer import metrics
+from transer.db import sqla_session
+from transer.utils import submit
+
+logger = logging.getLogger('scheduler')
+
+periodic_tasks = {}     # {name: PeriodicTask}, see /metrics
+
+
+def run_probes(tip_probe, backlog_probe):
+    """
+    Исполняется в executor-е перед запуском периодической задачи
+
+    :return: (tip, backlog) - идентификатор вершины чейна (hash/номер блока) и количество необработанных элементов
+    """
+    try:
+        tip = tip_probe() if tip_probe is not None else None
+        backlog = backlog_probe() if backlog_probe is not None else 0
+    finally:
+        sqla_session.close()    # don't keep the read transaction open between runs
+    return tip, backlog
+
+
+class PeriodicTask(object):
+    """
+    Периодическая задача с фиксированным темпом запусков (длительность запуска не сдвигает последующие),
+    без наложения запусков друг на друга и с адаптивным интервалом:
+    - запуск пропускается, если вершина чейна (tip_probe) не изменилась с прошлого запуска,
+      но не реже чем раз в max_interval;
+    - при наличии необработанных элементов (backlog_probe) интервал сокращается до min_interval,
+      в простое - растёт вдвое до max_interval;
+    - запуск дольше deadline секунд считается просроченным: задача его больше не ждёт, но executor
+      не может прервать вызов, поэтому следующие запуски пропускаются, пока просроченный не завершится
+    """
+
+    def __init__(self, func, args, kwargs, interval, *, loop, executor, name=None, wakeup=None,
+                 jitter=0.0, deadline=None, min_interval=None, max_interval=None,
+                 tip_probe=None, backlog_probe=None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.name = name or f'{func.__module__}.{func.__name__}'
+
+        self.loop = loop
+        self.executor = executor
+        self.wakeup = wakeup
+
+        self.interval = interval
+        self.min_interval = min_interval if min_interval is not None else interval
+        self.max_interval = max_interval if max_interval is not None else interval
+        self.current_interval = interval
+        self.jitter = jitter
+        self.deadline = deadline
+        self.overdue = None     # asyncio.Future of the run that has exceeded the deadline
+
+        self.tip_probe = tip_probe
+        self.backlog_probe = backlog_probe
+        self.last_tip = None
+
+        self.stats = {
+            'runs': 0,
+            'skips': 0,
+            'failures': 0,
+            'overruns': 0,
+            'backlog': 0,
+            'last_run_at': None,
+            'last_duration': None,
+            'last_result': None,
+            'interval': interval,
+        }
+
+    async def submit(self, func, *args, **kwargs):
+        return await submit(self.executor, func, *args, **kwargs)
+
+    async def probe(self):
+        if self.tip_probe is None and self.backlog_probe is None:
+            return None, 0
+        try:
+            return await self.submit(run_probes, self.tip_probe, self.backlog_probe)
+        except Exception as e:
+            logger.error(f'{self.name} probes failed: {e}')
+            return None, 0
+
+    def overdue_done(self, future):
+        if not future.cancelled() and future.exception() is None:   # failures are reported by subprocess_wrapper()
+            logger.warning(f'{self.name} overdue run finished')
+
+    async def run_once(self):
+        """
+        :return: False, если запуск пропущен из-за незавершённого просроченного запуска
+        """
+        if self.overdue is not None:
+            if not self.overdue.done():
+                self.stats['skips'] += 1
+                metrics.periodic_task_runs.inc(task=self.name, outcome='overdue')
+                logger.warning(f'{self.name} skipped, the overdue run is still in progress')
+                return False
+            self.overdue = None
+
+        started = self.loop.time()
+        self.stats['last_run_at'] = time.time()
+        outcome = 'success'
+        run = asyncio.ensure_future(self.submit(self.func, *self.args, **self.kwargs), loop=self.loop)
+        try:
+            self.stats['last_result'] = await asyncio.wait_for(
+                asyncio.shield(run, loop=self.loop), self.deadline, loop=self.loop
+            )
+        except asyncio.TimeoutError:
+            self.stats['overruns'] += 1
+            self.overdue = run
+            run.add_done_callback(self.overdue_done)
+            outcome = 'overdue'
+        except asyncio.CancelledError:
+            run.cancel()
+            raise
+        except Exception:
+            self.stats['failures'] += 1    # already reported by subprocess_wrapper()
+            outcome = 'failure'
+        finally:
+            duration = self.loop.time() - started
+            self.stats['runs'] += 1
+            self.stats['last_duration'] = duration
+
+        metrics.periodic_task_runs.inc(task=self.name, outcome=outcome)
+        metrics.periodic_task_duration.observe(duration, task=self.name)
+        metrics.periodic_task_last_run.set(self.stats['last_run_at'], task=self.name)
+        metrics.periodic_task_last_duration.set(duration, task=self.name)
+        if isinstance(self.stats['last_result'], int):     # periodic functions return number of processed items
+            metrics.periodic_task_items.set(self.stats['last_result'], task=self.name)
+
+        if outcome == 'overdue':
+            logger.error(f'{self.name} run exceeded the {self.deadline}s deadline, next runs wait for it to finish')
+        else:
+            logger.debug(f'{self.name} run took {duration:.3f}s')
+        return True
+
+    def adapt_interval(self, backlog):
+        if backlog:
+            self.current_interval = self.min_interval
+        else:
+            self.current_interval = min(max(self.current_interval * 2, self.interval), self.max_interval)
+        self.stats['interval'] = self.current_interval
+
+    async def wait(self, delay):
+        """
+        :return: True если задачу разбудил wakeup
+        """
+        if self.wakeup is None:
+            await asyncio.sleep(delay, loop=self.loop)
+            return False
+
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), delay, loop=self.loop)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def run_forever(self):
+        # spread the tasks started simultaneously
+        await asyncio.sleep(random.uniform(0, self.jitter * self.interval), loop=self.loop)
+
+        woken = False
+        last_run_at = None
+        while True:
+            started = self.loop.time()
+            if self.wakeup is not None:
+                self.wakeup.clear()     # notifications arrived during the run will trigger the next one immediately
+
+            tip, backlog = await self.probe()
+            self.stats['backlog'] = backlog
+            metrics.periodic_task_backlog.set(backlog, task=self.name)
+
+            forced = woken or last_run_at is None or started - last_run_at >= self.max_interval
+            if tip is not None and tip == self.last_tip and not forced:
+                self.stats['skips'] += 1
+                metrics.periodic_task_runs.inc(task=self.name, outcome='skipped')
+                logger.debug(f'{self.name} skipped, chain tip {tip} has not moved')
+            elif await self.run_once():
+                last_run_at = started
+                self.last_tip = tip
+
+            self.adapt_interval(backlog)
+
+            jitter = random.uniform(-self.jitter, self.jitter) * self.current_interval
+            delay = self.current_interval + jitter - (self.loop.time() - started)
+            woken = await self.wait(max(delay, 0))
+
+
+def delayed_schedule(func, args=None, kwargs=None, interval=60, wakeup=None, *, loop, executor, **options):
+    """
+    :param wakeup: asyncio.Event, выставление которого (например, по приходу нового блока)
+        запускает задачу не дожидаясь окончания interval
+    :param options: см. PeriodicTask
+    """
+    task = PeriodicTask(
+        func,
+        args if args is not None else [],
+        kwargs if kwargs is not None else {},
+        interval,
+        loop=loop,
+        executor=executor,
+        wakeup=wakeup,
+        **options
+    )
+    periodic_tasks[task.name] = task
+    return loop.create_task(task.run_forever())
+
+
+def create_delayed_scheduler(loop=None, executor=None):
+    if loop is not None and executor is not None:
+        return functools.partial(delayed_schedule, loop=loop, executor=executor)
+    return None
@@ -1,8 +1,10 @@
 from datetime import datetime
 import decimal
 import unittest
+import uuid
+from unittest import mock
 
-from transer import utils
+from transer import utils, config
 from transer import db
 from transer import exceptions
 from transer.db import btc, sqla_session
@@ -10,6 +12,10 @@ from transer.db import btc, sqla_session
 from transer.btc.validate_addresses import validate_addrs
 from transer.btc.create_transaction import create_raw_transaction
 from transer.btc.sign_transaction import sign_raw_transaction
+from transer.btc import coin_selection
+from transer.btc.monitor_transaction import filter_deposit_candidates
+from transer.orchestrator import deposit, withdraw
+from transer.types import CryptoCurrency, DepositStatus, WithdrawalStatus
 
 
 class TestCaseMixin:
@@ -38,14 +44,7 @@ class TestCaseMixin:
             treat_as_testnet=True
         )
 
-        bi = db.btc.BitcoindInstance(
-            instance_name='Test',
-            hostname='127.0.0.1',
-            port=18332,
-            rpc_user='dummy',
-            rpc_passwd='dummy',
-            is_https=False
-        )
+        bi = db.btc.BitcoindInstance(instance_name='Test')
 
         sqla_session.add_all([masterkey, bi])
         sqla_session.commit()
@@ -317,3 +316,397 @@ class TransactionSignTest(unittest.TestCase, TestCaseMixin):
                 signing_addrs=addresses,
                 trx_h=trx_h
             )
+
+
+class DepositSqlTest(unittest.TestCase, TestCaseMixin):
+    addresses = ['mtqw5xbgwQXvRB5yhLCvRnUnMBDprVuheY', 'msvaDqBXUfR89QYRq7yZBJE7PtTrNiSTMb']
+
+    @classmethod
+    def setUpClass(cls):
+        cls.init_db()
+        cls.init_with_data()
+
+        connection = cls.engine.connect()
+        connection.execute(f'TRUNCATE {db.transaction.CryptoDepositTransaction.__table__.fullname};')
+        connection.close()
+
+        bi = db.btc.BitcoindInstance.query.filter_by(instance_name='Test').one()
+        sqla_session.add_all([
+            db.btc.Address(bitcoind_inst=bi, crypto_path='0', crypto_number=n, address=a, is_populated=True)
+            for n, a in enumerate(cls.addresses)
+        ])
+        sqla_session.add(db.btc.ChangeTransactionLog(change_address=cls.addresses[1], change_tx_id='change_tx'))
+        sqla_session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        sqla_session.remove()     # the open transaction would block dropping the schemas by the next test case
+
+    def amounts(self):
+        sqla_session.expire_all()
+        return {a.address: a.amount for a in db.btc.Address.query.filter(db.btc.Address.address.in_(self.addresses))}
+
+    def test_001_filter_deposit_candidates(self):
+        bi = db.btc.BitcoindInstance.query.filter_by(instance_name='Test').one()
+        receive_txs = [
+            {'txid': 'tx1', 'address': self.addresses[0]},
+            {'txid': 'tx2', 'address': 'mqU8DCkXC2w5BjQejeKoeY9jM2a4V3uEub'},  # not a wallet address
+            {'txid': 'change_tx', 'address': self.addresses[1]},
+            {'txid': 'tx3', 'address': self.addresses[1]}
+        ]
+
+        res = filter_deposit_candidates(bi, receive_txs)
+        self.assertEqual([x['txid'] for x in res], ['tx1', 'tx3'])
+
+    def test_005_ingest_deposits(self):
+        deposits = [
+            (self.addresses[0], 'tx1', decimal.Decimal('0.1'), DepositStatus.COMPLETED, 100, 'block100'),
+            (self.addresses[0], 'tx2', decimal.Decimal('0.2'), DepositStatus.PENDING, None, None),
+            (self.addresses[1], 'tx3', decimal.Decimal('0.3'), DepositStatus.PENDING, 101, 'block101')
+        ]
+
+        credits = deposit.ingest_deposits(CryptoCurrency.BITCOIN, deposits)
+        self.assertEqual(credits, [(self.addresses[0], decimal.Decimal('0.1'))])
+
+        # already recorded deposits are skipped
+        credits = deposit.ingest_deposits(CryptoCurrency.BITCOIN, deposits)
+        self.assertEqual(credits, [])
+        sqla_session.commit()
+
+        self.assertEqual(db.transaction.CryptoDepositTransaction.query.count(), 3)
+
+    def test_010_apply_deposit_transitions(self):
+        pending = {
+            t.txid: t.id for t in db.transaction.CryptoDepositTransaction.query.filter_by(
+                status=DepositStatus.PENDING.value
+            )
+        }
+        transitions = [(pending['tx2'], DepositStatus.COMPLETED), (pending['tx3'], DepositStatus.CANCELLED)]
+
+        credits = deposit.apply_deposit_transitions(transitions)
+        self.assertEqual(credits, [(self.addresses[0], decimal.Decimal('0.2'))])
+
+        # the deposits are not PENDING anymore
+        self.assertEqual(deposit.apply_deposit_transitions(transitions), [])
+        sqla_session.commit()
+
+    def test_015_credit_deposits(self):
+        deposit.credit_deposits(db.btc.Address, [
+            (self.addresses[0], decimal.Decimal('0.1')),
+            (self.addresses[0], decimal.Decimal('0.2')),
+            (self.addresses[1], decimal.Decimal('0.05'))
+        ])
+        sqla_session.commit()
+
+        amounts = self.amounts()
+        self.assertEqual(amounts[self.addresses[0]], decimal.Decimal('0.3'))
+        self.assertEqual(amounts[self.addresses[1]], decimal.Decimal('0.05'))
+
+    def test_020_credit_deposits_unknown_address(self):
+        with self.assertRaises(exceptions.TransactionInconsistencyError):
+            deposit.credit_deposits(db.btc.Address, [
+                (self.addresses[0], decimal.Decimal('1.0')),
+                ('mqU8DCkXC2w5BjQejeKoeY9jM2a4V3uEub', decimal.Decimal('1.0'))
+            ])
+
+        # nothing is credited
+        self.assertEqual(self.amounts()[self.addresses[0]], decimal.Decimal('0.3'))
+
+
+class WithdrawBatchTest(unittest.TestCase, TestCaseMixin):
+    """
+    Пакетные выплаты без узла: обращения к bitcoind подменены
+    """
+    sources = ['mtqw5xbgwQXvRB5yhLCvRnUnMBDprVuheY', 'msvaDqBXUfR89QYRq7yZBJE7PtTrNiSTMb']
+    destinations = ['mqU8DCkXC2w5BjQejeKoeY9jM2a4V3uEub', 'muXB2duZRxARUjK4vTdmQEUm9P5kGXwYjn',
+                    'mohtHWsyJEigxbZu2ER8ctgfQ1dCNWxzBx']
+    feerate = decimal.Decimal('0.0001')
+
+    @classmethod
+    def setUpClass(cls):
+        cls.init_db()
+        cls.init_with_data()
+
+        bi = db.btc.BitcoindInstance.query.filter_by(instance_name='Test').one()
+        sqla_session.add_all([
+            db.btc.Address(bitcoind_inst=bi, crypto_path='0', crypto_number=n, address=a, is_populated=True,
+                           amount=decimal.Decimal('1.0'))
+            for n, a in enumerate(cls.sources)
+        ])
+        sqla_session.commit()
+
+        config['btcd_instance_name'] = 'Test'
+        config['btc_masterkey_name'] = 'electrum'
+        config['btc_batch_interval'] = 0
+        config['btc_batch_size'] = 100
+
+    def setUp(self):
+        connection = self.engine.connect()
+        connection.execute(f'TRUNCATE {db.transaction.CryptoWithdrawTransaction.__table__.fullname};')
+        connection.execute(f'TRUNCATE {db.btc.OutgoingTransaction.__table__.fullname} CASCADE;')
+        connection.execute(f'TRUNCATE {db.btc.ChangeTransactionLog.__table__.fullname};')
+        connection.close()
+
+        db.btc.Address.query.filter(db.btc.Address.address.in_(self.sources))\
+            .update({'amount': decimal.Decimal('1.0')}, synchronize_session=False)
+        sqla_session.commit()
+
+        self.created = []
+        self.sent = []
+        self.attempts = 0
+
+    def tearDown(self):
+        sqla_session.remove()
+
+    def utxos(self, *amounts):
+        return [
+            coin_selection.Utxo(f'utxo{i}', 0, self.sources[i % 2], decimal.Decimal(a)) for i, a in enumerate(amounts)
+        ]
+
+    def node(self, utxos, send_error=None):
+        """
+        :return: mock.patch.multiple подменяющий обращения withdraw к bitcoind
+        """
+        def create(bitcoind_inst, utxos, payments, change=None, change_amount=decimal.Decimal(0)):
+            self.created.append({
+                'utxos': utxos, 'payments': payments, 'change': change, 'change_amount': change_amount
+            })
+            return f'raw{len(self.created)}', None
+
+        def sign(bt_name, signing_addrs, trx):
+            return f'signed_{trx}', {'txid': f'txid_{trx}'}
+
+        def send(bt_name, signed_trx):
+            self.attempts += 1
+            if send_error is not None:
+                raise send_error
+            self.sent.append(signed_trx)
+            return signed_trx.replace('signed_', 'txid_')
+
+        def list_utxos(exclude_outpoints=(), **kwargs):
+            return [u for u in utxos if (u.txid, u.vout) not in set(exclude_outpoints)]
+
+        def txid_status(bt_name, txid):
+            raise exceptions.BtcMonitorTransactionException(f'{txid} not found')
+
+        return mock.patch.multiple(
+            withdraw,
+            btc_list_wallet_utxos=list_utxos,
+            btc_transaction_feerate=lambda **kwargs: self.feerate,
+            btc_create_raw_transaction=create,
+            btc_sign_transaction=sign,
+            btc_send_transaction=send,
+            btc_get_txid_status=txid_status
+        )
+
+    def queue(self, *payments):
+        u_txids = []
+        for address, amount in payments:
+            u_txid = uuid.uuid4()
+            status = withdraw.withdraw_btc(u_txid, address, decimal.Decimal(amount))
+            self.assertEqual(status, WithdrawalStatus.PREPENDING.value)
+            u_txids.append(u_txid)
+        return u_txids
+
+    def withdrawals(self, u_txids):
+        sqla_session.expire_all()
+        q = db.transaction.CryptoWithdrawTransaction.query
+        return [q.filter_by(u_txid=u).one() for u in u_txids]
+
+    def test_001_merged_payments(self):
+        u_txids = self.queue(
+            (self.destinations[0], '0.2'), (self.destinations[1], '0.2'), (self.destinations[0], '0.1')
+        )
+
+        with self.node(self.utxos('0.3', '0.4')):
+            self.assertEqual(withdraw.periodic_flush_withdraw_btc(), 3)
+
+        self.assertEqual(len(self.created), 1)
+        self.assertEqual(self.created[0]['payments'], {
+            self.destinations[0]: decimal.Decimal('0.3'),
+            self.destinations[1]: decimal.Decimal('0.2')
+        })
+        self.assertEqual(self.sent, ['signed_raw1'])
+
+        withdrawals = self.withdrawals(u_txids)
+        self.assertEqual({w.status for w in withdrawals}, {WithdrawalStatus.PENDING.value})
+        self.assertEqual({tuple(w.txids) for w in withdrawals}, {('txid_raw1',)})
+
+    def test_005_prefix_trimming(self):
+        u_txids = self.queue(
+            (self.destinations[0], '0.2'), (self.destinations[1], '0.2'),
+            (self.destinations[2], '0.3'), (self.destinations[0], '0.1')
+        )
+
+        # 0.6 covers the first two withdrawals with their fee, not the third one
+        with self.node(self.utxos('0.3', '0.3')):
+            self.assertEqual(withdraw.periodic_flush_withdraw_btc(), 2)
+
+        statuses = [w.status for w in self.withdrawals(u_txids)]
+        self.assertEqual(statuses, [WithdrawalStatus.PENDING.value] * 2 + [WithdrawalStatus.PREPENDING.value] * 2)
+
+    def test_010_failed_head(self):
+        u_txids = self.queue((self.destinations[0], '0.5'), (self.destinations[1], '0.01'))
+
+        with self.node(self.utxos('0.1')):
+            self.assertEqual(withdraw.periodic_flush_withdraw_btc(), 0)
+            statuses = [w.status for w in self.withdrawals(u_txids)]
+            self.assertEqual(statuses, [WithdrawalStatus.FAILED.value, WithdrawalStatus.PREPENDING.value])
+
+            # the head doesn't block the rest of the queue
+            self.assertEqual(withdraw.periodic_flush_withdraw_btc(), 1)
+            self.assertEqual(self.withdrawals(u_txids)[1].status, WithdrawalStatus.PENDING.value)
+
+    def test_015_broadcast_failure(self):
+        u_txids = self.queue((self.destinations[0], '0.2'), (self.destinations[1], '0.2'))
+
+        with self.node(self.utxos('0.5'), send_error=ConnectionResetError()):
+            self.assertEqual(withdraw.periodic_flush_withdraw_btc(), 2)
+
+        # the transaction is recorded and the withdrawals are not queued anymore
+        withdrawals = self.withdrawals(u_txids)
+        self.assertEqual({w.status for w in withdrawals}, {WithdrawalStatus.PENDING.value})
+        outgoing = db.btc.OutgoingTransaction.query.filter_by(txid=withdrawals[0].txids[0]).one()
+        self.assertFalse(outgoing.is_sent)
+
+        # the same transaction is sent again, not a new one
+        bi = db.btc.BitcoindInstance.query.filter_by(instance_name='Test').one()
+        with self.node(self.utxos('0.5')):
+            self.assertEqual(withdraw.periodic_flush_withdraw_btc(), 0)
+            self.assertEqual(withdraw.broadcast_withdrawals_btc(bi), 1)
+
+        self.assertEqual(len(self.created), 1)
+        self.assertEqual(self.sent, ['signed_raw1'])
+        sqla_session.expire_all()
+        self.assertTrue(db.btc.OutgoingTransaction.query.filter_by(txid=outgoing.txid).one().is_sent)
+
+    def test_017_failed_broadcast_inputs_reserved(self):
+        utxos = self.utxos('0.5', '0.5')
+        first = self.queue((self.destinations[0], '0.2'))
+
+        with self.node(utxos, send_error=ConnectionResetError()):
+            self.assertEqual(withdraw.periodic_flush_withdraw_btc(), 1)
+            second = self.queue((self.destinations[1], '0.2'))
+            self.assertEqual(withdraw.periodic_flush_withdraw_btc(), 1)
+
+        # the second transaction doesn't spend the inputs of the first one, both stay sendable
+        self.assertEqual(len(self.created), 2)
+        self.assertFalse(set(self.created[0]['utxos']) & set(self.created[1]['utxos']))
+
+        bi = db.btc.BitcoindInstance.query.filter_by(instance_name='Test').one()
+        with self.node(utxos):
+            self.assertEqual(withdraw.broadcast_withdrawals_btc(bi), 2)
+
+        self.assertEqual([w.status for w in self.withdrawals(first + second)], [WithdrawalStatus.PENDING.value] * 2)
+
+    def test_018_rejected_transaction(self):
+        u_txids = self.queue((self.destinations[0], '0.2'))
+
+        rejected = exceptions.BtcTransactionRejectedException('bad-txns-inputs-missingorspent')
+        with self.node(self.utxos('0.5'), send_error=rejected):
+            self.assertEqual(withdraw.periodic_flush_withdraw_btc(), 1)
+
+            bi = db.btc.BitcoindInstance.query.filter_by(instance_name='Test').one()
+            self.assertEqual(withdraw.broadcast_withdrawals_btc(bi), 0)
+
+        # terminal: not retried, the withdrawal failed and the spent amount is returned
+        self.assertEqual(self.attempts, 1)
+        self.assertEqual(self.withdrawals(u_txids)[0].status, WithdrawalStatus.FAILED.value)
+        outgoing = db.btc.OutgoingTransaction.query.filter_by(txid='txid_raw1').one()
+        self.assertTrue(outgoing.is_rejected)
+        self.assertEqual(db.btc.ChangeTransactionLog.query.filter_by(change_tx_id='txid_raw1').count(), 0)
+        amounts = {a.address: a.amount for a in db.btc.Address.query.filter(db.btc.Address.address.in_(self.sources))}
+        self.assertEqual(amounts, {a: decimal.Decimal('1.0') for a in self.sources})
+
+        # the inputs of the rejected transaction can be spent again
+        u_txids = self.queue((self.destinations[1], '0.2'))
+        with self.node(self.utxos('0.5')):
+            self.assertEqual(withdraw.periodic_flush_withdraw_btc(), 1)
+        self.assertEqual(self.created[1]['utxos'], self.created[0]['utxos'])
+        self.assertEqual(self.withdrawals(u_txids)[0].status, WithdrawalStatus.PENDING.value)
+
+    def test_020_change_credited_once(self):
+        u_txids = self.queue((self.destinations[0], '0.2'), (self.destinations[1], '0.2'))
+
+        with self.node(self.utxos('0.3', '0.4')):
+            withdraw.periodic_flush_withdraw_btc()
+
+        change = self.created[0]
+        self.assertGreater(change['change_amount'], 0)
+        change_address = db.btc.Address.query.filter_by(address=change['change']).one()
+        amount_before = change_address.amount
+
+        tx_info = {
+            'txid': 'txid_raw1',
+            'confirmations': 6,
+            'vout': [
+                {'value': change['change_amount'], 'scriptPubKey': {'addresses': [change['change']]}},
+                {'value': decimal.Decimal('0.2'), 'scriptPubKey': {'addresses': [self.destinations[0]]}},
+                {'value': decimal.Decimal('0.2'), 'scriptPubKey': {'addresses': [self.destinations[1]]}}
+            ]
+        }
+        with self.node([]), mock.patch.object(withdraw, 'btc_get_txid_status', lambda **kwargs: tx_info):
+            self.assertEqual(withdraw.periodic_check_withdraw_btc(), 2)
+
+        statuses = [w.status for w in self.withdrawals(u_txids)]
+        self.assertEqual(statuses, [WithdrawalStatus.COMPLETED.value] * 2)
+        change_address = db.btc.Address.query.filter_by(address=change['change']).one()
+        self.assertEqual(change_address.amount, amount_before + change['change_amount'])
+
+
+class CoinSelectionTest(unittest.TestCase):
+    feerate = decimal.Decimal('0.0001')     # 10 satoshi per byte
+
+    @staticmethod
+    def utxos(*amounts):
+        return [coin_selection.Utxo(f'tx{i}', 0, f'addr{i}', decimal.Decimal(a)) for i, a in enumerate(amounts)]
+
+    def test_001_changeless_match(self):
+        # 0.5 BTC UTXO minus its input (1480 sat) and the rest of the transaction (440 sat) covers amount exactly
+        utxos = self.utxos('0.3', '0.5', '0.2')
+        selection = coin_selection.select_coins(utxos, decimal.Decimal('0.49998080'), self.feerate)
+
+        self.assertEqual([u.txid for u in selection.utxos], ['tx1'])
+        self.assertEqual(selection.change, 0)
+        self.assertEqual(selection.fee, decimal.Decimal('0.00001920'))
+
+    def test_005_change(self):
+        utxos = self.utxos('0.3', '0.5', '0.2')
+        selection = coin_selection.select_coins(utxos, decimal.Decimal('0.6'), self.feerate)
+
+        spent = sum(u.amount for u in selection.utxos)
+        self.assertEqual(spent, decimal.Decimal('0.6') + selection.fee + selection.change)
+        self.assertGreater(selection.change, 0)
+        self.assertEqual(len(selection.utxos), 2)
+
+    def test_010_fee_covers_size(self):
+        utxos = self.utxos(*['0.01'] * 10)
+        selection = coin_selection.select_coins(utxos, decimal.Decimal('0.035'), self.feerate, outputs=3)
+
+        outputs = 3 + (1 if selection.change > 0 else 0)
+        size = coin_selection.transaction_size(len(selection.utxos), outputs)
+        self.assertGreaterEqual(selection.fee, size * self.feerate / 1000)
+
+    def test_015_uneconomic_utxos_skipped(self):
+        # spending a 1000 satoshi UTXO costs 1480 satoshi
+        utxos = self.utxos('0.1', *['0.00001'] * 50)
+        selection = coin_selection.select_coins(utxos, decimal.Decimal('0.05'), self.feerate)
+
+        self.assertEqual([u.txid for u in selection.utxos], ['tx0'])
+
+    def test_020_max_inputs(self):
+        utxos = self.utxos(*['0.001'] * 100)
+
+        with self.assertRaises(exceptions.BtcInsufficientFundsException):
+            coin_selection.select_coins(utxos, decimal.Decimal('0.05'), self.feerate, max_inputs=20)
+
+    def test_025_insufficient_funds(self):
+        with self.assertRaises(exceptions.BtcInsufficientFundsException):
+            coin_selection.select_coins(self.utxos('0.1', '0.2'), decimal.Decimal('0.3'), self.feerate)
+
+    def test_030_branch_and_bound(self):
+        values = [50, 40, 30, 20, 10]
+
+        selected = coin_selection.branch_and_bound(values, 60, 0, coin_selection.MAX_INPUTS)
+        self.assertEqual(sum(values[i] for i in selected), 60)
+        self.assertIsNone(coin_selection.branch_and_bound(values, 155, 100, coin_selection.MAX_INPUTS))
@@ -0,0 +1,132 @@
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+from aiohttp import web
+
+from transer import chain_events
+from transer.exceptions import DaemonConfigException
+
+
+class ListenerTestMixin:
+    loop = None
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(None)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_listener(self, listener, uri, check, timeout=5):
+        """
+        Запускает listener, дожидается пробуждения и останавливает его
+
+        :param check: корутина, выполняемая параллельно с ожиданием пробуждения (например, публикация блоков)
+        """
+        wakeup = asyncio.Event(loop=self.loop)
+        task = self.loop.create_task(listener(uri, [wakeup], loop=self.loop))
+
+        async def wait():
+            publisher = self.loop.create_task(check())
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout, loop=self.loop)
+            finally:
+                publisher.cancel()
+                task.cancel()
+
+        self.loop.run_until_complete(wait())
+        self.assertTrue(wakeup.is_set())
+
+
+class BitcoindBlocksTest(ListenerTestMixin, unittest.TestCase):
+    def test_001_hashblock_notification(self):
+        zmq = chain_events.import_zmq()
+        context = zmq.Context()
+        publisher = context.socket(zmq.PUB)
+        port = publisher.bind_to_random_port('tcp://127.0.0.1')
+
+        async def publish():
+            # subscription is propagated to the publisher asynchronously, so publish until delivered
+            while True:
+                publisher.send_multipart([b'rawtx', b'\x00' * 32, b'\x00\x00\x00\x00'])
+                publisher.send_multipart([b'hashblock', b'\x01' * 32, b'\x00\x00\x00\x00'])
+                await asyncio.sleep(0.05, loop=self.loop)
+
+        try:
+            self.run_listener(chain_events.listen_bitcoind_blocks, f'tcp://127.0.0.1:{port}', publish)
+        finally:
+            publisher.close(linger=0)
+            context.term()
+
+    def test_005_pyzmq_required_on_startup(self):
+        with mock.patch.dict('sys.modules', {'zmq': None, 'zmq.asyncio': None}):
+            with self.assertRaises(DaemonConfigException):
+                chain_events.create_block_listeners(self.loop, btcd_zmq_uri='tcp://127.0.0.1:28332')
+
+
+class GethHeadsTest(ListenerTestMixin, unittest.TestCase):
+    def start_server(self, handler):
+        app = web.Application(loop=self.loop)
+        app.router.add_get('/', handler)
+        self.handler = app.make_handler(loop=self.loop)
+        self.server = self.loop.run_until_complete(self.loop.create_server(self.handler, '127.0.0.1', 0))
+        return f'ws://127.0.0.1:{self.server.sockets[0].getsockname()[1]}/'
+
+    def tearDown(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.loop.run_until_complete(self.handler.shutdown(1.0))
+        super(GethHeadsTest, self).tearDown()
+
+    def test_001_new_heads_notification(self):
+        async def geth(request):
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+
+            subscribe = json.loads((await ws.receive()).data)
+            self.assertEqual(subscribe['method'], 'eth_subscribe')
+            self.assertEqual(subscribe['params'], ['newHeads'])
+
+            await ws.send_str(json.dumps({'jsonrpc': '2.0', 'id': subscribe['id'], 'result': '0x1'}))
+            await ws.send_str(json.dumps({
+                'jsonrpc': '2.0',
+                'method': 'eth_subscription',
+                'params': {'subscription': '0x1', 'result': {'number': '0x10', 'hash': '0x' + '01' * 32}}
+            }))
+            await ws.receive()
+            return ws
+
+        async def idle():
+            pass
+
+        ws_uri = self.start_server(geth)
+        self.run_listener(chain_events.listen_geth_heads, ws_uri, idle)
+
+    def test_005_reconnect(self):
+        connections = []
+
+        async def geth(request):
+            ws = web.WebSocketResponse()
+            await ws.prepare(request)
+            await ws.receive()
+
+            connections.append(request)
+            if len(connections) > 1:    # the first connection is dropped without notifications
+                await ws.send_str(json.dumps({
+                    'jsonrpc': '2.0',
+                    'method': 'eth_subscription',
+                    'params': {'subscription': '0x1', 'result': {'number': '0x11'}}
+                }))
+                await ws.receive()
+            await ws.close()
+            return ws
+
+        async def idle():
+            pass
+
+        ws_uri = self.start_server(geth)
+        with mock.patch.object(chain_events, 'RECONNECT_DELAY', 0.01):
+            self.run_listener(chain_events.listen_geth_heads, ws_uri, idle)
+        self.assertEqual(len(connections), 2)
@@ -0,0 +1,236 @@
+import asyncio
+import selectors
+import unittest
+from concurrent.futures import Future
+
+from transer import config
+from transer.scheduler import PeriodicTask
+
+
+class FakeClockSelector(selectors.DefaultSelector):
+    """
+    Вместо ожидания таймеров event loop-а переводит его виртуальные часы
+    """
+
+    def __init__(self, clock):
+        super(FakeClockSelector, self).__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        events = super(FakeClockSelector, self).select(0)
+        if events or timeout is None:
+            return events or super(FakeClockSelector, self).select(None)
+
+        self.clock.advance(timeout)
+        return []
+
+
+class FakeClockLoop(asyncio.SelectorEventLoop):
+    """
+    Event loop с виртуальным временем: результаты тестов не зависят от загрузки машины
+    """
+
+    def __init__(self):
+        self.now = 0.0
+        super(FakeClockLoop, self).__init__(selector=FakeClockSelector(self))
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += max(seconds, 0)
+
+
+class FakeExecutor(object):
+    """
+    Исполняет вызовы в потоке event loop-а, каждый завершается через duration секунд виртуального времени.
+    Считает максимальное наложение вызовов
+    """
+
+    def __init__(self, loop, duration=0.0):
+        self.loop = loop
+        self.duration = duration
+        self.running = 0
+        self.max_running = 0
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+
+        def complete():
+            self.running -= 1
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.loop.call_later(self.duration, complete)
+        return future
+
+
+class FakeJob(object):
+    """
+    Периодическая функция: считает запуски
+    """
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.runs = 0
+
+    def __call__(self):
+        self.runs += 1
+        if self.fail:
+            raise RuntimeError('job failed')
+        return self.runs
+
+
+class PeriodicTaskTest(unittest.TestCase):
+    def setUp(self):
+        config['sentry_dsn'] = None
+        self.loop = FakeClockLoop()
+        asyncio.set_event_loop(None)
+        self.executor = FakeExecutor(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def create_task(self, func, interval, **options):
+        return PeriodicTask(func, [], {}, interval, loop=self.loop, executor=self.executor, name='test', **options)
+
+    def run_for(self, task, seconds):
+        async def run():
+            runner = self.loop.create_task(task.run_forever())
+            await asyncio.sleep(seconds, loop=self.loop)
+            runner.cancel()
+            try:
+                await runner
+            except asyncio.CancelledError:
+                pass
+        self.loop.run_until_complete(run())
+
+    def test_001_adapt_interval(self):
+        task = self.create_task(FakeJob(), 10, min_interval=2, max_interval=40)
+
+        task.adapt_interval(backlog=5)
+        self.assertEqual(task.current_interval, 2)
+
+        # idle runs grow the interval back to 'interval' and then up to 'max_interval'
+        intervals = []
+        for _ in range(5):
+            task.adapt_interval(backlog=0)
+            intervals.append(task.current_interval)
+        self.assertEqual(intervals, [10, 20, 40, 40, 40])
+
+    def test_005_run_once(self):
+        job = FakeJob()
+        task = self.create_task(job, 10)
+
+        self.loop.run_until_complete(task.run_once())
+        self.assertEqual(job.runs, 1)
+        self.assertEqual(task.stats['runs'], 1)
+        self.assertEqual(task.stats['failures'], 0)
+        self.assertEqual(task.stats['last_result'], 1)
+
+    def test_010_failure_is_counted(self):
+        task = self.create_task(FakeJob(fail=True), 10)
+
+        self.loop.run_until_complete(task.run_once())
+        self.assertEqual(task.stats['runs'], 1)
+        self.assertEqual(task.stats['failures'], 1)
+
+    def test_015_deadline_overrun(self):
+        self.executor.duration = 5
+        task = self.create_task(FakeJob(), 10, deadline=1)
+
+        self.loop.run_until_complete(task.run_once())
+        # the task stops waiting for the run at the deadline
+        self.assertEqual(self.loop.time(), 1)
+        self.assertEqual(task.stats['overruns'], 1)
+
+        self.loop.run_until_complete(task.overdue)
+        self.assertEqual(task.stats['runs'], 1)
+
+    def test_017_overdue_run_blocks_next_runs(self):
+        self.executor.duration = 4.5
+        job = FakeJob()
+        task = self.create_task(job, 1, deadline=1)
+
+        # runs start at 0, 5 and 10: the ones due at 1-4, 6-9 and 11 wait for the overdue run to finish
+        self.run_for(task, 11.5)
+        self.assertEqual(job.runs, 2)
+        self.assertEqual(task.stats['overruns'], 3)
+        self.assertEqual(task.stats['skips'], 9)
+        self.assertEqual(self.executor.max_running, 1)
+
+        self.loop.run_until_complete(task.overdue)
+
+    def test_020_no_overlap(self):
+        # every run takes longer than the interval: they start at 0, 5, 10, ... and five finish by 27
+        self.executor.duration = 5
+        job = FakeJob()
+        task = self.create_task(job, 1)
+
+        self.run_for(task, 27)
+        self.assertEqual(job.runs, 5)
+        self.assertEqual(self.executor.max_running, 1)
+
+    def test_025_skip_unchanged_tip(self):
+        job = FakeJob()
+        task = self.create_task(job, 1, max_interval=20, tip_probe=lambda: 'tip')
+
+        # the interval doubles while idle: the tip is probed at 0, 2, 6, 14 and 30,
+        # the run at 30 is forced by 'max_interval'
+        self.run_for(task, 45)
+        self.assertEqual(job.runs, 2)
+        self.assertEqual(task.stats['skips'], 3)
+
+    def test_030_run_on_tip_change(self):
+        tips = iter(range(1000))
+        job = FakeJob()
+        task = self.create_task(job, 1, max_interval=1000, tip_probe=lambda: next(tips))
+
+        self.run_for(task, 20)
+        self.assertEqual(job.runs, 4)   # at 0, 2, 6 and 14
+        self.assertEqual(task.stats['skips'], 0)
+
+    def test_035_backlog_shortens_interval(self):
+        task = self.create_task(FakeJob(), 10, min_interval=1, max_interval=10, backlog_probe=lambda: 10)
+
+        self.run_for(task, 20.5)
+        self.assertEqual(task.stats['runs'], 21)
+        self.assertEqual(task.stats['backlog'], 10)
+        self.assertEqual(task.stats['interval'], 1)
+
+    def test_040_failed_probes(self):
+        def probe():
+            raise RuntimeError('node is down')
+
+        job = FakeJob()
+        task = self.create_task(job, 10, tip_probe=probe, backlog_probe=probe)
+
+        self.run_for(task, 15)
+        # the task runs as if there were no probes
+        self.assertEqual(job.runs, 2)
+
+    def test_045_wakeup(self):
+        job = FakeJob()
+        wakeup = asyncio.Event(loop=self.loop)
+        task = self.create_task(job, 10, wakeup=wakeup, tip_probe=lambda: 'tip')
+
+        async def notify():
+            await asyncio.sleep(5, loop=self.loop)
+            wakeup.set()
+
+        self.loop.create_task(notify())
+        self.run_for(task, 8)
+        # woken up runs are not skipped even if the tip has not moved yet
+        self.assertEqual(job.runs, 2)
+
+    def test_050_jitter_spreads_start(self):
+        job = FakeJob()
+        task = self.create_task(job, 10, jitter=0.1)
+
+        self.run_for(task, 1)
+        self.assertEqual(job.runs, 1)   # started within 'jitter * interval'
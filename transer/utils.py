@@ -7,6 +7,7 @@ import logging
 from logging.config import dictConfig
 import decimal
 import json
+import time
 import asyncio
 import importlib.util
 
@@ -23,7 +24,7 @@ from jsonrpc.exceptions import JSONRPCDispatchException
 
 from aiohttp import web
 
-from transer import db, config
+from transer import db, config, metrics, profiling, rpc_stats
 
 
 class ExceptionBaseClass(Exception):
@@ -157,11 +158,102 @@ def init_logging():
     logging.config.dictConfig(logging_config)
 
 
-def handler_fabric(executor, dispatcher):
+def cpu_bound(func):
+    """
+    Помечает JSON-RPC метод как CPU-bound (подпись транзакций, деривация ключей и т.п.).
+    Такие методы исполняются в ProcessPoolExecutor, все остальные считаются I/O-bound
+    и в native dispatch mode исполняются в ThreadPoolExecutor без pickle/IPC
+    """
+    func.cpu_bound = True
+    return func
+
+
+def jsonrpc_parse(body):
+    """
+    Дешёвый разбор тела JSON-RPC запроса (одиночного или batch) в event loop
+
+    :param body: тело запроса as str
+    :return: разобранный запрос (dict или list) или None, если тело не разбирается
+    """
+    try:
+        return json.loads(body)
+    except (TypeError, ValueError):
+        return None
+
+
+def jsonrpc_methods(data):
+    """
+    :param data: разобранный JSON-RPC запрос, см. jsonrpc_parse()
+    :return: list имён методов или None, если запрос некорректный
+    """
+    if data is None:
+        return None
+
+    items = data if isinstance(data, list) else [data]
+    methods = []
+    for i in items:
+        if not isinstance(i, dict) or not isinstance(i.get('method'), str):
+            return None
+        methods.append(i['method'])
+    return methods
+
+
+def is_cpu_bound_request(dispatcher, data):
+    methods = jsonrpc_methods(data)
+    if methods is None:
+        return True     # let the worker process report the error as usual
+
+    for m in methods:
+        func = dispatcher.method_map.get(m)
+        if func is None or getattr(func, 'cpu_bound', False):
+            return True
+    return False
+
+
+def handler_fabric(executor, dispatcher, io_executor=None):
+    """
+    :param executor: ProcessPoolExecutor для CPU-bound методов
+    :param dispatcher: jsonrpc.Dispatcher
+    :param io_executor: ThreadPoolExecutor для I/O-bound методов (native dispatch mode);
+        если None, то все запросы идут в executor как раньше
+    """
+    def choose_executor(data):
+        if io_executor is not None and not is_cpu_bound_request(dispatcher, data):
+            return io_executor
+        return executor
+
+    async def timed_submit(endpoint, data, func, *args):
+        methods = jsonrpc_methods(data)
+        method = methods[0] if methods and methods[0] in dispatcher.method_map else 'unknown'
+
+        started = time.monotonic()
+        try:
+            return await submit(choose_executor(data), func, *args)
+        finally:
+            metrics.jsonrpc_requests.inc(endpoint=endpoint, method=method)
+            metrics.jsonrpc_request_duration.observe(time.monotonic() - started, endpoint=endpoint, method=method)
+
+    async def batch_submitter(endpoint, batch):
+        # JSON-RPC 2.0 batch: every item is handled by its own worker, responses are gathered in request order
+        if len(batch) == 0:
+            return jsonrpc_error_response(-32600, 'Invalid Request')
+
+        responses = await asyncio.gather(*[
+            timed_submit(endpoint, item, jsonrpc_dispatch, dispatcher, json.dumps(item)) for item in batch
+        ])
+
+        responses = [r for r in responses if r is not None]     # notifications have no response
+        text = '[' + ','.join(responses) + ']' if responses else ''
+        return web.Response(text=text, headers={'Content-Type': 'application/json'})
+
     async def submitter(request):
         body = await request.text()
-        future = executor.submit(subprocess_wrapper, jsonrpc_handler, dispatcher, request.headers, body)
-        return await asyncio.wrap_future(future)   # future.result() нельзя, тк. нужен (a)wait в asyncio loop
+        data = jsonrpc_parse(body)
+
+        if isinstance(data, list) and request.headers.get('Content-Type') == 'application/json':
+            return await batch_submitter(request.path, data)
+
+        return await timed_submit(request.path, data, jsonrpc_handler, dispatcher, request.headers, body)
     return submitter
 
 
@@ -179,8 +271,7 @@ def endpoint_fabric(executor, func):
             sync_request['match_info'] = request.match_info
             sync_request['json'] = await json_from_request(request)
 
-            future = executor.submit(subprocess_wrapper, func, sync_request)
-            return await asyncio.wrap_future(future)   # future.result() нельзя, тк. нужен (a)wait в asyncio loop
+            return await submit(executor, func, sync_request)
         except Exception as e:
             if config['sentry_dsn']:
                 sentry_client = Client(
@@ -198,9 +289,57 @@ def endpoint_fabric(executor, func):
     return submitter
 
 
+async def submit(executor, func, *args, **kwargs):
+    """
+    Исполнение func в executor-е через subprocess_wrapper() с учётом глубины очереди executor-а
+    и сделанных RPC вызовов в /metrics
+    """
+    tag = profile_tag(func, args)
+
+    future = executor.submit(instrumented_call, func, *args, **kwargs)
+    metrics.track_future(executor, future)
+    try:
+        # future.result() нельзя, тк. нужен (a)wait в asyncio loop
+        result, rpc_calls = await asyncio.wrap_future(future)
+    except Exception as e:
+        metrics.record_rpc_calls(tag, getattr(e, 'rpc_calls', {}))
+        raise
+    metrics.record_rpc_calls(tag, rpc_calls)
+    return result
+
+
+def instrumented_call(func, *args, **kwargs):
+    """
+    Исполняется в executor-е: статистика RPC вызовов worker-а возвращается в главный процесс вместе с результатом
+
+    :return: (результат func, rpc_stats)
+    """
+    rpc_stats.reset()
+    try:
+        result = subprocess_wrapper(func, *args, **kwargs)
+    except Exception as e:
+        e.rpc_calls = rpc_stats.drain()
+        raise
+    return result, rpc_stats.drain()
+
+
+def profile_tag(func, args):
+    """
+    :return: имя профилируемого вызова: JSON-RPC метод(ы) для jsonrpc_handler()/jsonrpc_dispatch(), иначе имя функции
+    """
+    if func in (jsonrpc_handler, jsonrpc_dispatch):
+        methods = jsonrpc_methods(jsonrpc_parse(args[-1]))
+        return '+'.join(methods) if methods else 'jsonrpc_invalid'
+
+    func = getattr(func, 'func', func)  # functools.partial
+    return getattr(func, '__name__', repr(func))
+
+
 def subprocess_wrapper(func, *args, **kwargs):
     # Sqlalchemy's Engine to multiprocessing augmenter moved to init_db()
     try:
+        if config.get('profile_dir'):
+            return profiling.profiled(profile_tag(func, args), func, *args, **kwargs)
         return func(*args, **kwargs)
     except Exception as e:
         if config['sentry_dsn']:
@@ -218,21 +357,37 @@ def subprocess_wrapper(func, *args, **kwargs):
             raise e
 
 
-def jsonrpc_handler(dispatcher, headers, body):
-    if headers.get('Content-Type') != 'application/json':
-        error_response = {
-            'error': {
-                'code': -32700,
-                'message': 'Parse error'
-            },
-            'id': None,
-            'jsonrpc': '2.0'
-        }
-        return web.Response(text=json.dumps(error_response), headers={'Content-Type': 'application/json'})
+def jsonrpc_error_response(code, message):
+    error_response = {
+        'error': {
+            'code': code,
+            'message': message
+        },
+        'id': None,
+        'jsonrpc': '2.0'
+    }
+    return web.Response(text=json.dumps(error_response), headers={'Content-Type': 'application/json'})
+
 
+def jsonrpc_dispatch(dispatcher, body):
+    """
+    :param dispatcher: jsonrpc.Dispatcher
+    :param body: JSON-RPC запрос as str
+    :return: сериализованный JSON-RPC ответ as str или None для notification
+    """
     response = JSONRPCResponseManager.handle(body, dispatcher)
+    if response is None:
+        return None
     response.serialize = lambda s: json.dumps(s, cls=DatetimeDecimalEncoder)
-    return web.Response(text=response.json, headers={'Content-Type': 'application/json'})
+    return response.json
+
+
+def jsonrpc_handler(dispatcher, headers, body):
+    if headers.get('Content-Type') != 'application/json':
+        return jsonrpc_error_response(-32700, 'Parse error')
+
+    text = jsonrpc_dispatch(dispatcher, body)
+    return web.Response(text=text or '', headers={'Content-Type': 'application/json'})
 
 
 def bulk_importer(path):
@@ -264,26 +419,65 @@ def docstrings_from_dispatcher(dispatcher):
     return methods
 
 
-# inspired by https://gist.github.com/Horace89/88316fb7e518cc629ccb63abec540e48
-def delayed_schedule(func, args=None, kwargs=None, interval=60, *, loop, executor):
-    if args is None:
-        args = []
-    if kwargs is None:
-        kwargs = {}
-
-    async def periodic_func():
-        while True:
-            future = executor.submit(subprocess_wrapper, func, *args, **kwargs)
-            await asyncio.wrap_future(future)
-            await asyncio.sleep(interval, loop=loop)
+_http_pools = {}     # {pid: urllib3.PoolManager}
+
+
+def http_pool():
+    """
+    Долгоживущий keep-alive пул HTTP(S) соединений к signing-нодам, один на процесс.
+    После fork() пул родительского процесса не используется, тк. его сокеты общие с родителем
+
+    :return: urllib3.PoolManager
+    """
+    pid = os.getpid()
+    pool = _http_pools.get(pid)
+    if pool is None:
+        _http_pools.clear()
+        pool = urllib3.PoolManager(
+            maxsize=config.get('signer_pool_maxsize', 10),
+            timeout=urllib3.Timeout(
+                connect=config.get('signer_connect_timeout', 5.0),
+                read=config.get('signer_read_timeout', 120.0)
+            ),
+            ca_certs=certifi.where(),
+            cert_reqs='CERT_REQUIRED'
+        )
+        _http_pools[pid] = pool
+    return pool
+
+
+def jsonrpc_post(target_uri, payload):
+    """
+    :param target_uri: url JSON-RPC сервера
+    :param payload: JSON-RPC запрос (dict) или batch (list)
+    :return: декодированный ответ
+    """
+    encoded_data = json.dumps(payload, cls=DatetimeDecimalEncoder).encode('utf-8')
+    if isinstance(payload, list):
+        method, calls = rpc_stats.batch_method(p['method'] for p in payload), len(payload)
+    else:
+        method, calls = payload['method'], 1
 
-    return loop.create_task(periodic_func())
+    started = time.monotonic()
+    resp_data = b''
+    errors = calls
+    try:
+        resp = http_pool().request(
+            'POST',
+            target_uri,
+            body=encoded_data,
+            headers={'Content-Type': 'application/json'},
+            retries=3
+        )
+        resp_data = resp.data
+        decoded_resp = json.loads(resp_data)
+        errors = rpc_stats.count_errors(decoded_resp)
+        return decoded_resp
+    finally:
+        rpc_stats.record('signer', method, started, len(encoded_data), len(resp_data), errors, calls)
 
 
-def create_delayed_scheduler(loop=None, executor=None):
-    if loop is not None and executor is not None:
-        return functools.partial(delayed_schedule, loop=loop, executor=executor)
-    return None
+LOCAL_RUNNABLE_MARK = 'a237e8d6-1af0-4c22-8d47-062bb6900b18'   # magic number :)
 
 
 # All these tricks with magic numbers need to work around the limitations of 'multiprocessing'
@@ -293,61 +487,98 @@ def create_delayed_scheduler(loop=None, executor=None):
 # http://www.jsonrpc.org/specification#parameter_structures
 def jsonrpc_caller(target_uri=None, catchables=()):
     def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
+        func_params = list(inspect.signature(func).parameters)
+        exceptions = {x.__name__: x for x in catchables}
+
+        def jsonrpc_request(args, kwargs, request_id=0):
             if len(args) > 0 and len(kwargs) > 0:
                 raise JSONRPCDispatchException(-32600, 'Positional and named args cannot be mixed')
 
-            if len(args) and args[-1] == 'a237e8d6-1af0-4c22-8d47-062bb6900b18':  # magic number :)
-                args.pop()
-                return func(*args, **kwargs)
-            if kwargs.pop('__local_runnable__', None):
-                return func(*args, **kwargs)
-
             if len(args) > 0:
-                params = {}
-                func_params = inspect.signature(func).parameters
-                for i, p in enumerate(func_params):
-                    params[p] = args[i]
+                params = dict(zip(func_params, args))
             else:
-                params = kwargs
+                params = dict(kwargs)
 
-            params['__local_runnable__'] = 'a237e8d6-1af0-4c22-8d47-062bb6900b18'  # magic number :)
-            payload = {
+            params['__local_runnable__'] = LOCAL_RUNNABLE_MARK
+            return {
                 "method": func.__name__,
                 "params": params,
                 "jsonrpc": "2.0",
-                "id": 0,
+                "id": request_id,
             }
 
-            encoded_data = json.dumps(payload, cls=DatetimeDecimalEncoder).encode('utf-8')
+        def jsonrpc_result(decoded_resp):
+            if decoded_resp.get('error') is None:
+                return decoded_resp.get('result')
 
-            http = urllib3.PoolManager(
-                ca_certs=certifi.where(),
-                cert_reqs='CERT_REQUIRED'
-            )
-            resp = http.request(
-                'POST',
-                target_uri,
-                body=encoded_data,
-                headers={'Content-Type': 'application/json'},
-                retries=3
-            )
+            error = decoded_resp['error']
+            error_data = error.get('data') or {}
+            remote_exception_args = error_data.get('args', [error.get('message')])
+            if error_data.get('type') in exceptions:
+                remote_exception = exceptions[error_data['type']]
+                raise remote_exception(*remote_exception_args)
+            else:
+                unknown_exception = Exception
+                raise unknown_exception(*remote_exception_args)
 
-            decoded_resp = json.loads(resp.data)
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if len(args) > 0 and len(kwargs) > 0:
+                raise JSONRPCDispatchException(-32600, 'Positional and named args cannot be mixed')
 
-            if decoded_resp.get('result', None):
-                return decoded_resp['result']
-            else:
-                exceptions = {x.__name__: x for x in catchables}
-                error_data = decoded_resp['error']['data']
-                remote_exception_args = error_data['args']
-                if error_data['type'] in exceptions:
-                    remote_exception = exceptions[error_data['type']]
-                    raise remote_exception(*remote_exception_args)
-                else:
-                    unknown_exception = Exception
-                    raise unknown_exception(*remote_exception_args)
+            if len(args) and args[-1] == LOCAL_RUNNABLE_MARK:
+                return func(*args[:-1])
+            if kwargs.pop('__local_runnable__', None):
+                return func(*args, **kwargs)
+
+            decoded_resp = jsonrpc_post(target_uri, jsonrpc_request(args, kwargs))
+            return jsonrpc_result(decoded_resp)
+
+        wrapper.jsonrpc_target_uri = target_uri
+        wrapper.jsonrpc_request = jsonrpc_request
+        wrapper.jsonrpc_result = jsonrpc_result
 
         return wrapper if target_uri is not None else func
     return decorator
+
+
+def jsonrpc_batch(calls):
+    """
+    Пакетный вызов функций, обёрнутых jsonrpc_caller: все вызовы к одной signing-ноде уходят
+    одним JSON-RPC batch POST-ом. Функции без target_uri исполняются локально
+
+    :param calls: [(func, kwargs), ...]
+    :return: list результатов в порядке calls; исключение первого неуспешного вызова пробрасывается
+    """
+    results = [None] * len(calls)
+    remote_calls = {}   # {target_uri: [(idx, func, kwargs), ...]}
+
+    for idx, (func, kwargs) in enumerate(calls):
+        target_uri = getattr(func, 'jsonrpc_target_uri', None)
+        if target_uri is None:
+            results[idx] = func(**kwargs)
+        else:
+            remote_calls.setdefault(target_uri, []).append((idx, func, kwargs))
+
+    for target_uri, uri_calls in remote_calls.items():
+        payload = [func.jsonrpc_request((), kwargs, request_id=idx) for idx, func, kwargs in uri_calls]
+        decoded_resps = jsonrpc_post(target_uri, payload)
+        if isinstance(decoded_resps, dict):     # whole batch rejected, e.g. with Parse error
+            decoded_resps = [decoded_resps]
+
+        # an error of the whole batch comes with null id, report it instead of missing responses
+        batch_error = next((r for r in decoded_resps if r.get('id') is None), None)
+        if batch_error is not None:
+            _, func, _ = uri_calls[0]
+            func.jsonrpc_result(batch_error)    # raises the remote error
+            raise Exception(f'Malformed batch response from {target_uri}: {batch_error}')
+
+        resps_by_id = {r.get('id'): r for r in decoded_resps}
+
+        for idx, func, _ in uri_calls:
+            decoded_resp = resps_by_id.get(idx)
+            if decoded_resp is None:
+                raise Exception(f'No response for batched call of {func.__name__} from {target_uri}')
+            results[idx] = func.jsonrpc_result(decoded_resp)
+
+    return results